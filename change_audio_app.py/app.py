@@ -1,13 +1,10 @@
-import torch
 import gradio as gr
 
 from utils import (async_video_meta_data,
                    seconds_to_str,
                    timeline)
 from audio_change import split, riffusuion_inference, create_archive
-
-
-print(f'cuda: {torch.cuda.is_available()}')
+import riffusion_inference
 
 
 initial_caution = '# !!!'
@@ -176,4 +173,6 @@ with gr.Blocks(theme=gr.themes.Monochrome()) as demo:
 
 
 if __name__ == '__main__':
+    # Load the models while the UI starts instead of before it
+    riffusion_inference.start_loading()
     demo.launch(share=True)
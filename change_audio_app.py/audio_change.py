@@ -1,3 +1,4 @@
+import asyncio
 import os
 import uuid
 
@@ -41,7 +42,10 @@ async def riffusuion_inference(data: dict) -> dict:
     
     guidance_scale = data['additional']['guidance_scale']
     num_inference_steps = data['additional']['num_inference_steps']
-    riffusion_inference.inference(data['prompt'], guidance_scale, num_inference_steps, duration, audio_path, format='wav')
+    # In a thread, so waiting for the models to load does not block other requests
+    await asyncio.to_thread(
+        riffusion_inference.inference, data['prompt'], guidance_scale, num_inference_steps,
+        duration, audio_path, format='wav')
     
     edited_path = await replace_audio(
         video_path, audio_path, dir=config.temporary_directory,
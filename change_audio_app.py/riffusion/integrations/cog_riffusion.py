@@ -15,7 +15,7 @@ from cog import BaseModel, BasePredictor, Input, Path
 
 from riffusion.datatypes import InferenceInput, PromptInput
 from riffusion.riffusion_pipeline import RiffusionPipeline
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
+from riffusion.spectrogram_image_converter import get_spectrogram_image_converter
 from riffusion.spectrogram_params import SpectrogramParams
 
 MODEL_ID = "riffusion/riffusion-model-v1"
@@ -117,7 +117,7 @@ class RiffusionPredictor(BasePredictor):
 
         # Reconstruct audio from the image
         params = SpectrogramParams()
-        converter = SpectrogramImageConverter(params=params, device=self.device)
+        converter = get_spectrogram_image_converter(params=params, device=self.device)
         segment = converter.audio_from_spectrogram_image(image)
 
         if not os.path.exists("out/"):
@@ -1,14 +1,12 @@
-import shutil
-import subprocess
-import tempfile
+import functools
+import queue
+import threading
 import typing as T
-from pathlib import Path
 
 import numpy as np
 import pydub
 import torch
 import torchaudio
-from torchaudio.transforms import Fade
 
 from riffusion.util import audio_util
 
@@ -22,47 +20,127 @@ def split_audio(
 ) -> T.Dict[str, pydub.AudioSegment]:
     """
     Split audio into stems using demucs.
+
+    Uses a shared in-process separator, so the model is only loaded on the first call. The
+    stems never go through files anymore, so `extension` is unused and only kept for callers
+    that pass the later arguments by position.
+    """
+    separator = get_stem_separator(model_name=model_name, device=device)
+    stems = separator.separate(audio_util.Waveform.from_segment(segment), jobs=jobs)
+    return {name: stem.to_segment() for name, stem in stems.items()}
+
+
+class StemSeparator:
+    """
+    Resident demucs stem separation that keeps the model loaded between calls.
+
+    Holds a pool of `num_workers` model replicas, so that up to that many separations can run
+    concurrently from different threads. Further callers wait for a free replica.
+
+    See:
+        https://github.com/facebookresearch/demucs
+    """
+
+    def __init__(
+        self,
+        model_name: str = "htdemucs_6s",
+        device: str = "cuda",
+        num_workers: int = 1,
+        shifts: int = 1,
+        overlap: float = 0.25,
+    ):
+        from demucs.pretrained import get_model
+
+        # MPS does not support the demucs ops
+        self.device = device if device != "mps" else "cpu"
+        self.shifts = shifts
+        self.overlap = overlap
+
+        self._models: "queue.Queue[torch.nn.Module]" = queue.Queue()
+        for _ in range(num_workers):
+            model = get_model(model_name)
+            model.to(self.device)
+            model.eval()
+            self._models.put(model)
+
+        self.sources: T.List[str] = list(model.sources)
+        self.sample_rate: int = model.samplerate
+        self.channels: int = model.audio_channels
+
+    def separate(
+        self,
+        waveform: audio_util.Waveform,
+        jobs: int = 0,
+    ) -> T.Dict[str, audio_util.Waveform]:
+        """
+        Split a waveform into stems, returned at the sample rate and channels of the input.
+
+        Args:
+            waveform: Audio to split
+            jobs: Number of CPU threads demucs uses to process chunks in parallel
+        """
+        from demucs.apply import apply_model
+        from demucs.audio import convert_audio
+
+        wav = torch.from_numpy(waveform.samples)
+        wav = convert_audio(wav, waveform.sample_rate, self.sample_rate, self.channels)
+
+        # Normalize like the demucs command line
+        ref = wav.mean(0)
+        ref_mean, ref_std = ref.mean(), ref.std()
+        wav = (wav - ref_mean) / ref_std
+
+        model = self._models.get()
+        try:
+            with torch.no_grad():
+                sources = apply_model(
+                    model,
+                    wav[None],
+                    shifts=self.shifts,
+                    split=True,
+                    overlap=self.overlap,
+                    device=self.device,
+                    num_workers=jobs,
+                    progress=False,
+                )[0]
+        finally:
+            self._models.put(model)
+
+        # De-normalize
+        sources = sources.cpu() * ref_std + ref_mean
+
+        stems = {}
+        for name, source in zip(self.sources, sources):
+            source = convert_audio(
+                source, self.sample_rate, waveform.sample_rate, waveform.channels
+            )
+            stems[name] = audio_util.Waveform(
+                samples=source.numpy().astype(np.float32, copy=False),
+                sample_rate=waveform.sample_rate,
+            )
+
+        return stems
+
+
+_SEPARATOR_CACHE_LOCK = threading.Lock()
+
+
+def get_stem_separator(
+    model_name: str = "htdemucs_6s",
+    device: str = "cuda",
+    num_workers: int = 1,
+) -> StemSeparator:
+    """
+    Get a process-wide shared stem separator for the given model and device, loading it on the
+    first call. Thread-safe.
     """
-    tmp_dir = Path(tempfile.mkdtemp(prefix="split_audio_"))
-
-    # Save the audio to a temporary file
-    audio_path = tmp_dir / "audio.mp3"
-    segment.export(audio_path, format="mp3")
-
-    # Assemble command
-    command = [
-        "demucs",
-        str(audio_path),
-        "--name",
-        model_name,
-        "--out",
-        str(tmp_dir),
-        "--jobs",
-        str(jobs),
-        "--device",
-        device if device != "mps" else "cpu",
-    ]
-    print(" ".join(command))
-
-    if extension == "mp3":
-        command.append("--mp3")
-
-    # Run demucs
-    subprocess.run(
-        command,
-        check=True,
-    )
-
-    # Load the stems
-    stems = {}
-    for stem_path in tmp_dir.glob(f"{model_name}/audio/*.{extension}"):
-        stem = pydub.AudioSegment.from_file(stem_path)
-        stems[stem_path.stem] = stem
-
-    # Delete tmp dir
-    shutil.rmtree(tmp_dir)
-
-    return stems
+    with _SEPARATOR_CACHE_LOCK:
+        return _cached_stem_separator(model_name, device, num_workers)
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_stem_separator(model_name: str, device: str, num_workers: int) -> StemSeparator:
+    return StemSeparator(model_name=model_name, device=device, num_workers=num_workers)
 
 
 class AudioSplitter:
@@ -80,10 +158,12 @@ class AudioSplitter:
         self,
         segment_length_s: float = 10.0,
         overlap_s: float = 0.1,
+        batch_size: int = 4,
         device: str = "cuda",
     ):
         self.segment_length_s = segment_length_s
         self.overlap_s = overlap_s
+        self.batch_size = batch_size
         self.device = device
 
         self.model = self.load_model().to(device)
@@ -114,34 +194,32 @@ class AudioSplitter:
         else:
             raise ValueError(f"Audio must be stereo, but got {audio.channels} channels")
 
-        # Get as (samples, channels) float numpy array
-        waveform_np = np.array(audio_stereo.get_array_of_samples())
-        waveform_np = waveform_np.reshape(-1, audio_stereo.channels)
-        waveform_np_float = waveform_np.astype(np.float32)
-
-        # To torch and channels-first
-        waveform = torch.from_numpy(waveform_np_float).to(self.device)
-        waveform = waveform.transpose(1, 0)
+        # To torch as (channels, samples)
+        audio_waveform = audio_util.Waveform.from_segment(audio_stereo)
+        waveform = torch.from_numpy(audio_waveform.samples).to(self.device)
 
         # Normalize
         ref = waveform.mean(0)
-        waveform = (waveform - ref.mean()) / ref.std()
-
-        # Split
-        sources = self.separate_sources(
-            waveform[None],
-            sample_rate=audio.frame_rate,
-        )[0]
-
-        # De-normalize
-        sources = sources * ref.std() + ref.mean()
-
-        # To numpy
-        sources_np = sources.cpu().numpy().astype(waveform_np.dtype)
+        ref_mean, ref_std = ref.mean(), ref.std()
+        waveform = (waveform - ref_mean) / ref_std
+
+        # Split chunk by chunk, so only one mini-batch of sources is on the device at a time
+        sources_np = np.empty(
+            (len(self.model.sources),) + audio_waveform.samples.shape, dtype=np.float32
+        )
+        position = 0
+        for sources in self.iter_separate_sources(waveform[None], sample_rate=audio.frame_rate):
+            # De-normalize
+            sources = sources[0] * ref_std + ref_mean
+
+            num_samples = sources.shape[-1]
+            sources_np[:, :, position : position + num_samples] = sources.cpu().numpy()
+            position += num_samples
 
         # Convert to pydub
         stem_segments = [
-            audio_util.audio_from_waveform(waveform, audio.frame_rate) for waveform in sources_np
+            audio_util.Waveform(samples=samples, sample_rate=audio.frame_rate).to_segment()
+            for samples in sources_np
         ]
 
         # Convert back to mono if necessary
@@ -154,34 +232,79 @@ class AudioSplitter:
         self,
         waveform: torch.Tensor,
         sample_rate: int = 44100,
-    ):
+    ) -> torch.Tensor:
         """
         Apply model to a given waveform in chunks. Use fade and overlap to smooth the edges.
+
+        Args:
+            waveform: (batch, channels, samples)
+            sample_rate: Sample rate of the waveform
+
+        Returns:
+            sources: (batch, sources, channels, samples)
         """
-        batch, channels, length = waveform.shape
+        return torch.cat(list(self.iter_separate_sources(waveform, sample_rate)), dim=-1)
 
-        chunk_len = int(sample_rate * self.segment_length_s * (1 + self.overlap_s))
-        start = 0
-        end = chunk_len
-        overlap_frames = self.overlap_s * sample_rate
-        fade = Fade(fade_in_len=0, fade_out_len=int(overlap_frames), fade_shape="linear")
+    def iter_separate_sources(
+        self,
+        waveform: torch.Tensor,
+        sample_rate: int = 44100,
+    ) -> T.Iterator[torch.Tensor]:
+        """
+        Like `separate_sources`, but yield the separated sources in order as pieces along the
+        time axis as soon as they are final, instead of holding all of them at full length.
 
-        final = torch.zeros(batch, len(self.model.sources), channels, length, device=self.device)
+        The waveform is cut into chunks of equal length at a uniform stride, with the end zero
+        padded, and the chunks run through the model `batch_size` at a time. Consecutive chunks
+        overlap by `overlap_s` and are linearly crossfaded.
 
-        # TODO(hayk): Improve this code, which came from the torchaudio docs
-        while start < length - overlap_frames:
-            chunk = waveform[:, :, start:end]
+        Args:
+            waveform: (batch, channels, samples)
+            sample_rate: Sample rate of the waveform
+
+        Yields:
+            sources: (batch, sources, channels, samples) pieces that concatenate to the full length
+        """
+        batch, channels, length = waveform.shape
+
+        chunk_len = int(sample_rate * self.segment_length_s * (1 + self.overlap_s))
+        overlap_frames = int(self.overlap_s * sample_rate)
+        stride = chunk_len - overlap_frames
+        if not 0 < overlap_frames < stride:
+            raise ValueError(f"Invalid overlap of {overlap_frames} for chunks of {chunk_len}")
+
+        # Pad the end so that every chunk has the same length
+        num_chunks = max(1, -(-(length - overlap_frames) // stride))
+        padded_length = num_chunks * stride + overlap_frames
+        padded = torch.nn.functional.pad(waveform, (0, padded_length - length))
+
+        # (chunk, batch, channels, chunk_len) view into the padded waveform
+        chunks = padded.unfold(-1, chunk_len, stride).permute(2, 0, 1, 3)
+
+        fade_in = torch.arange(overlap_frames, device=waveform.device) / overlap_frames
+        fade_out = 1 - fade_in
+
+        # Faded out end of the previous chunk, to add to the start of the next one
+        tail: T.Optional[torch.Tensor] = None
+        remaining = length
+        for batch_start in range(0, num_chunks, self.batch_size):
+            chunk_batch = chunks[batch_start : batch_start + self.batch_size]
             with torch.no_grad():
-                out = self.model.forward(chunk)
-            out = fade(out)
-            final[:, :, :, start:end] += out
-            if start == 0:
-                fade.fade_in_len = int(overlap_frames)
-                start += int(chunk_len - overlap_frames)
-            else:
-                start += chunk_len
-            end += chunk_len
-            if end >= length:
-                fade.fade_out_len = 0
-
-        return final
+                out = self.model.forward(chunk_batch.reshape(-1, channels, chunk_len))
+            out = out.reshape(chunk_batch.shape[:2] + out.shape[1:])
+
+            for i, chunk_out in enumerate(out, start=batch_start):
+                if tail is not None:
+                    chunk_out[..., :overlap_frames] *= fade_in
+                    chunk_out[..., :overlap_frames] += tail
+
+                # Hold back the overlap with the next chunk, except at the end
+                if i < num_chunks - 1:
+                    chunk_out[..., stride:] *= fade_out
+                    tail = chunk_out[..., stride:]
+                    chunk_out = chunk_out[..., :stride]
+
+                piece = chunk_out[..., :remaining]
+                remaining -= piece.shape[-1]
+                if piece.shape[-1] > 0:
+                    yield piece
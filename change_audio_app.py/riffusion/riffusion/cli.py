@@ -13,7 +13,7 @@ import pydub
 import tqdm
 from PIL import Image
 
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
+from riffusion.spectrogram_image_converter import get_spectrogram_image_converter
 from riffusion.spectrogram_params import SpectrogramParams
 from riffusion.util import image_util
 
@@ -51,7 +51,7 @@ def audio_to_image(
         power_for_image=power_for_image,
     )
 
-    converter = SpectrogramImageConverter(params=params, device=device)
+    converter = get_spectrogram_image_converter(params=params, device=device)
 
     pil_image = converter.spectrogram_image_from_audio(segment)
 
@@ -86,7 +86,7 @@ def image_to_audio(*, image: str, audio: str, device: str = "cuda"):
         print("WARNING: Could not find spectrogram parameters in exif data. Using defaults.")
         params = SpectrogramParams()
 
-    converter = SpectrogramImageConverter(params=params, device=device)
+    converter = get_spectrogram_image_converter(params=params, device=device)
     segment = converter.audio_from_spectrogram_image(pil_image)
 
     extension = Path(audio).suffix[1:]
@@ -169,7 +169,7 @@ def audio_to_images_batch(
         sample_rate=sample_rate,
     )
 
-    converter = SpectrogramImageConverter(params=params, device=device)
+    converter = get_spectrogram_image_converter(params=params, device=device)
 
     def process_one(audio_path: Path) -> None:
         # Load
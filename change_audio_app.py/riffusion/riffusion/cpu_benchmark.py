@@ -0,0 +1,134 @@
+"""
+Benchmark of riffusion inference on the CPU, with and without the CPU optimizations.
+"""
+import dataclasses
+import time
+import typing as T
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+from riffusion.cpu_inference import CpuOptions, cpu_supports_bf16
+from riffusion.datatypes import InferenceInput, PromptInput
+from riffusion.model_registry import DEFAULT_CHECKPOINT, ModelRegistry
+from riffusion.riffusion_pipeline import RiffusionPipeline
+
+SEED_IMAGES_DIR = Path(Path(__file__).resolve().parent.parent, "seed_images")
+
+
+@dataclasses.dataclass(frozen=True)
+class BenchmarkResult:
+    """
+    Timings of one pipeline over several runs of the same input.
+    """
+
+    # Seconds of the first run, including compiling or tracing the unet
+    first_run_s: float
+
+    # Mean seconds per denoising step of the runs after the first
+    step_s: float
+
+    # Denoising steps of one run
+    num_steps: int
+
+
+def benchmark_pipeline(
+    pipeline: RiffusionPipeline,
+    inputs: InferenceInput,
+    init_image: Image.Image,
+    num_runs: int = 3,
+) -> BenchmarkResult:
+    """
+    Run the pipeline `num_runs` times on the same input and time its denoising steps, counted as
+    calls of the unet.
+    """
+    num_calls = 0
+
+    def count_call(module: torch.nn.Module, args: T.Any) -> None:
+        nonlocal num_calls
+        num_calls += 1
+
+    handle = pipeline.unet.register_forward_pre_hook(count_call)
+    try:
+        start_time = time.perf_counter()
+        pipeline.riffuse(inputs, init_image=init_image)
+        first_run_s = time.perf_counter() - start_time
+        num_steps = num_calls
+
+        start_time = time.perf_counter()
+        for _ in range(num_runs - 1):
+            pipeline.riffuse(inputs, init_image=init_image)
+        steady_s = time.perf_counter() - start_time
+    finally:
+        handle.remove()
+
+    steady_steps = num_calls - num_steps
+    step_s = steady_s / steady_steps if steady_steps else first_run_s / max(num_steps, 1)
+
+    return BenchmarkResult(first_run_s=first_run_s, step_s=step_s, num_steps=num_steps)
+
+
+def run_benchmark(
+    *,
+    checkpoint: str = DEFAULT_CHECKPOINT,
+    cache_dir: T.Optional[str] = None,
+    prompt: str = "jazz piano",
+    num_inference_steps: int = 20,
+    num_runs: int = 3,
+    seed_image_id: str = "og_beat",
+    unet_mode: str = "compile",
+    no_bf16_autocast: bool = False,
+    no_channels_last: bool = False,
+    no_quantize_text_encoder: bool = False,
+    num_threads: T.Optional[int] = None,
+):
+    """
+    Report the seconds per denoising step of riffusion inference on the CPU, before and after
+    the CPU optimizations.
+
+    Both pipelines share the weights of one registry. The baseline runs first, since the
+    optimized pipeline switches the shared unet to channels_last.
+    """
+    options = CpuOptions(
+        bf16_autocast=not no_bf16_autocast,
+        channels_last=not no_channels_last,
+        unet_mode=unet_mode,
+        num_threads=num_threads,
+        quantize_text_encoder=not no_quantize_text_encoder,
+    )
+
+    registry = ModelRegistry(cache_dir=cache_dir)
+
+    prompt_input = PromptInput(prompt=prompt, seed=42, denoising=0.75)
+    inputs = InferenceInput(
+        start=prompt_input,
+        end=prompt_input,
+        alpha=0.0,
+        num_inference_steps=num_inference_steps,
+        seed_image_id=seed_image_id,
+    )
+    init_image = Image.open(str(SEED_IMAGES_DIR / f"{seed_image_id}.png")).convert("RGB")
+
+    baseline = registry.riffusion(
+        checkpoint, device="cpu", dtype=torch.float32, use_traced_unet=False
+    )
+    baseline_result = benchmark_pipeline(baseline, inputs, init_image, num_runs=num_runs)
+
+    optimized = registry.riffusion(
+        checkpoint, device="cpu", dtype=torch.float32, cpu_options=options
+    )
+    optimized_result = benchmark_pipeline(optimized, inputs, init_image, num_runs=num_runs)
+
+    print(f"Options: {options}")
+    print(f"Threads: {torch.get_num_threads()}, native bfloat16: {cpu_supports_bf16()}")
+    print(f"Denoising steps per run: {baseline_result.num_steps}")
+    for name, result in (("baseline", baseline_result), ("optimized", optimized_result)):
+        print(f"{name:>10}: {result.step_s:.3f} s/step, first run {result.first_run_s:.2f} s")
+    print(f"   speedup: {baseline_result.step_s / optimized_result.step_s:.2f}x")
+
+
+if __name__ == "__main__":
+    import argh
+
+    argh.dispatch_command(run_benchmark)
@@ -0,0 +1,177 @@
+"""
+Optimizations for running the riffusion model on CPU-only hosts.
+"""
+from __future__ import annotations
+
+import dataclasses
+import functools
+import os
+import typing as T
+
+import torch
+
+from riffusion.weights_cache import ShapeTracedUNet, TracedUNetCache, trace_unet
+
+UNET_MODES = ("compile", "trace", "eager")
+
+
+@dataclasses.dataclass(frozen=True)
+class CpuOptions:
+    """
+    Which CPU optimizations to apply to the modules of a pipeline.
+    """
+
+    # Run the UNet under bfloat16 autocast, if the CPU supports bfloat16 natively
+    bf16_autocast: bool = True
+
+    # Use the channels_last memory format for the UNet, which suits oneDNN convolutions
+    channels_last: bool = True
+
+    # How to run the UNet: "compile" with torch.compile, "trace" with torch.jit once per input
+    # shape, or "eager". Traced UNets run in float32, without autocast.
+    unet_mode: str = "compile"
+
+    # Intra-op threads, defaults to the CPUs available to the process
+    num_threads: T.Optional[int] = None
+
+    # Quantize the linear layers of the text encoder to int8
+    quantize_text_encoder: bool = True
+
+    def __post_init__(self) -> None:
+        if self.unet_mode not in UNET_MODES:
+            raise ValueError(f"unet_mode must be one of {UNET_MODES}, got {self.unet_mode}")
+
+
+def cpu_supports_bf16() -> bool:
+    """
+    Whether the CPU has native bfloat16 instructions, AVX512-BF16 or AMX. Without them bfloat16
+    is emulated and slower than float32.
+    """
+    for name in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        check = getattr(torch.cpu, name, None)
+        if check is not None and check():
+            return True
+    return False
+
+
+def tune_threads(num_threads: T.Optional[int] = None) -> int:
+    """
+    Set the number of intra-op threads of torch, by default to the number of CPUs the process
+    may run on, which respects container CPU sets unlike the count of the host.
+    """
+    if num_threads is None:
+        try:
+            num_threads = len(os.sched_getaffinity(0))
+        except AttributeError:
+            num_threads = os.cpu_count() or 1
+
+    torch.set_num_threads(num_threads)
+
+    # A single step runs one large op after another, so inter-op parallelism only adds
+    # contention. This can only be set before the first parallel work of the process.
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    return num_threads
+
+
+def quantize_text_encoder(text_encoder: torch.nn.Module) -> torch.nn.Module:
+    """
+    Copy of the text encoder with int8 dynamic quantization of its linear layers.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        text_encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=False
+    )
+
+
+class CpuUNet(torch.nn.Module):
+    """
+    UNet wrapper that runs under bfloat16 autocast and returns samples in the input dtype.
+    Has the call signature the pipelines use.
+
+    With `compile_unet`, the UNet goes through torch.compile without dynamic shapes, so each
+    input shape gets its own specialized graph, compiled on first use and cached by torch.
+    """
+
+    @dataclasses.dataclass
+    class UNet2DConditionOutput:
+        sample: torch.Tensor
+
+    def __init__(self, unet: torch.nn.Module, autocast: bool = True, compile_unet: bool = False):
+        super().__init__()
+        self.unet = unet
+        self.autocast = autocast
+        self._run = torch.compile(unet, dynamic=False) if compile_unet else unet
+
+    @property
+    def in_channels(self) -> int:
+        return self.unet.in_channels
+
+    @property
+    def config(self) -> T.Any:
+        return self.unet.config
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.unet.parameters()).device
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return next(self.unet.parameters()).dtype
+
+    def forward(
+        self,
+        sample: torch.Tensor,
+        timestep: T.Union[torch.Tensor, float, int],
+        encoder_hidden_states: torch.Tensor,
+    ) -> T.Any:
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.autocast):
+            output = self._run(sample, timestep, encoder_hidden_states=encoder_hidden_states)
+
+        return self.UNet2DConditionOutput(sample=output.sample.to(sample.dtype))
+
+
+def optimize_for_cpu(
+    unet: torch.nn.Module,
+    text_encoder: torch.nn.Module,
+    options: CpuOptions,
+    traced_unet_cache: T.Optional[TracedUNetCache] = None,
+    checkpoint: str = "",
+) -> T.Tuple[torch.nn.Module, torch.nn.Module]:
+    """
+    Apply the CPU optimizations to a UNet and text encoder in float32.
+
+    The UNet is only changed in place by channels_last, otherwise new modules are returned and
+    the given ones can still be used unoptimized.
+
+    Args:
+        unet: UNet of the pipeline
+        text_encoder: Text encoder of the pipeline
+        options: Which optimizations to apply
+        traced_unet_cache: Where to keep traced UNets in "trace" mode, otherwise they are only
+            kept in memory
+        checkpoint: Checkpoint of the modules, for the traced UNet cache
+
+    Returns:
+        unet: Optimized UNet
+        text_encoder: Optimized text encoder
+    """
+    tune_threads(options.num_threads)
+
+    if options.quantize_text_encoder:
+        text_encoder = quantize_text_encoder(text_encoder)
+
+    if options.channels_last:
+        unet.to(memory_format=torch.channels_last)
+
+    if options.unet_mode == "trace":
+        if traced_unet_cache is not None:
+            trace = functools.partial(traced_unet_cache.get_or_trace, unet, checkpoint)
+        else:
+            trace = functools.partial(trace_unet, unet)
+        return ShapeTracedUNet(unet, trace=trace), text_encoder
+
+    autocast = options.bf16_autocast and cpu_supports_bf16()
+    return CpuUNet(unet, autocast, compile_unet=options.unet_mode == "compile"), text_encoder
@@ -56,6 +56,73 @@ class InferenceInput:
     # ID of mask image to use
     mask_image_id: T.Optional[str] = None
 
+    # Name of the diffusers scheduler to denoise with, None for the scheduler of the checkpoint
+    scheduler: T.Optional[str] = None
+
+
+@dataclass(frozen=True)
+class InterpolationInput:
+    """
+    Parameters for a job that runs the riffusion model at several alphas between a start and
+    end set of PromptInputs and stitches the clips together. This is the API required to start
+    an interpolation job on the model server.
+    """
+
+    # Start point of interpolation
+    start: PromptInput
+
+    # End point of interpolation
+    end: PromptInput
+
+    # Number of clips, at alphas evenly spaced from 0 to 1
+    num_interpolation_steps: int = 5
+
+    # Power applied to the alphas around 0.5, values above 1 spend more clips near the middle
+    alpha_power: float = 1.0
+
+    # Number of inner loops of the diffusion model
+    num_inference_steps: int = 50
+
+    # Which seed image to use
+    seed_image_id: str = "og_beat"
+
+    # ID of mask image to use
+    mask_image_id: T.Optional[str] = None
+
+    # Crossfade between clips in the stitched audio
+    crossfade_s: float = 0.2
+
+    # Name of the diffusers scheduler to denoise with, None for the scheduler of the checkpoint
+    scheduler: T.Optional[str] = None
+
+    def alphas(self) -> T.List[float]:
+        """
+        Interpolation alpha of each clip, in order.
+        """
+        num_steps = self.num_interpolation_steps
+        alphas = [i / (num_steps - 1) if num_steps > 1 else 0.0 for i in range(num_steps)]
+
+        # Power scaling around the middle, the same curve as the interpolation app
+        shifted = [2 * alpha - 1 for alpha in alphas]
+        return [(abs(x) ** self.alpha_power * (1 if x >= 0 else -1) + 1) / 2 for x in shifted]
+
+    def inference_inputs(self) -> T.List[InferenceInput]:
+        """
+        Inputs for a single run of the model at each alpha.
+        """
+        return [
+            InferenceInput(
+                start=self.start,
+                end=self.end,
+                alpha=alpha,
+                num_inference_steps=self.num_inference_steps,
+                seed_image_id=self.seed_image_id,
+                mask_image_id=self.mask_image_id,
+                scheduler=self.scheduler,
+            )
+            for alpha in self.alphas()
+        ]
+
 
 @dataclass(frozen=True)
 class InferenceOutput:
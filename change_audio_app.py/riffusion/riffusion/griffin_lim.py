@@ -0,0 +1,200 @@
+"""
+Griffin-Lim phase reconstruction with warm starts and early stopping.
+"""
+from __future__ import annotations
+
+import typing as T
+from dataclasses import dataclass
+
+import torch
+
+
+@dataclass(frozen=True)
+class GriffinLimResult:
+    """
+    Output of a Griffin-Lim phase reconstruction.
+    """
+
+    # Reconstructed waveform, (..., samples)
+    waveform: torch.Tensor
+
+    # Unit magnitude complex phase estimate, (..., frequency, time)
+    phase: torch.Tensor
+
+    # Number of iterations actually run
+    num_iters: int
+
+    # Spectral convergence of the final estimate, ||S - |STFT(x)||| / ||S||
+    spectral_convergence: float
+
+
+class GriffinLim(torch.nn.Module):
+    """
+    Fast Griffin-Lim phase reconstruction with momentum.
+
+    See https://perraudin.info/publications/perraudin-note-002.pdf
+
+    Computes the same thing as torchaudio.transforms.GriffinLim with power=1, but additionally:
+
+        * Can warm start from a supplied phase estimate instead of a random one, for example the
+          phase of the source audio or of a previous overlapping clip.
+        * Stops early once the relative improvement of the spectral convergence between two
+          iterations falls below `tolerance`.
+        * Reports the number of iterations used and the residual error.
+
+    Args:
+        n_fft: Size of FFT
+        n_iter: Maximum number of iterations
+        win_length: Window size
+        hop_length: Length of hop between STFT windows
+        momentum: The momentum parameter for fast Griffin-Lim
+        tolerance: Relative improvement threshold for early stopping, zero disables it
+        length: Array length of the expected output
+    """
+
+    def __init__(
+        self,
+        n_fft: int,
+        n_iter: int = 32,
+        win_length: T.Optional[int] = None,
+        hop_length: T.Optional[int] = None,
+        momentum: float = 0.99,
+        tolerance: float = 0.0,
+        length: T.Optional[int] = None,
+    ):
+        super().__init__()
+
+        if not 0 <= momentum < 1:
+            raise ValueError(f"momentum must be in the range [0, 1), got {momentum}")
+
+        self.n_fft = n_fft
+        self.n_iter = n_iter
+        self.win_length = win_length if win_length is not None else n_fft
+        self.hop_length = hop_length if hop_length is not None else self.win_length // 2
+        self.momentum = momentum
+        self.tolerance = tolerance
+        self.length = length
+
+        self.register_buffer("window", torch.hann_window(self.win_length))
+
+    def forward(self, specgram: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            specgram: Linear amplitudes, (..., frequency, time)
+
+        Returns:
+            waveform: (..., samples)
+        """
+        return self.reconstruct(specgram).waveform
+
+    def reconstruct(
+        self,
+        specgram: torch.Tensor,
+        init_phase: T.Optional[torch.Tensor] = None,
+        length: T.Optional[int] = None,
+    ) -> GriffinLimResult:
+        """
+        Estimate the phase of the given amplitudes and reconstruct a waveform.
+
+        Args:
+            specgram: Linear amplitudes, (..., frequency, time)
+            init_phase: Optional complex phase to start from, same shape as specgram. Only the
+                        angle is used. If not given, a random phase is used.
+            length: Array length of the expected output, defaults to the module setting
+
+        Returns:
+            result: Waveform, phase and convergence information
+        """
+        length = length if length is not None else self.length
+
+        # Pack batch
+        shape = specgram.size()
+        specgram = specgram.reshape(-1, shape[-2], shape[-1])
+
+        if init_phase is None:
+            angles = torch.rand(
+                specgram.size(), dtype=_complex_dtype(specgram.dtype), device=specgram.device
+            )
+        else:
+            if init_phase.shape != shape:
+                raise ValueError(f"init_phase shape {init_phase.shape} must match {shape}")
+            angles = init_phase.reshape(specgram.size()).to(
+                device=specgram.device, dtype=_complex_dtype(specgram.dtype)
+            )
+            angles = angles / (angles.abs() + 1e-16)
+
+        specgram_norm = torch.linalg.norm(specgram)
+
+        tprev = torch.tensor(0.0, dtype=specgram.dtype, device=specgram.device)
+        rebuilt = angles
+        spectral_convergence = float("inf")
+        num_iters = 0
+        for _ in range(self.n_iter):
+            # Invert with our current estimate of the phases
+            inverse = self._istft(specgram * angles, length=length)
+
+            # Rebuild the spectrogram
+            rebuilt = self._stft(inverse)
+
+            num_iters += 1
+
+            # Check for convergence, which needs a device sync so only do it when asked to
+            if self.tolerance > 0:
+                error = float(torch.linalg.norm(specgram - rebuilt.abs()) / specgram_norm)
+                improvement = (spectral_convergence - error) / max(error, 1e-16)
+                spectral_convergence = error
+                if improvement < self.tolerance:
+                    angles = rebuilt / (rebuilt.abs() + 1e-16)
+                    break
+
+            # Update our phase estimates
+            angles = rebuilt
+            if self.momentum:
+                angles = angles - tprev.mul_(self.momentum / (1 + self.momentum))
+            angles = angles.div(angles.abs().add(1e-16))
+
+            # Store the previous iterate
+            tprev = rebuilt
+
+        if num_iters > 0 and self.tolerance <= 0:
+            spectral_convergence = float(
+                torch.linalg.norm(specgram - rebuilt.abs()) / specgram_norm
+            )
+
+        # Return the final phase estimates
+        waveform = self._istft(specgram * angles, length=length)
+
+        return GriffinLimResult(
+            waveform=waveform.reshape(shape[:-2] + waveform.shape[-1:]),
+            phase=angles.reshape(shape),
+            num_iters=num_iters,
+            spectral_convergence=spectral_convergence,
+        )
+
+    def _stft(self, waveform: torch.Tensor) -> torch.Tensor:
+        return torch.stft(
+            input=waveform,
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            window=self.window,
+            center=True,
+            pad_mode="reflect",
+            normalized=False,
+            onesided=True,
+            return_complex=True,
+        )
+
+    def _istft(self, specgram: torch.Tensor, length: T.Optional[int]) -> torch.Tensor:
+        return torch.istft(
+            specgram,
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            window=self.window,
+            length=length,
+        )
+
+
+def _complex_dtype(dtype: torch.dtype) -> torch.dtype:
+    return torch.complex128 if dtype == torch.float64 else torch.complex64
@@ -0,0 +1,228 @@
+"""
+Scheduling of inference work: batching concurrent requests onto a single pipeline, and bounded
+worker pools for the stages after it.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import queue
+import threading
+import time
+import typing as T
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+from riffusion.datatypes import InferenceInput
+
+V = T.TypeVar("V")
+
+if T.TYPE_CHECKING:
+    from riffusion.riffusion_pipeline import RiffusionPipeline
+
+
+@dataclasses.dataclass
+class _Request:
+    inputs: InferenceInput
+    init_image: Image.Image
+    mask_image: T.Optional[Image.Image]
+    future: "Future[Image.Image]"
+
+    @property
+    def batch_key(self) -> T.Tuple[int, str, T.Optional[str], T.Optional[str]]:
+        """
+        Requests with equal keys can be denoised in one batch.
+        """
+        return (
+            self.inputs.num_inference_steps,
+            self.inputs.seed_image_id,
+            self.inputs.mask_image_id,
+            self.inputs.scheduler,
+        )
+
+
+class InferenceScheduler:
+    """
+    Runs requests from many threads on one pipeline, batching compatible ones together.
+
+    A worker thread takes the oldest waiting request and, for up to `max_wait_s`, gathers more
+    requests with the same number of inference steps, seed image, mask image and scheduler, up
+    to `max_batch_size` in total. The batch runs as one `RiffusionPipeline.riffuse_batch` call and
+    each caller gets its own image back. Requests that do not fit are kept in order for the
+    next batch.
+
+    Since requests are grouped by image id, callers must pass the same init and mask images for
+    the same ids. Only the worker thread touches the pipeline, so it is never used
+    concurrently.
+    """
+
+    def __init__(
+        self,
+        pipeline: RiffusionPipeline,
+        max_batch_size: int = 4,
+        max_wait_s: float = 0.02,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+
+        # Requests taken off the queue that did not fit in the last batch, oldest first
+        self._deferred: T.Deque[_Request] = collections.deque()
+
+        # Held while queueing a request and while stopping, so that no request is queued after
+        # the queue is drained by `stop`
+        self._submit_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        inputs: InferenceInput,
+        init_image: Image.Image,
+        mask_image: T.Optional[Image.Image] = None,
+    ) -> "Future[Image.Image]":
+        """
+        Queue a request and return a future for its spectrogram image.
+        """
+        future: "Future[Image.Image]" = Future()
+        with self._submit_lock:
+            if self._stopped.is_set():
+                raise RuntimeError("InferenceScheduler is stopped")
+            self._queue.put(_Request(inputs, init_image, mask_image, future))
+        return future
+
+    def riffuse(
+        self,
+        inputs: InferenceInput,
+        init_image: Image.Image,
+        mask_image: T.Optional[Image.Image] = None,
+    ) -> Image.Image:
+        """
+        Blocking version of `submit`, a drop-in for `RiffusionPipeline.riffuse`.
+        """
+        return self.submit(inputs, init_image, mask_image).result()
+
+    def stop(self) -> None:
+        """
+        Finish the batch in progress and stop the worker. Requests still waiting are cancelled.
+        """
+        with self._submit_lock:
+            self._stopped.set()
+        self._thread.join()
+
+        while self._deferred:
+            self._deferred.popleft().future.cancel()
+        while not self._queue.empty():
+            self._queue.get_nowait().future.cancel()
+
+    def _next_request(self, timeout: T.Optional[float]) -> T.Optional[_Request]:
+        if self._deferred:
+            return self._deferred.popleft()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect_batch(self) -> T.List[_Request]:
+        """
+        Wait for a request, then gather compatible ones until the batch is full or the wait
+        time is over.
+        """
+        first = self._next_request(timeout=0.1)
+        if first is None:
+            return []
+
+        batch = [first]
+
+        # Deferred requests are already here, take compatible ones without waiting
+        skipped: T.List[_Request] = []
+        while self._deferred and len(batch) < self.max_batch_size:
+            request = self._deferred.popleft()
+            (batch if request.batch_key == first.batch_key else skipped).append(request)
+        self._deferred.extendleft(reversed(skipped))
+
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if request.batch_key == first.batch_key:
+                batch.append(request)
+            else:
+                self._deferred.append(request)
+
+        return batch
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            batch = self._collect_batch()
+
+            # Skip requests whose callers gave up
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                images = self.pipeline.riffuse_batch(
+                    [request.inputs for request in batch],
+                    init_image=batch[0].init_image,
+                    mask_image=batch[0].mask_image,
+                )
+            except Exception as exception:  # pylint: disable=broad-except
+                for request in batch:
+                    request.future.set_exception(exception)
+                continue
+
+            for request, image in zip(batch, images):
+                request.future.set_result(image)
+
+
+class BoundedExecutor:
+    """
+    Thread pool whose `submit` blocks while `max_pending` tasks are queued or running.
+
+    Used for pipeline stages after the model, so that a slow stage applies backpressure to its
+    producers instead of queueing unbounded work.
+    """
+
+    def __init__(self, max_workers: int, max_pending: T.Optional[int] = None):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bounded-executor"
+        )
+        self._semaphore = threading.BoundedSemaphore(max_pending or 2 * max_workers)
+
+    def submit(self, fn: T.Callable[..., V], *args: T.Any, **kwargs: T.Any) -> "Future[V]":
+        self._semaphore.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return future
+
+    def iter_bounded(self, chunks: T.Iterable[V]) -> T.Iterator[V]:
+        """
+        Iterate over chunks that are produced lazily, like a streamed response, while holding
+        one of the `max_pending` slots. The slot is taken when iteration starts and released
+        when the chunks are exhausted or the iterator is closed, so work that runs as a stream
+        is consumed counts against the bound like submitted tasks do.
+        """
+        with self._semaphore:
+            yield from chunks
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,264 @@
+"""
+Background jobs that interpolate between two prompts and deliver each clip as it completes.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import threading
+import typing as T
+import uuid
+from concurrent.futures import Future, as_completed
+
+import pydub
+from PIL import Image
+
+from riffusion.datatypes import InferenceOutput, InterpolationInput
+from riffusion.inference_scheduler import BoundedExecutor, InferenceScheduler
+from riffusion.util import audio_util
+
+# Event names of the job event log
+CLIP_EVENT = "clip"
+RESULT_EVENT = "result"
+ERROR_EVENT = "error"
+
+
+@dataclasses.dataclass(frozen=True)
+class JobEvent:
+    """
+    Entry of the event log of a job. Ids count up from zero within a job.
+    """
+
+    event_id: int
+    name: str
+    data: T.Dict[str, T.Any]
+
+
+class InterpolationJob:
+    """
+    State of one interpolation job, safe to read from any thread.
+
+    Clips are filled in as they complete, in whatever order the model finishes them, and the
+    stitched result is set once all clips are done. Every change is also appended to an event
+    log, which clients can follow with `iter_events`.
+    """
+
+    def __init__(self, job_id: str, inputs: InterpolationInput):
+        self.job_id = job_id
+        self.inputs = inputs
+        self.alphas = inputs.alphas()
+
+        self.clips: T.List[T.Optional[InferenceOutput]] = [None] * len(self.alphas)
+        self.result: T.Optional[InferenceOutput] = None
+        self.error: T.Optional[str] = None
+
+        self._segments: T.List[T.Optional[pydub.AudioSegment]] = [None] * len(self.alphas)
+        self._images: T.List[T.Optional[Image.Image]] = [None] * len(self.alphas)
+        self._events: T.List[JobEvent] = []
+        self._condition = threading.Condition()
+
+    @property
+    def status(self) -> str:
+        if self.error is not None:
+            return "failed"
+        if self.result is not None:
+            return "done"
+        return "running"
+
+    @property
+    def finished(self) -> bool:
+        return self.status != "running"
+
+    def to_dict(self) -> T.Dict[str, T.Any]:
+        """
+        Snapshot of the job for polling clients.
+        """
+        with self._condition:
+            return dict(
+                job_id=self.job_id,
+                status=self.status,
+                alphas=self.alphas,
+                num_clips_done=sum(clip is not None for clip in self.clips),
+                clips=[dataclasses.asdict(clip) if clip else None for clip in self.clips],
+                result=dataclasses.asdict(self.result) if self.result else None,
+                error=self.error,
+            )
+
+    def iter_events(
+        self, start: int = 0, timeout: T.Optional[float] = None
+    ) -> T.Iterator[JobEvent]:
+        """
+        Yield events from the given id on, waiting for new ones until the job is finished.
+
+        Args:
+            start: Id of the first event to yield, to resume after a reconnect
+            timeout: Stop if no event arrives for this many seconds
+        """
+        index = start
+        while True:
+            with self._condition:
+                if index >= len(self._events) and not self.finished:
+                    self._condition.wait(timeout=timeout)
+                if index >= len(self._events):
+                    return
+                events = self._events[index:]
+
+            index += len(events)
+            yield from events
+
+    def _add_event(self, name: str, data: T.Dict[str, T.Any]) -> None:
+        # Called with the condition held
+        self._events.append(JobEvent(event_id=len(self._events), name=name, data=data))
+        self._condition.notify_all()
+
+    def _set_clip(
+        self, index: int, image: Image.Image, segment: pydub.AudioSegment, output: InferenceOutput
+    ) -> None:
+        with self._condition:
+            self._images[index] = image
+            self._segments[index] = segment
+            self.clips[index] = output
+            self._add_event(
+                CLIP_EVENT,
+                dict(index=index, alpha=self.alphas[index], **dataclasses.asdict(output)),
+            )
+
+    def _set_result(self, output: InferenceOutput) -> None:
+        with self._condition:
+            self.result = output
+            self._add_event(RESULT_EVENT, dataclasses.asdict(output))
+
+    def _set_error(self, message: str) -> None:
+        with self._condition:
+            self.error = message
+            self._add_event(ERROR_EVENT, dict(message=message))
+
+
+class InterpolationJobManager:
+    """
+    Runs interpolation jobs in the background and keeps the most recent ones for clients.
+
+    All alphas of a job are submitted to the scheduler at once, so they are denoised in batches
+    that share the prompt embeddings and the encoded seed image, interleaved with other
+    requests to the same pipeline. Each spectrogram is turned into a clip as soon as its batch
+    completes, and the clips are stitched with crossfades at the end.
+
+    Args:
+        scheduler: Scheduler that runs the model
+        reconstruct_audio: Turns a spectrogram image into audio
+        encode_output: Encodes a spectrogram image and its audio into the API output
+        postprocess_pool: Optional worker pool for reconstruction and encoding
+        max_jobs: Number of jobs to keep, the oldest finished ones are dropped first
+        max_interpolation_steps: Largest number of clips a job can ask for
+    """
+
+    def __init__(
+        self,
+        scheduler: InferenceScheduler,
+        reconstruct_audio: T.Callable[[Image.Image], pydub.AudioSegment],
+        encode_output: T.Callable[[Image.Image, pydub.AudioSegment], InferenceOutput],
+        postprocess_pool: T.Optional[BoundedExecutor] = None,
+        max_jobs: int = 64,
+        max_interpolation_steps: int = 64,
+    ):
+        self.scheduler = scheduler
+        self.reconstruct_audio = reconstruct_audio
+        self.encode_output = encode_output
+        self.postprocess_pool = postprocess_pool
+        self.max_jobs = max_jobs
+        self.max_interpolation_steps = max_interpolation_steps
+
+        self._jobs: "collections.OrderedDict[str, InterpolationJob]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        inputs: InterpolationInput,
+        init_image: Image.Image,
+        mask_image: T.Optional[Image.Image] = None,
+    ) -> InterpolationJob:
+        """
+        Start a job and return it right away.
+        """
+        if not 1 <= inputs.num_interpolation_steps <= self.max_interpolation_steps:
+            raise ValueError(
+                f"num_interpolation_steps must be between 1 and {self.max_interpolation_steps}, "
+                f"got {inputs.num_interpolation_steps}"
+            )
+        if inputs.crossfade_s < 0:
+            raise ValueError(f"crossfade_s must not be negative, got {inputs.crossfade_s}")
+
+        job = InterpolationJob(job_id=uuid.uuid4().hex, inputs=inputs)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict()
+
+        thread = threading.Thread(
+            target=self._run,
+            args=(job, init_image, mask_image),
+            name=f"interpolation-job-{job.job_id}",
+            daemon=True,
+        )
+        thread.start()
+
+        return job
+
+    def get(self, job_id: str) -> T.Optional[InterpolationJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _evict(self) -> None:
+        # Called with the lock held. Running jobs are only dropped if all jobs are running.
+        while len(self._jobs) > self.max_jobs:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+            del self._jobs[finished[0] if finished else next(iter(self._jobs))]
+
+    def _run(
+        self,
+        job: InterpolationJob,
+        init_image: Image.Image,
+        mask_image: T.Optional[Image.Image],
+    ) -> None:
+        image_futures: T.Dict["Future[Image.Image]", int] = {}
+        try:
+            for index, inputs in enumerate(job.inputs.inference_inputs()):
+                image_futures[self.scheduler.submit(inputs, init_image, mask_image)] = index
+
+            clip_futures: T.List[Future] = []
+            for image_future in as_completed(image_futures):
+                args = (job, image_futures[image_future], image_future.result())
+                if self.postprocess_pool is None:
+                    self._finish_clip(*args)
+                else:
+                    clip_futures.append(self.postprocess_pool.submit(self._finish_clip, *args))
+
+            for clip_future in clip_futures:
+                clip_future.result()
+
+            job._set_result(self._stitch(job))
+        except Exception as exception:  # pylint: disable=broad-except
+            # Do not spend the model on clips of a failed job
+            for image_future in image_futures:
+                image_future.cancel()
+            job._set_error(f"{type(exception).__name__}: {exception}")
+
+    def _finish_clip(self, job: InterpolationJob, index: int, image: Image.Image) -> None:
+        segment = self.reconstruct_audio(image)
+        job._set_clip(index, image, segment, self.encode_output(image, segment))
+
+    def _stitch(self, job: InterpolationJob) -> InferenceOutput:
+        """
+        Crossfade the clips into one audio segment, and place the spectrograms side by side.
+        """
+        segments = T.cast(T.List[pydub.AudioSegment], job._segments)
+        images = T.cast(T.List[Image.Image], job._images)
+
+        segment = audio_util.stitch_segments(segments, crossfade_s=job.inputs.crossfade_s)
+
+        image = Image.new(images[0].mode, (sum(i.width for i in images), images[0].height))
+        x = 0
+        for clip_image in images:
+            image.paste(clip_image, (x, 0))
+            x += clip_image.width
+
+        return self.encode_output(image, segment)
@@ -0,0 +1,324 @@
+"""
+Registry of loaded model weights, shared by all pipelines built on the same checkpoint.
+"""
+from __future__ import annotations
+
+import functools
+import inspect
+import os
+import threading
+import typing as T
+from pathlib import Path
+
+import torch
+from diffusers import StableDiffusionImg2ImgPipeline, StableDiffusionPipeline
+
+from riffusion.cpu_inference import CpuOptions, optimize_for_cpu
+from riffusion.riffusion_pipeline import RiffusionPipeline
+from riffusion.util import cache_util, scheduler_util, torch_util
+from riffusion.weights_cache import ShapeTracedUNet, TracedUNetCache, UNetShapes, WeightsCache
+
+DEFAULT_CHECKPOINT = "riffusion/riffusion-model-v1"
+
+PipelineT = T.TypeVar("PipelineT")
+
+# (checkpoint, device, dtype)
+ModelKey = T.Tuple[str, str, torch.dtype]
+
+
+class ModelRegistry:
+    """
+    Loads the UNet, VAE, text encoder and tokenizer of a checkpoint once per checkpoint, device
+    and dtype, and hands out text to image, image to image and riffusion pipelines as views over
+    the shared modules.
+
+    Views are cheap to create and each gets its own scheduler, since schedulers keep state while
+    denoising. The scheduler is the one of the checkpoint, or any diffusers scheduler by name
+    configured like it. Anything that changes the modules themselves, like moving them to
+    another device, affects all views of the same key.
+
+    With a `cache_dir`, modules are kept there converted to their dtype as safetensors, and
+    UNets traced on the CPU are kept there as well, so later processes load them from memory
+    mapped files instead of converting or tracing again. See `WeightsCache` and
+    `TracedUNetCache`.
+    """
+
+    def __init__(self, cache_dir: T.Optional[T.Union[str, Path]] = None) -> None:
+        self.weights_cache: T.Optional[WeightsCache] = None
+        self.traced_unet_cache: T.Optional[TracedUNetCache] = None
+        if cache_dir:
+            self.weights_cache = WeightsCache(Path(cache_dir, "weights"))
+            self.traced_unet_cache = TracedUNetCache(Path(cache_dir, "traced_unet"))
+
+        self._components: T.Dict[ModelKey, T.Dict[str, T.Any]] = {}
+        self._traced_unets: T.Dict[ModelKey, T.Optional[torch.nn.Module]] = {}
+        self._cpu_modules: T.Dict[
+            T.Tuple[ModelKey, CpuOptions], T.Tuple[torch.nn.Module, torch.nn.Module]
+        ] = {}
+
+        # Held while loading, so concurrent callers never load the same weights twice
+        self._lock = threading.Lock()
+
+    def components(
+        self,
+        checkpoint: str = DEFAULT_CHECKPOINT,
+        device: str = "cuda",
+        dtype: torch.dtype = torch.float16,
+        local_files_only: bool = False,
+        low_cpu_mem_usage: bool = False,
+        cache_dir: T.Optional[str] = None,
+    ) -> T.Dict[str, T.Any]:
+        """
+        Return the modules of a checkpoint, loading them on first use.
+
+        Args:
+            checkpoint: Model checkpoint on disk in diffusers format
+            device: Device to load the model on
+            dtype: Dtype of the weights, float32 is used on devices without float16 support
+            local_files_only: Don't download, only use local files
+            low_cpu_mem_usage: Attempt to use less memory on CPU
+            cache_dir: Directory to download the checkpoint to
+        """
+        key = self.key(checkpoint, device=device, dtype=dtype)
+
+        with self._lock:
+            if key not in self._components:
+                if key[2] != dtype:
+                    print(f"WARNING: Falling back to {key[2]} on {key[1]}, {dtype} is unsupported")
+                self._components[key] = self._load_components(
+                    key,
+                    local_files_only=local_files_only,
+                    low_cpu_mem_usage=low_cpu_mem_usage,
+                    cache_dir=cache_dir,
+                )
+
+            return dict(self._components[key])
+
+    def _load_components(self, key: ModelKey, **kwargs: T.Any) -> T.Dict[str, T.Any]:
+        checkpoint, device, dtype = key
+
+        components = None
+        if self.weights_cache is not None:
+            components = self.weights_cache.load(checkpoint, dtype=dtype, device=device)
+
+        if components is None:
+            pipeline = StableDiffusionPipeline.from_pretrained(
+                checkpoint, revision="main", torch_dtype=dtype, safety_checker=None, **kwargs
+            ).to(device)
+            components = dict(pipeline.components)
+
+            if self.weights_cache is not None:
+                self.weights_cache.save(checkpoint, dtype=dtype, components=components)
+
+        # Disable the NSFW filter, causes incorrect false positives
+        components["safety_checker"] = lambda images, **kwargs: (images, False)
+
+        return components
+
+    @staticmethod
+    def key(checkpoint: str, device: str, dtype: torch.dtype) -> ModelKey:
+        """
+        Registry key of a checkpoint on a device, with the dtype that will actually be used.
+        """
+        device = torch_util.check_device(device)
+
+        # float16 is unsupported on these devices
+        if dtype == torch.float16 and (device == "cpu" or device.lower().startswith("mps")):
+            dtype = torch.float32
+
+        return (checkpoint, device, dtype)
+
+    def txt2img(
+        self,
+        checkpoint: str = DEFAULT_CHECKPOINT,
+        device: str = "cuda",
+        dtype: torch.dtype = torch.float16,
+        scheduler: T.Optional[str] = None,
+        **kwargs: T.Any,
+    ) -> StableDiffusionPipeline:
+        """
+        Text to image pipeline over the shared modules, with the named scheduler if given.
+        Keyword arguments go to `components`.
+        """
+        components = self.components(checkpoint, device=device, dtype=dtype, **kwargs)
+        return _build_view(StableDiffusionPipeline, components, scheduler=scheduler)
+
+    def img2img(
+        self,
+        checkpoint: str = DEFAULT_CHECKPOINT,
+        device: str = "cuda",
+        dtype: torch.dtype = torch.float16,
+        scheduler: T.Optional[str] = None,
+        **kwargs: T.Any,
+    ) -> StableDiffusionImg2ImgPipeline:
+        """
+        Image to image pipeline over the shared modules, with the named scheduler if given.
+        Keyword arguments go to `components`.
+        """
+        components = self.components(checkpoint, device=device, dtype=dtype, **kwargs)
+        return _build_view(StableDiffusionImg2ImgPipeline, components, scheduler=scheduler)
+
+    def riffusion(
+        self,
+        checkpoint: str = DEFAULT_CHECKPOINT,
+        device: str = "cuda",
+        dtype: torch.dtype = torch.float16,
+        use_traced_unet: bool = True,
+        channels_last: bool = False,
+        embedding_cache_dir: T.Optional[str] = None,
+        local_files_only: bool = False,
+        low_cpu_mem_usage: bool = False,
+        cache_dir: T.Optional[str] = None,
+        cpu_options: T.Optional[CpuOptions] = None,
+        scheduler: T.Optional[str] = None,
+    ) -> RiffusionPipeline:
+        """
+        Riffusion interpolation pipeline over the shared modules.
+
+        Args:
+            use_traced_unet: Whether to use the traced unet for speedups, which is loaded once
+                per key as well
+            channels_last: Whether to use channels_last memory format for the shared unet
+            embedding_cache_dir: Optional directory to persist prompt embeddings across restarts
+            cpu_options: CPU optimizations to apply on the CPU, instead of the traced unet. The
+                optimized modules are created once per key and options.
+            scheduler: Name of the default scheduler of the pipeline, the one of the checkpoint
+                if None. Inputs can still choose their own.
+
+        See `components` for the other arguments.
+        """
+        key = self.key(checkpoint, device=device, dtype=dtype)
+        components = self.components(
+            checkpoint,
+            device=device,
+            dtype=dtype,
+            local_files_only=local_files_only,
+            low_cpu_mem_usage=low_cpu_mem_usage,
+            cache_dir=cache_dir,
+        )
+        pipeline = _build_view(RiffusionPipeline, components, scheduler=scheduler)
+
+        if embedding_cache_dir:
+            pipeline.embedding_cache = cache_util.PromptEmbeddingCache(
+                cache_dir=embedding_cache_dir, namespace=checkpoint
+            )
+
+        if channels_last:
+            pipeline.unet.to(memory_format=torch.channels_last)
+
+        if cpu_options is not None and key[1] == "cpu":
+            with self._lock:
+                if (key, cpu_options) not in self._cpu_modules:
+                    self._cpu_modules[(key, cpu_options)] = optimize_for_cpu(
+                        pipeline.unet,
+                        pipeline.text_encoder,
+                        options=cpu_options,
+                        traced_unet_cache=self.traced_unet_cache,
+                        checkpoint=checkpoint,
+                    )
+                pipeline.unet, pipeline.text_encoder = self._cpu_modules[(key, cpu_options)]
+
+            # Embeddings of the quantized text encoder differ, keep them apart on disk
+            if cpu_options.quantize_text_encoder:
+                pipeline.embedding_cache.namespace += ":int8"
+
+            return pipeline
+
+        # Optionally use a traced unet, the published one on CUDA or one traced here on CPU
+        if use_traced_unet:
+            with self._lock:
+                if key not in self._traced_unets:
+                    self._traced_unets[key] = self._load_traced_unet(
+                        key,
+                        unet=pipeline.unet,
+                        text_encoder=pipeline.text_encoder,
+                        local_files_only=local_files_only,
+                        cache_dir=cache_dir,
+                    )
+                traced_unet = self._traced_unets[key]
+
+            if traced_unet is not None:
+                pipeline.unet = traced_unet
+
+        return pipeline
+
+    def _load_traced_unet(
+        self,
+        key: ModelKey,
+        unet: torch.nn.Module,
+        text_encoder: torch.nn.Module,
+        local_files_only: bool,
+        cache_dir: T.Optional[str],
+    ) -> T.Optional[torch.nn.Module]:
+        checkpoint, device, dtype = key
+
+        if device == "cpu" and self.traced_unet_cache is not None:
+            shapes = default_unet_shapes(unet, text_encoder)
+            traced = self.traced_unet_cache.get_or_trace(unet, checkpoint=checkpoint, shapes=shapes)
+            return ShapeTracedUNet(unet, {shapes: traced})
+
+        if checkpoint != "riffusion/riffusion-model-v1":
+            return None
+
+        return RiffusionPipeline.load_traced_unet(
+            checkpoint=checkpoint,
+            subfolder="unet_traced",
+            filename="unet_traced.pt",
+            in_channels=unet.in_channels,
+            dtype=dtype,
+            device=device,
+            local_files_only=local_files_only,
+            cache_dir=cache_dir,
+        )
+
+    def clear(self) -> None:
+        """
+        Drop the references to all loaded modules. Views handed out keep theirs.
+        """
+        with self._lock:
+            self._components.clear()
+            self._traced_unets.clear()
+            self._cpu_modules.clear()
+
+
+def default_unet_shapes(
+    unet: torch.nn.Module, text_encoder: torch.nn.Module, width: int = 512, height: int = 512
+) -> UNetShapes:
+    """
+    UNet input shapes for one image with classifier free guidance, the most common call.
+    """
+    sample_shape = (2, unet.in_channels, height // 8, width // 8)
+    hidden_shape = (2, text_encoder.config.max_position_embeddings, text_encoder.config.hidden_size)
+    return sample_shape, hidden_shape
+
+
+def _build_view(
+    cls: T.Type[PipelineT], components: T.Dict[str, T.Any], scheduler: T.Optional[str] = None
+) -> PipelineT:
+    """
+    Construct a pipeline from shared modules, with a fresh copy of the scheduler, or a new
+    scheduler of the given name with the same config.
+    """
+    parameters = inspect.signature(cls.__init__).parameters
+
+    kwargs = {name: module for name, module in components.items() if name in parameters}
+
+    config = components["scheduler"].config
+    if scheduler is None:
+        kwargs["scheduler"] = type(components["scheduler"]).from_config(config)
+    else:
+        kwargs["scheduler"] = scheduler_util.get_scheduler(scheduler, config=config)
+
+    if "requires_safety_checker" in parameters:
+        kwargs["requires_safety_checker"] = False
+
+    return cls(**kwargs)
+
+
+@functools.lru_cache(maxsize=1)
+def get_model_registry() -> ModelRegistry:
+    """
+    Registry shared by everything in the process. Its cache directory is taken from the
+    RIFFUSION_MODEL_CACHE_DIR environment variable, if set.
+    """
+    return ModelRegistry(cache_dir=os.environ.get("RIFFUSION_MODEL_CACHE_DIR"))
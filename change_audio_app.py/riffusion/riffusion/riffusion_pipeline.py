@@ -4,7 +4,6 @@ Riffusion inference pipeline.
 from __future__ import annotations
 
 import dataclasses
-import functools
 import inspect
 import typing as T
 
@@ -13,15 +12,16 @@ import torch
 from diffusers.models import AutoencoderKL, UNet2DConditionModel
 from diffusers.pipeline_utils import DiffusionPipeline
 from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
-from diffusers.schedulers import DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler
+from diffusers.schedulers.scheduling_utils import SchedulerMixin
 from diffusers.utils import logging
 from huggingface_hub import hf_hub_download
 from PIL import Image
 from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 
+from riffusion.cpu_inference import CpuOptions
 from riffusion.datatypes import InferenceInput
 from riffusion.external.prompt_weighting import get_weighted_text_embeddings
-from riffusion.util import torch_util
+from riffusion.util import cache_util, scheduler_util, torch_util
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -45,7 +45,7 @@ class RiffusionPipeline(DiffusionPipeline):
         text_encoder: CLIPTextModel,
         tokenizer: CLIPTokenizer,
         unet: UNet2DConditionModel,
-        scheduler: T.Union[DDIMScheduler, PNDMScheduler, LMSDiscreteScheduler],
+        scheduler: SchedulerMixin,
         safety_checker: StableDiffusionSafetyChecker,
         feature_extractor: CLIPFeatureExtractor,
     ):
@@ -60,6 +60,14 @@ class RiffusionPipeline(DiffusionPipeline):
             feature_extractor=feature_extractor,
         )
 
+        # Text encoder outputs of recent prompts
+        self.embedding_cache = cache_util.PromptEmbeddingCache()
+
+        # Encoded seed images and masks, which are reused across requests
+        self.latent_cache: cache_util.LRUCache[T.Hashable, T.Any] = cache_util.LRUCache(
+            max_size=32
+        )
+
     @classmethod
     def load_checkpoint(
         cls,
@@ -71,10 +79,16 @@ class RiffusionPipeline(DiffusionPipeline):
         local_files_only: bool = False,
         low_cpu_mem_usage: bool = False,
         cache_dir: T.Optional[str] = None,
+        embedding_cache_dir: T.Optional[str] = None,
+        cpu_options: T.Optional[CpuOptions] = None,
+        scheduler: T.Optional[str] = None,
     ) -> RiffusionPipeline:
         """
         Load the riffusion model pipeline.
 
+        The modules are loaded through the process wide model registry, so they are shared with
+        every other pipeline of the same checkpoint, device and dtype.
+
         Args:
             checkpoint: Model checkpoint on disk in diffusers format
             use_traced_unet: Whether to use the traced unet for speedups
@@ -82,47 +96,26 @@ class RiffusionPipeline(DiffusionPipeline):
             channels_last: Whether to use channels_last memory format
             local_files_only: Don't download, only use local files
             low_cpu_mem_usage: Attempt to use less memory on CPU
+            embedding_cache_dir: Optional directory to persist prompt embeddings across restarts
+            cpu_options: CPU optimizations to apply when the device is the CPU
+            scheduler: Name of the default diffusers scheduler, the one of the checkpoint if None
         """
-        device = torch_util.check_device(device)
-
-        if device == "cpu" or device.lower().startswith("mps"):
-            print(f"WARNING: Falling back to float32 on {device}, float16 is unsupported")
-            dtype = torch.float32
-
-        pipeline = RiffusionPipeline.from_pretrained(
-            checkpoint,
-            revision="main",
-            torch_dtype=dtype,
-            # Disable the NSFW filter, causes incorrect false positives
-            # TODO(hayk): Disable the "you have passed a non-standard module" warning from this.
-            safety_checker=lambda images, **kwargs: (images, False),
-            low_cpu_mem_usage=low_cpu_mem_usage,
+        # Imported here since the registry builds on this module
+        from riffusion.model_registry import get_model_registry
+
+        return get_model_registry().riffusion(
+            checkpoint=checkpoint,
+            device=device,
+            dtype=dtype,
+            use_traced_unet=use_traced_unet,
+            channels_last=channels_last,
+            embedding_cache_dir=embedding_cache_dir,
             local_files_only=local_files_only,
+            low_cpu_mem_usage=low_cpu_mem_usage,
             cache_dir=cache_dir,
-        ).to(device)
-
-        if channels_last:
-            pipeline.unet.to(memory_format=torch.channels_last)
-
-        # Optionally load a traced unet
-        if checkpoint == "riffusion/riffusion-model-v1" and use_traced_unet:
-            traced_unet = cls.load_traced_unet(
-                checkpoint=checkpoint,
-                subfolder="unet_traced",
-                filename="unet_traced.pt",
-                in_channels=pipeline.unet.in_channels,
-                dtype=dtype,
-                device=device,
-                local_files_only=local_files_only,
-                cache_dir=cache_dir,
-            )
-
-            if traced_unet is not None:
-                pipeline.unet = traced_unet
-
-        model = pipeline.to(device)
-
-        return model
+            cpu_options=cpu_options,
+            scheduler=scheduler,
+        )
 
     @staticmethod
     def load_traced_unet(
@@ -174,36 +167,46 @@ class RiffusionPipeline(DiffusionPipeline):
     def device(self) -> str:
         return str(self.vae.device)
 
-    @functools.lru_cache()
-    def embed_text(self, text) -> torch.FloatTensor:
+    def embed_text(self, text: str) -> torch.FloatTensor:
         """
-        Takes in text and turns it into text embeddings.
+        Takes in text and turns it into text embeddings. Cached, see `embedding_cache`.
         """
-        text_input = self.tokenizer(
-            text,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
+
+        def embed() -> torch.FloatTensor:
+            text_input = self.tokenizer(
+                text,
+                padding="max_length",
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+            with torch.no_grad():
+                return self.text_encoder(text_input.input_ids.to(self.device))[0]
+
+        return self.embedding_cache.get_or_create(
+            "text", text, device=self.device, dtype=self.text_encoder.dtype, create=embed
         )
-        with torch.no_grad():
-            embed = self.text_encoder(text_input.input_ids.to(self.device))[0]
-        return embed
 
-    @functools.lru_cache()
-    def embed_text_weighted(self, text) -> torch.FloatTensor:
+    def embed_text_weighted(self, text: str) -> torch.FloatTensor:
         """
-        Get text embedding with weights.
+        Get text embedding with weights. Cached, see `embedding_cache`.
         """
-        return get_weighted_text_embeddings(
-            pipe=self,
-            prompt=text,
-            uncond_prompt=None,
-            max_embeddings_multiples=3,
-            no_boseos_middle=False,
-            skip_parsing=False,
-            skip_weighting=False,
-        )[0]
+
+        def embed() -> torch.FloatTensor:
+            with torch.no_grad():
+                return get_weighted_text_embeddings(
+                    pipe=self,
+                    prompt=text,
+                    uncond_prompt=None,
+                    max_embeddings_multiples=3,
+                    no_boseos_middle=False,
+                    skip_parsing=False,
+                    skip_weighting=False,
+                )[0]
+
+        return self.embedding_cache.get_or_create(
+            "weighted", text, device=self.device, dtype=self.text_encoder.dtype, create=embed
+        )
 
     @torch.no_grad()
     def riffuse(
@@ -231,48 +234,33 @@ class RiffusionPipeline(DiffusionPipeline):
         guidance_scale = start.guidance * (1.0 - alpha) + end.guidance * alpha
 
         # TODO(hayk): Always generate the seed on CPU?
-        if self.device.lower().startswith("mps"):
-            generator_start = torch.Generator(device="cpu").manual_seed(start.seed)
-            generator_end = torch.Generator(device="cpu").manual_seed(end.seed)
-        else:
-            generator_start = torch.Generator(device=self.device).manual_seed(start.seed)
-            generator_end = torch.Generator(device=self.device).manual_seed(end.seed)
+        generator_start = self._generator(start.seed)
+        generator_end = self._generator(end.seed)
 
         # Text encodings
-        if use_reweighting:
-            embed_start = self.embed_text_weighted(start.prompt)
-            embed_end = self.embed_text_weighted(end.prompt)
-        else:
-            embed_start = self.embed_text(start.prompt)
-            embed_end = self.embed_text(end.prompt)
-
-        text_embedding = embed_start + alpha * (embed_end - embed_start)
+        text_embedding = self._interpolated_text_embedding(inputs, use_reweighting)
 
         # Image latents
-        init_image_torch = preprocess_image(init_image).to(
-            device=self.device, dtype=embed_start.dtype
+        init_latent_dist = self.encode_init_image(
+            init_image, image_id=inputs.seed_image_id, dtype=text_embedding.dtype
         )
-        init_latent_dist = self.vae.encode(init_image_torch).latent_dist
         # TODO(hayk): Probably this seed should just be 0 always? Make it 100% symmetric. The
         # result is so close no matter the seed that it doesn't really add variety.
-        if self.device.lower().startswith("mps"):
-            generator = torch.Generator(device="cpu").manual_seed(start.seed)
-        else:
-            generator = torch.Generator(device=self.device).manual_seed(start.seed)
-
-        init_latents = init_latent_dist.sample(generator=generator)
-        init_latents = 0.18215 * init_latents
+        init_latents = 0.18215 * init_latent_dist.sample(generator=self._generator(start.seed))
 
         # Prepare mask latent
-        mask: T.Optional[torch.Tensor] = None
-        if mask_image:
-            vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
-            mask = preprocess_mask(mask_image, scale_factor=vae_scale_factor).to(
-                device=self.device, dtype=embed_start.dtype
-            )
+        mask = self.prepare_mask(
+            mask_image, image_id=inputs.mask_image_id, dtype=text_embedding.dtype
+        )
+
+        # Negative prompt encodings, only needed for classifier free guidance
+        negative_text_embedding: T.Optional[torch.Tensor] = None
+        if guidance_scale > 1.0:
+            negative_text_embedding = self._interpolated_negative_embedding(inputs)
 
         outputs = self.interpolate_img2img(
             text_embeddings=text_embedding,
+            negative_text_embeddings=negative_text_embedding,
             init_latents=init_latents,
             mask=mask,
             generator_a=generator_start,
@@ -282,10 +270,228 @@ class RiffusionPipeline(DiffusionPipeline):
             strength_b=end.denoising,
             num_inference_steps=inputs.num_inference_steps,
             guidance_scale=guidance_scale,
+            scheduler=inputs.scheduler,
         )
 
         return outputs["images"][0]
 
+    @torch.no_grad()
+    def riffuse_batch(
+        self,
+        inputs_list: T.Sequence[InferenceInput],
+        init_image: Image.Image,
+        mask_image: T.Optional[Image.Image] = None,
+        use_reweighting: bool = True,
+    ) -> T.List[Image.Image]:
+        """
+        Like `riffuse`, but for several inputs that share the init image and the number of
+        inference steps, for example all alphas of an interpolation.
+
+        The init image is encoded once and the inputs are denoised together, with per-sample
+        text embeddings, noise and guidance scales. Samples can only share a denoising loop if
+        they start at the same timestep, so inputs are grouped by their interpolated strength
+        and each group runs one batched loop. Gives the same images as calling `riffuse` on each
+        input.
+
+        Args:
+            inputs_list: Parameter dataclasses, all with the same num_inference_steps and
+                scheduler
+            init_image: Image used for conditioning
+            mask_image: Mask applied to all inputs, see `riffuse`
+            use_reweighting: Use prompt reweighting
+
+        Returns:
+            images: One image per input, in order
+        """
+        if not inputs_list:
+            return []
+
+        num_inference_steps = inputs_list[0].num_inference_steps
+        if any(inputs.num_inference_steps != num_inference_steps for inputs in inputs_list):
+            raise ValueError("All inputs of a batch must have the same num_inference_steps")
+        if any(inputs.scheduler != inputs_list[0].scheduler for inputs in inputs_list):
+            raise ValueError("All inputs of a batch must have the same scheduler")
+        scheduler = self.get_scheduler(inputs_list[0].scheduler)
+
+        text_embeddings = torch.cat(
+            [self._interpolated_text_embedding(inputs, use_reweighting) for inputs in inputs_list]
+        )
+        dtype = text_embeddings.dtype
+
+        # Encode the init image once and sample its latents once per seed
+        init_latent_dist = self.encode_init_image(
+            init_image, image_id=inputs_list[0].seed_image_id, dtype=dtype
+        )
+        latents_by_seed: T.Dict[int, torch.Tensor] = {}
+        for inputs in inputs_list:
+            if inputs.start.seed not in latents_by_seed:
+                latents_by_seed[inputs.start.seed] = 0.18215 * init_latent_dist.sample(
+                    generator=self._generator(inputs.start.seed)
+                )
+        init_latents = torch.cat([latents_by_seed[inputs.start.seed] for inputs in inputs_list])
+
+        # Draw the noise once per seed and slerp all samples at once
+        noise_by_seed: T.Dict[int, torch.Tensor] = {}
+        for inputs in inputs_list:
+            for seed in (inputs.start.seed, inputs.end.seed):
+                if seed not in noise_by_seed:
+                    noise_by_seed[seed] = torch.randn(
+                        init_latents.shape[1:],
+                        generator=self._generator(seed),
+                        device=self.device,
+                        dtype=dtype,
+                    )[None]
+        noise = torch_util.slerp(
+            torch.tensor([inputs.alpha for inputs in inputs_list]),
+            torch.cat([noise_by_seed[inputs.start.seed] for inputs in inputs_list]),
+            torch.cat([noise_by_seed[inputs.end.seed] for inputs in inputs_list]),
+        )
+
+        guidance_scales = torch.tensor(
+            [
+                inputs.start.guidance * (1.0 - inputs.alpha) + inputs.end.guidance * inputs.alpha
+                for inputs in inputs_list
+            ],
+            device=self.device,
+            dtype=dtype,
+        )
+
+        mask = self.prepare_mask(mask_image, image_id=inputs_list[0].mask_image_id, dtype=dtype)
+
+        # Group samples that start denoising at the same timestep
+        groups: T.Dict[int, T.List[int]] = {}
+        for i, inputs in enumerate(inputs_list):
+            strength = (1 - inputs.alpha) * inputs.start.denoising + inputs.alpha * (
+                inputs.end.denoising
+            )
+            init_timestep = self._init_timestep(num_inference_steps, strength, scheduler)
+            groups.setdefault(init_timestep, []).append(i)
+
+        # Guidance of at most one means no classifier free guidance, which is the same as one
+        uncond_embeddings: T.Optional[torch.Tensor] = None
+        if (guidance_scales > 1.0).any():
+            uncond_embeddings = torch.cat(
+                [self._interpolated_negative_embedding(inputs) for inputs in inputs_list]
+            )
+            guidance_scales = guidance_scales.clamp(min=1.0)
+
+        latents = torch.empty_like(init_latents)
+        for init_timestep, indices in groups.items():
+            index = torch.tensor(indices, device=self.device)
+            latents[index] = self._denoise(
+                text_embeddings=text_embeddings[index],
+                uncond_embeddings=None if uncond_embeddings is None else uncond_embeddings[index],
+                init_latents=init_latents[index],
+                noise=noise[index],
+                init_timestep=init_timestep,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scales[index],
+                mask=mask,
+                scheduler=scheduler,
+            )
+
+        return self._decode_latents(latents, output_type="pil")
+
+    def _generator(self, seed: int) -> torch.Generator:
+        """
+        Seeded random generator on the pipeline device, or on CPU for MPS.
+        """
+        if self.device.lower().startswith("mps"):
+            return torch.Generator(device="cpu").manual_seed(seed)
+        return torch.Generator(device=self.device).manual_seed(seed)
+
+    def _interpolated_text_embedding(
+        self, inputs: InferenceInput, use_reweighting: bool
+    ) -> torch.Tensor:
+        """
+        Text embedding of the start prompt interpolated towards the end prompt by alpha.
+        """
+        if use_reweighting:
+            embed_start = self.embed_text_weighted(inputs.start.prompt)
+            embed_end = self.embed_text_weighted(inputs.end.prompt)
+        else:
+            embed_start = self.embed_text(inputs.start.prompt)
+            embed_end = self.embed_text(inputs.end.prompt)
+
+        return embed_start + inputs.alpha * (embed_end - embed_start)
+
+    def _interpolated_negative_embedding(self, inputs: InferenceInput) -> torch.Tensor:
+        """
+        Embedding of the start negative prompt interpolated towards the end one by alpha, for
+        classifier free guidance. A missing negative prompt is the empty prompt.
+        """
+        embed_start = self.embed_text(inputs.start.negative_prompt or "")
+        embed_end = self.embed_text(inputs.end.negative_prompt or "")
+
+        if inputs.start.negative_prompt == inputs.end.negative_prompt:
+            return embed_start
+
+        return embed_start + inputs.alpha * (embed_end - embed_start)
+
+    @torch.no_grad()
+    def encode_init_image(
+        self,
+        init_image: Image.Image,
+        image_id: T.Optional[str] = None,
+        dtype: T.Optional[torch.dtype] = None,
+    ):
+        """
+        Encode the init image into the VAE latent distribution.
+
+        Results are cached by image id, content, dtype and device, so repeated requests with the
+        same seed image skip the resize and the VAE encoder.
+
+        Args:
+            init_image: Image used for conditioning
+            image_id: Optional name of the image, such as the seed image id
+            dtype: Dtype of the latents, defaults to that of the VAE
+        """
+        dtype = dtype or self.vae.dtype
+        key = (
+            "init_latents",
+            image_id,
+            cache_util.image_hash(init_image),
+            init_image.size,
+            dtype,
+            self.device,
+        )
+
+        def encode():
+            init_image_torch = preprocess_image(init_image).to(device=self.device, dtype=dtype)
+            return self.vae.encode(init_image_torch).latent_dist
+
+        return self.latent_cache.get_or_create(key, encode)
+
+    def prepare_mask(
+        self,
+        mask_image: T.Optional[Image.Image],
+        image_id: T.Optional[str] = None,
+        dtype: T.Optional[torch.dtype] = None,
+    ) -> T.Optional[torch.Tensor]:
+        """
+        Mask in latent space, or None if there is no mask image. Cached like the init latents.
+        """
+        if not mask_image:
+            return None
+
+        dtype = dtype or self.vae.dtype
+        key = (
+            "mask",
+            image_id,
+            cache_util.image_hash(mask_image),
+            mask_image.size,
+            dtype,
+            self.device,
+        )
+
+        def prepare():
+            vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+            return preprocess_mask(mask_image, scale_factor=vae_scale_factor).to(
+                device=self.device, dtype=dtype
+            )
+
+        return self.latent_cache.get_or_create(key, prepare)
+
     @torch.no_grad()
     def interpolate_img2img(
         self,
@@ -300,19 +506,23 @@ class RiffusionPipeline(DiffusionPipeline):
         num_inference_steps: int = 50,
         guidance_scale: float = 7.5,
         negative_prompt: T.Optional[T.Union[str, T.List[str]]] = None,
+        negative_text_embeddings: T.Optional[torch.Tensor] = None,
         num_images_per_prompt: int = 1,
         eta: T.Optional[float] = 0.0,
         output_type: T.Optional[str] = "pil",
+        scheduler: T.Optional[str] = None,
         **kwargs,
     ):
         """
         TODO
+
+        The unconditional embeddings for classifier free guidance are those of
+        `negative_text_embeddings` if given, else of `negative_prompt`, else of the empty prompt.
+
+        Denoises with the diffusers scheduler named `scheduler` if given, see `get_scheduler`.
         """
         batch_size = text_embeddings.shape[0]
 
-        # set timesteps
-        self.scheduler.set_timesteps(num_inference_steps)
-
         # duplicate text embeddings for each generation per prompt, using mps friendly method
         bs_embed, seq_len, _ = text_embeddings.shape
         text_embeddings = text_embeddings.repeat(1, num_images_per_prompt, 1)
@@ -321,51 +531,23 @@ class RiffusionPipeline(DiffusionPipeline):
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
-        # get unconditional embeddings for classifier free guidance
-        if do_classifier_free_guidance:
-            if negative_prompt is None:
-                uncond_tokens = [""]
-            elif isinstance(negative_prompt, str):
-                uncond_tokens = [negative_prompt]
-            elif batch_size != len(negative_prompt):
-                raise ValueError("The length of `negative_prompt` should be equal to batch_size.")
+        uncond_embeddings: T.Optional[torch.Tensor] = None
+        if guidance_scale > 1.0:
+            if negative_text_embeddings is not None:
+                uncond_embeddings = negative_text_embeddings
             else:
-                uncond_tokens = negative_prompt
-
-            # max_length = text_input_ids.shape[-1]
-            uncond_input = self.tokenizer(
-                uncond_tokens,
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt",
-            )
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
+                uncond_embeddings = self._uncond_embeddings(negative_prompt, batch_size)
 
             # duplicate unconditional embeddings for each generation per prompt
             uncond_embeddings = uncond_embeddings.repeat_interleave(
                 batch_size * num_images_per_prompt, dim=0
             )
 
-            # For classifier free guidance, we need to do two forward passes.
-            # Here we concatenate the unconditional and text embeddings into a single batch
-            # to avoid doing two forward passes
-            text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
-
         latents_dtype = text_embeddings.dtype
 
         strength = (1 - interpolate_alpha) * strength_a + interpolate_alpha * strength_b
-
-        # get the original timestep using init_timestep
-        offset = self.scheduler.config.get("steps_offset", 0)
-        init_timestep = int(num_inference_steps * strength) + offset
-        init_timestep = min(init_timestep, num_inference_steps)
-
-        timesteps = self.scheduler.timesteps[-init_timestep]
-        timesteps = torch.tensor(
-            [timesteps] * batch_size * num_images_per_prompt, device=self.device
-        )
+        denoising_scheduler = self.get_scheduler(scheduler)
+        init_timestep = self._init_timestep(num_inference_steps, strength, denoising_scheduler)
 
         # add noise to latents using the timesteps
         noise_a = torch.randn(
@@ -375,32 +557,159 @@ class RiffusionPipeline(DiffusionPipeline):
             init_latents.shape, generator=generator_b, device=self.device, dtype=latents_dtype
         )
         noise = torch_util.slerp(interpolate_alpha, noise_a, noise_b)
+
+        latents = self._denoise(
+            text_embeddings=text_embeddings,
+            uncond_embeddings=uncond_embeddings,
+            init_latents=init_latents,
+            noise=noise,
+            init_timestep=init_timestep,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=torch.tensor(guidance_scale, device=self.device, dtype=latents_dtype),
+            mask=mask,
+            eta=eta,
+            scheduler=denoising_scheduler,
+        )
+
+        image = self._decode_latents(latents, output_type=output_type)
+
+        return dict(images=image, latents=latents, nsfw_content_detected=False)
+
+    def _uncond_embeddings(
+        self,
+        negative_prompt: T.Optional[T.Union[str, T.List[str]]],
+        batch_size: int,
+    ) -> torch.Tensor:
+        """
+        Embeddings of the negative prompt, or of the empty prompt, for classifier free guidance.
+        """
+        if negative_prompt is None:
+            uncond_tokens = [""]
+        elif isinstance(negative_prompt, str):
+            uncond_tokens = [negative_prompt]
+        elif batch_size != len(negative_prompt):
+            raise ValueError("The length of `negative_prompt` should be equal to batch_size.")
+        else:
+            uncond_tokens = negative_prompt
+
+        # Constant per negative prompt, so served from the embedding cache
+        return torch.cat([self.embed_text(tokens) for tokens in uncond_tokens])
+
+    def get_scheduler(self, scheduler: T.Optional[str] = None) -> SchedulerMixin:
+        """
+        New diffusers scheduler of the given name, configured like the scheduler of the
+        pipeline, or the scheduler of the pipeline if None. Any scheduler of diffusers works,
+        for example DPMSolverMultistepScheduler for DPM-Solver++ at low step counts.
+
+        Raises:
+            ValueError: If diffusers has no scheduler of that name
+        """
+        if scheduler is None:
+            return self.scheduler
+
+        return scheduler_util.get_scheduler(scheduler, config=self.scheduler.config)
+
+    def _init_timestep(
+        self,
+        num_inference_steps: int,
+        strength: float,
+        scheduler: T.Optional[SchedulerMixin] = None,
+    ) -> int:
+        """
+        Number of denoising steps to run for the given img2img strength.
+        """
+        if scheduler is None:
+            scheduler = self.scheduler
+
+        # get the original timestep using init_timestep
+        offset = scheduler.config.get("steps_offset", 0)
+        init_timestep = int(num_inference_steps * strength) + offset
+        return min(init_timestep, num_inference_steps)
+
+    def _denoise(
+        self,
+        text_embeddings: torch.Tensor,
+        uncond_embeddings: T.Optional[torch.Tensor],
+        init_latents: torch.Tensor,
+        noise: torch.Tensor,
+        init_timestep: int,
+        num_inference_steps: int,
+        guidance_scale: torch.Tensor,
+        mask: T.Optional[torch.Tensor] = None,
+        eta: T.Optional[float] = 0.0,
+        scheduler: T.Optional[SchedulerMixin] = None,
+    ) -> torch.Tensor:
+        """
+        Noise the init latents to the starting timestep and run the img2img denoising loop.
+
+        All samples of the batch start at the same timestep, since the scheduler state is
+        shared. The guidance scale is a scalar or per-sample tensor of shape (batch,).
+
+        Args:
+            text_embeddings: (batch, tokens, dim) conditional embeddings
+            uncond_embeddings: (batch, tokens, dim) embeddings for classifier free guidance, or
+                               None to not use guidance
+            init_latents: (batch, channels, height, width) latents of the init image
+            noise: Noise of the same shape as init_latents
+            init_timestep: Number of steps to denoise for, see `_init_timestep`
+            scheduler: Scheduler to denoise with, the scheduler of the pipeline if None
+
+        Returns:
+            latents: Denoised latents
+        """
+        batch_size = init_latents.shape[0]
+
+        if scheduler is None:
+            scheduler = self.scheduler
+
+        # set timesteps
+        scheduler.set_timesteps(num_inference_steps)
+
+        # For classifier free guidance, we need to do two forward passes.
+        # Here we concatenate the unconditional and text embeddings into a single batch
+        # to avoid doing two forward passes
+        do_classifier_free_guidance = uncond_embeddings is not None
+        if do_classifier_free_guidance:
+            text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+            if guidance_scale.ndim > 0:
+                guidance_scale = guidance_scale.view(-1, 1, 1, 1)
+
+        offset = scheduler.config.get("steps_offset", 0)
+        t_start = max(num_inference_steps - init_timestep + offset, 0)
+
+        # Second order schedulers like Heun have `order` timesteps per inference step, so the
+        # denoising starts at the first timestep of step `t_start`
+        start_index = t_start * scheduler.order
+        if start_index >= len(scheduler.timesteps):
+            return init_latents
+        if hasattr(scheduler, "set_begin_index"):
+            scheduler.set_begin_index(start_index)
+
+        # Some schedulers like PNDM have timesteps as arrays
+        # It's more optimized to move all timesteps to correct device beforehand
+        timesteps = scheduler.timesteps[start_index:].to(self.device)
+
+        # add noise to latents for the first timestep that is denoised
         init_latents_orig = init_latents
-        init_latents = self.scheduler.add_noise(init_latents, noise, timesteps)
+        init_latents = scheduler.add_noise(init_latents, noise, timesteps[:1].repeat(batch_size))
 
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same args
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_eta = "eta" in set(inspect.signature(scheduler.step).parameters.keys())
         extra_step_kwargs = {}
         if accepts_eta:
             extra_step_kwargs["eta"] = eta
 
         latents = init_latents.clone()
 
-        t_start = max(num_inference_steps - init_timestep + offset, 0)
-
-        # Some schedulers like PNDM have timesteps as arrays
-        # It's more optimized to move all timesteps to correct device beforehand
-        timesteps = self.scheduler.timesteps[t_start:].to(self.device)
-
         for i, t in enumerate(self.progress_bar(timesteps)):
             # expand the latents if we are doing classifier free guidance
             latent_model_input = (
                 torch.cat([latents] * 2) if do_classifier_free_guidance else latents
             )
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+            latent_model_input = scheduler.scale_model_input(latent_model_input, t)
 
             # predict the noise residual
             noise_pred = self.unet(
@@ -415,15 +724,20 @@ class RiffusionPipeline(DiffusionPipeline):
                 )
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+            latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
 
             if mask is not None:
-                init_latents_proper = self.scheduler.add_noise(
+                init_latents_proper = scheduler.add_noise(
                     init_latents_orig, noise, torch.tensor([t])
                 )
-                # import ipdb; ipdb.set_trace()
                 latents = (init_latents_proper * mask) + (latents * (1 - mask))
 
+        return latents
+
+    def _decode_latents(self, latents: torch.Tensor, output_type: T.Optional[str] = "pil"):
+        """
+        Decode latents into images, as PIL images or a (batch, height, width, 3) numpy array.
+        """
         latents = 1.0 / 0.18215 * latents
         image = self.vae.decode(latents).sample
 
@@ -433,7 +747,7 @@ class RiffusionPipeline(DiffusionPipeline):
         if output_type == "pil":
             image = self.numpy_to_pil(image)
 
-        return dict(images=image, latents=latents, nsfw_content_detected=False)
+        return image
 
 
 def preprocess_image(image: Image.Image) -> torch.Tensor:
@@ -1,40 +1,68 @@
 """
 Flask server that serves the riffusion model as an API.
 """
+from __future__ import annotations
 
 import dataclasses
+import functools
 import io
 import json
 import logging
 import time
 import typing as T
+import uuid
 from pathlib import Path
 
 import dacite
 import flask
 import PIL
+import pydub
 from flask_cors import CORS
 
-from riffusion.datatypes import InferenceInput, InferenceOutput
-from riffusion.riffusion_pipeline import RiffusionPipeline
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
+from riffusion.datatypes import InferenceInput, InferenceOutput, InterpolationInput
+from riffusion.inference_scheduler import BoundedExecutor, InferenceScheduler
+from riffusion.interpolation_jobs import InterpolationJobManager
+from riffusion.spectrogram_image_converter import get_spectrogram_image_converter
 from riffusion.spectrogram_params import SpectrogramParams
-from riffusion.util import base64_util
+from riffusion.util import audio_util, base64_util, scheduler_util
+from riffusion.util.loading_util import BackgroundLoader
 
-# Flask app with CORS
+if T.TYPE_CHECKING:
+    from riffusion.riffusion_pipeline import RiffusionPipeline
+
+# Flask app with CORS, letting browsers read the duration of streamed audio
 app = flask.Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["X-Duration-Seconds"])
 
 # Log at the INFO level to both stdout and disk
 logging.basicConfig(level=logging.INFO)
 logging.getLogger().addHandler(logging.FileHandler("server.log"))
 
+# Global variable for the background loading of the model and everything that depends on it
+MODEL_LOADER: T.Optional[BackgroundLoader[None]] = None
+
 # Global variable for the model pipeline
 PIPELINE: T.Optional[RiffusionPipeline] = None
 
+# Global variable for the scheduler that batches requests onto the pipeline
+SCHEDULER: T.Optional[InferenceScheduler] = None
+
+# Global variables for the stage that turns model outputs into responses
+POSTPROCESS_POOL: T.Optional[BoundedExecutor] = None
+POSTPROCESS_DEVICE: T.Optional[str] = None
+
+# Global variable for the background interpolation jobs
+JOBS: T.Optional[InterpolationJobManager] = None
+
 # Where built-in seed images are stored
 SEED_IMAGES_DIR = Path(Path(__file__).resolve().parent.parent, "seed_images")
 
+# Response formats of /run_inference/, chosen by the Accept header of the request
+RESPONSE_FORMATS = ("application/json", "multipart/mixed", "audio/mpeg")
+
+# Seconds between keepalive comments on idle server-sent event streams
+SSE_KEEPALIVE_S = 15.0
+
 
 def run_app(
     *,
@@ -46,21 +74,48 @@ def run_app(
     debug: bool = False,
     ssl_certificate: T.Optional[str] = None,
     ssl_key: T.Optional[str] = None,
+    embedding_cache_dir: T.Optional[str] = None,
+    max_batch_size: int = 4,
+    max_wait_ms: float = 20.0,
+    postprocess_workers: int = 2,
+    postprocess_device: T.Optional[str] = None,
+    cpu_optimize: bool = False,
 ):
     """
     Run a flask API that serves the given riffusion model checkpoint.
+
+    Requests are handled concurrently, and up to `max_batch_size` requests with the same
+    number of steps, seed image and mask that arrive within `max_wait_ms` of each other are
+    denoised as one batch. Audio reconstruction and encoding run on a pool of
+    `postprocess_workers` threads, on `postprocess_device` if given, while the model moves on
+    to the next batch.
+
+    The model loads on a background thread while the server already listens. Until it is
+    ready, /health and the model endpoints answer with 503.
+
+    With `cpu_optimize` and the cpu device, the model runs with the default `CpuOptions`
+    instead of the traced unet.
     """
-    # Initialize the model
-    global PIPELINE
-    PIPELINE = RiffusionPipeline.load_checkpoint(
-        checkpoint=checkpoint,
-        use_traced_unet=not no_traced_unet,
-        device=device,
-    )
+    global MODEL_LOADER
+    MODEL_LOADER = BackgroundLoader(
+        functools.partial(
+            load_model,
+            checkpoint=checkpoint,
+            no_traced_unet=no_traced_unet,
+            device=device,
+            embedding_cache_dir=embedding_cache_dir,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            postprocess_workers=postprocess_workers,
+            postprocess_device=postprocess_device,
+            cpu_optimize=cpu_optimize,
+        ),
+        name="model-loader",
+    ).start()
 
     args = dict(
         debug=debug,
-        threaded=False,
+        threaded=True,
         host=host,
         port=port,
     )
@@ -72,16 +127,128 @@ def run_app(
     app.run(**args)  # type: ignore
 
 
+def load_model(
+    *,
+    checkpoint: str,
+    no_traced_unet: bool,
+    device: str,
+    embedding_cache_dir: T.Optional[str],
+    max_batch_size: int,
+    max_wait_ms: float,
+    postprocess_workers: int,
+    postprocess_device: T.Optional[str],
+    cpu_optimize: bool = False,
+) -> None:
+    """
+    Load the model and set up the globals that serve it. See `run_app` for the arguments.
+    """
+    start_time = time.time()
+
+    # Imported here so the server starts without waiting for diffusers
+    from riffusion.cpu_inference import CpuOptions
+    from riffusion.riffusion_pipeline import RiffusionPipeline
+
+    # Initialize the model
+    global PIPELINE
+    PIPELINE = RiffusionPipeline.load_checkpoint(
+        checkpoint=checkpoint,
+        use_traced_unet=not no_traced_unet,
+        device=device,
+        embedding_cache_dir=embedding_cache_dir,
+        cpu_options=CpuOptions() if cpu_optimize else None,
+    )
+
+    # Encode the seed images, masks and the default negative prompt before the first request
+    warm_latent_cache(PIPELINE, SEED_IMAGES_DIR)
+    PIPELINE.embed_text("")
+
+    global SCHEDULER
+    SCHEDULER = InferenceScheduler(
+        PIPELINE, max_batch_size=max_batch_size, max_wait_s=max_wait_ms / 1000
+    )
+
+    global POSTPROCESS_POOL, POSTPROCESS_DEVICE
+    POSTPROCESS_POOL = BoundedExecutor(max_workers=postprocess_workers)
+    POSTPROCESS_DEVICE = postprocess_device
+
+    global JOBS
+    JOBS = InterpolationJobManager(
+        SCHEDULER,
+        reconstruct_audio=functools.partial(reconstruct_audio, device=postprocess_device or device),
+        encode_output=encode_output,
+        postprocess_pool=POSTPROCESS_POOL,
+    )
+
+    logging.info(f"Model ready after {time.time() - start_time:.2f} s")
+
+
+def requires_model(view: T.Callable[..., T.Any]) -> T.Callable[..., T.Any]:
+    """
+    Decorator for endpoints that need the model, answering 503 until it is loaded.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args: T.Any, **kwargs: T.Any) -> T.Any:
+        if MODEL_LOADER is None or not MODEL_LOADER.ready:
+            status = MODEL_LOADER.status if MODEL_LOADER else "not_started"
+            return f"Model is not ready: {status}", 503, {"Retry-After": "5"}
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """
+    Readiness probe.
+
+    Returns:
+        JSON with the status of the model, with status 200 once it is ready and 503 before,
+        or if loading failed
+    """
+    if MODEL_LOADER is None:
+        return json.dumps(dict(status="not_started")), 503
+
+    body: T.Dict[str, T.Any] = dict(status=MODEL_LOADER.status)
+    if MODEL_LOADER.error is not None:
+        body["error"] = repr(MODEL_LOADER.error)
+
+    return json.dumps(body), 200 if MODEL_LOADER.ready else 503
+
+
+def apply_scheduler_preset(json_data: T.Dict[str, T.Any]) -> T.Dict[str, T.Any]:
+    """
+    Fill in the scheduler and number of inference steps of the preset named by the "preset" key
+    of a request payload, if any. Values given in the payload take precedence.
+
+    Raises:
+        ValueError: If there is no preset of that name
+    """
+    json_data = dict(json_data)
+    preset_name = json_data.pop("preset", None)
+    if preset_name is None:
+        return json_data
+
+    preset = scheduler_util.get_preset(preset_name)
+    return {**dataclasses.asdict(preset), **json_data}
+
+
 @app.route("/run_inference/", methods=["POST"])
+@requires_model
 def run_inference():
     """
     Execute the riffusion model as an API.
 
     Inputs:
-        Serialized JSON of the InferenceInput dataclass
+        Serialized JSON of the InferenceInput dataclass, optionally with a "preset" key, see
+        `apply_scheduler_preset`
 
     Returns:
-        Serialized JSON of the InferenceOutput dataclass
+        Depending on the Accept header of the request, one of:
+            application/json: Serialized JSON of the InferenceOutput dataclass (default)
+            multipart/mixed: A JSON part with the duration, the JPEG image and the MP3 audio
+            audio/mpeg: Only the MP3 audio, with the duration in the X-Duration-Seconds header
+        The binary formats avoid base64 and stream the MP3 while it is being encoded.
     """
     start_time = time.time()
 
@@ -93,18 +260,34 @@ def run_inference():
 
     # Parse an InferenceInput dataclass from the payload
     try:
-        inputs = dacite.from_dict(InferenceInput, json_data)
+        inputs = dacite.from_dict(InferenceInput, apply_scheduler_preset(json_data))
     except dacite.exceptions.WrongTypeError as exception:
         logging.info(json_data)
         return str(exception), 400
     except dacite.exceptions.MissingValueError as exception:
         logging.info(json_data)
         return str(exception), 400
+    except ValueError as exception:
+        return str(exception), 400
+
+    if inputs.scheduler is not None:
+        try:
+            scheduler_util.get_scheduler_class(inputs.scheduler)
+        except ValueError as exception:
+            return str(exception), 400
+
+    response_format = flask.request.accept_mimetypes.best_match(
+        RESPONSE_FORMATS, default="application/json"
+    )
 
     response = compute_request(
         inputs=inputs,
         seed_images_dir=SEED_IMAGES_DIR,
         pipeline=PIPELINE,
+        scheduler=SCHEDULER,
+        postprocess_pool=POSTPROCESS_POOL,
+        postprocess_device=POSTPROCESS_DEVICE,
+        response_format=response_format,
     )
 
     # Log the total time
@@ -113,56 +296,280 @@ def run_inference():
     return response
 
 
+@app.route("/interpolation_jobs/", methods=["POST"])
+@requires_model
+def start_interpolation_job():
+    """
+    Start a job that interpolates between two prompts in the background.
+
+    Inputs:
+        Serialized JSON of the InterpolationInput dataclass, optionally with a "preset" key,
+        see `apply_scheduler_preset`
+
+    Returns:
+        JSON with the job_id, with status 202. The job can be polled at
+        /interpolation_jobs/<job_id> or followed as server-sent events at
+        /interpolation_jobs/<job_id>/events.
+    """
+    json_data = json.loads(flask.request.data)
+    logging.info(json_data)
+
+    try:
+        inputs = dacite.from_dict(InterpolationInput, apply_scheduler_preset(json_data))
+        if inputs.scheduler is not None:
+            scheduler_util.get_scheduler_class(inputs.scheduler)
+    except (dacite.exceptions.WrongTypeError, dacite.exceptions.MissingValueError) as exception:
+        return str(exception), 400
+    except ValueError as exception:
+        return str(exception), 400
+
+    assert JOBS is not None
+    try:
+        init_image, mask_image = load_request_images(
+            SEED_IMAGES_DIR, inputs.seed_image_id, inputs.mask_image_id
+        )
+        job = JOBS.submit(inputs, init_image=init_image, mask_image=mask_image)
+    except ValueError as exception:
+        return str(exception), 400
+
+    logging.info(f"Started interpolation job {job.job_id} with {len(job.alphas)} clips")
+
+    return json.dumps(dict(job_id=job.job_id)), 202
+
+
+@app.route("/interpolation_jobs/<job_id>", methods=["GET"])
+@requires_model
+def get_interpolation_job(job_id: str):
+    """
+    Poll an interpolation job.
+
+    Returns:
+        JSON with the status, the clips finished so far as serialized InferenceOutputs, and the
+        stitched result once all clips are done
+    """
+    job = JOBS.get(job_id) if JOBS else None
+    if job is None:
+        return f"Unknown interpolation job: {job_id}", 404
+
+    return json.dumps(job.to_dict())
+
+
+@app.route("/interpolation_jobs/<job_id>/events", methods=["GET"])
+@requires_model
+def interpolation_job_events(job_id: str):
+    """
+    Follow an interpolation job as server-sent events.
+
+    Sends a "clip" event with the index, alpha and serialized InferenceOutput of each clip as
+    it completes, then a "result" event with the stitched InferenceOutput, or an "error" event.
+    Reconnecting clients resume after the Last-Event-ID header.
+    """
+    job = JOBS.get(job_id) if JOBS else None
+    if job is None:
+        return f"Unknown interpolation job: {job_id}", 404
+
+    try:
+        start = int(flask.request.headers.get("Last-Event-ID", -1)) + 1
+    except ValueError:
+        return "Last-Event-ID must be an integer", 400
+
+    def iter_messages() -> T.Iterator[str]:
+        event_id = start
+        while True:
+            finished = job.finished
+            for event in job.iter_events(start=event_id, timeout=SSE_KEEPALIVE_S):
+                event_id = event.event_id + 1
+                data = json.dumps(event.data)
+                yield f"id: {event.event_id}\nevent: {event.name}\ndata: {data}\n\n"
+
+            if finished:
+                return
+
+            # Keep proxies from closing an idle connection
+            yield ": keepalive\n\n"
+
+    return flask.Response(
+        iter_messages(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def warm_latent_cache(pipeline: RiffusionPipeline, seed_images_dir: T.Union[str, Path]) -> None:
+    """
+    Fill the latent cache of the pipeline with all seed images and masks in the directory, so
+    that requests do not need to run the VAE encoder.
+    """
+    for image_path in sorted(Path(seed_images_dir).glob("*.png")):
+        image = load_seed_image(str(image_path))
+        if image_path.stem.startswith("mask_"):
+            pipeline.prepare_mask(image, image_id=image_path.stem)
+        else:
+            pipeline.encode_init_image(image, image_id=image_path.stem)
+
+    logging.info(f"Latent cache warmed: {pipeline.latent_cache.stats()}")
+
+
+@functools.lru_cache(maxsize=64)
+def load_seed_image(path: str) -> PIL.Image.Image:
+    """
+    Load a seed or mask image as RGB. Cached, so callers must not modify the image.
+    """
+    return PIL.Image.open(path).convert("RGB")
+
+
+def load_request_images(
+    seed_images_dir: T.Union[str, Path],
+    seed_image_id: str,
+    mask_image_id: T.Optional[str] = None,
+) -> T.Tuple[PIL.Image.Image, T.Optional[PIL.Image.Image]]:
+    """
+    Load the seed image and optional mask image of a request by ID.
+
+    Raises:
+        ValueError: If an image does not exist
+    """
+    # Load the seed image by ID
+    init_image_path = Path(seed_images_dir, f"{seed_image_id}.png")
+
+    if not init_image_path.is_file():
+        raise ValueError(f"Invalid seed image: {seed_image_id}")
+    init_image = load_seed_image(str(init_image_path))
+
+    # Load the mask image by ID
+    mask_image: T.Optional[PIL.Image.Image] = None
+    if mask_image_id:
+        mask_image_path = Path(seed_images_dir, f"{mask_image_id}.png")
+        if not mask_image_path.is_file():
+            raise ValueError(f"Invalid mask image: {mask_image_id}")
+        mask_image = load_seed_image(str(mask_image_path))
+
+    return init_image, mask_image
+
+
 def compute_request(
     inputs: InferenceInput,
     pipeline: RiffusionPipeline,
     seed_images_dir: str,
-) -> T.Union[str, T.Tuple[str, int]]:
+    scheduler: T.Optional[InferenceScheduler] = None,
+    postprocess_pool: T.Optional[BoundedExecutor] = None,
+    postprocess_device: T.Optional[str] = None,
+    response_format: str = "application/json",
+) -> T.Union[str, flask.Response, T.Tuple[str, int]]:
     """
     Does all the heavy lifting of the request.
 
+    Runs in two stages, the model producing the spectrogram image and the postprocessing of the
+    image into the response. With a pool, the postprocessing of one request overlaps with the
+    model running the next.
+
     Args:
         inputs: The input dataclass
         pipeline: The riffusion model pipeline
         seed_images_dir: The directory where seed images are stored
+        scheduler: Optional scheduler to batch the model call with concurrent requests
+        postprocess_pool: Optional worker pool to run the postprocessing on
+        postprocess_device: Device for audio reconstruction, defaults to the pipeline device
+        response_format: One of RESPONSE_FORMATS
     """
-    # Load the seed image by ID
-    init_image_path = Path(seed_images_dir, f"{inputs.seed_image_id}.png")
-
-    if not init_image_path.is_file():
-        return f"Invalid seed image: {inputs.seed_image_id}", 400
-    init_image = PIL.Image.open(str(init_image_path)).convert("RGB")
-
-    # Load the mask image by ID
-    mask_image: T.Optional[PIL.Image.Image] = None
-    if inputs.mask_image_id:
-        mask_image_path = Path(seed_images_dir, f"{inputs.mask_image_id}.png")
-        if not mask_image_path.is_file():
-            return f"Invalid mask image: {inputs.mask_image_id}", 400
-        mask_image = PIL.Image.open(str(mask_image_path)).convert("RGB")
+    try:
+        init_image, mask_image = load_request_images(
+            seed_images_dir, inputs.seed_image_id, inputs.mask_image_id
+        )
+    except ValueError as exception:
+        return str(exception), 400
 
     # Execute the model to get the spectrogram image
-    image = pipeline.riffuse(
+    image = (scheduler or pipeline).riffuse(
         inputs,
         init_image=init_image,
         mask_image=mask_image,
     )
 
+    device = postprocess_device or str(pipeline.device)
+    if postprocess_pool is None:
+        return postprocess_image(image, device=device, response_format=response_format)
+
+    return postprocess_pool.submit(
+        postprocess_image,
+        image,
+        device=device,
+        response_format=response_format,
+        postprocess_pool=postprocess_pool,
+    ).result()
+
+
+def postprocess_image(
+    image: PIL.Image.Image,
+    device: str = "cuda",
+    response_format: str = "application/json",
+    postprocess_pool: T.Optional[BoundedExecutor] = None,
+) -> T.Union[str, flask.Response]:
+    """
+    Reconstruct audio from a spectrogram image and encode both into the response.
+
+    For the binary formats the returned response streams the MP3 as it is encoded, so the
+    encoding happens while the response is sent rather than in this function. With a pool, the
+    stream holds one of its slots while it encodes, so streamed encodes count against the
+    postprocessing bound as well.
+    """
+    segment = reconstruct_audio(image, device=device)
+
+    mp3_chunks: T.Iterable[bytes] = ()
+    if response_format in ("audio/mpeg", "multipart/mixed"):
+        mp3_chunks = audio_util.iter_mp3_chunks(segment)
+        if postprocess_pool is not None:
+            mp3_chunks = postprocess_pool.iter_bounded(mp3_chunks)
+
+    if response_format == "audio/mpeg":
+        return flask.Response(
+            mp3_chunks,
+            mimetype="audio/mpeg",
+            headers={"X-Duration-Seconds": str(segment.duration_seconds)},
+        )
+
+    if response_format == "multipart/mixed":
+        image_bytes = io.BytesIO()
+        image.save(image_bytes, exif=image.getexif(), format="JPEG")
+
+        metadata = json.dumps(dict(duration_s=segment.duration_seconds)).encode()
+
+        boundary = uuid.uuid4().hex
+        parts = [
+            ("metadata", "application/json", metadata),
+            ("image", "image/jpeg", image_bytes.getvalue()),
+            ("audio", "audio/mpeg", mp3_chunks),
+        ]
+        return flask.Response(
+            iter_multipart(boundary, parts),
+            content_type=f"multipart/mixed; boundary={boundary}",
+        )
+
+    return json.dumps(dataclasses.asdict(encode_output(image, segment)))
+
+
+def reconstruct_audio(image: PIL.Image.Image, device: str = "cuda") -> pydub.AudioSegment:
+    """
+    Reconstruct filtered audio from a spectrogram image of the model.
+    """
     # TODO(hayk): Change the frequency range to [20, 20k] once the model is retrained
     params = SpectrogramParams(
         min_frequency=0,
         max_frequency=10000,
     )
 
-    # Reconstruct audio from the image
-    # TODO(hayk): It may help performance a bit to cache this object
-    converter = SpectrogramImageConverter(params=params, device=str(pipeline.device))
+    converter = get_spectrogram_image_converter(params=params, device=device)
 
-    segment = converter.audio_from_spectrogram_image(
+    return converter.audio_from_spectrogram_image(
         image,
         apply_filters=True,
     )
 
+
+def encode_output(image: PIL.Image.Image, segment: pydub.AudioSegment) -> InferenceOutput:
+    """
+    Encode a spectrogram image and its audio as base64 data URIs.
+    """
     # Export audio to MP3 bytes
     mp3_bytes = io.BytesIO()
     segment.export(mp3_bytes, format="mp3")
@@ -180,7 +587,36 @@ def compute_request(
         duration_s=segment.duration_seconds,
     )
 
-    return json.dumps(dataclasses.asdict(output))
+    return output
+
+
+def iter_multipart(
+    boundary: str,
+    parts: T.Sequence[T.Tuple[str, str, T.Union[bytes, T.Iterable[bytes]]]],
+) -> T.Iterator[bytes]:
+    """
+    Yield a multipart body chunk by chunk.
+
+    Args:
+        boundary: Boundary string, which must not occur in any part
+        parts: Name, content type and content of each part, where the content is either bytes
+            or an iterable of chunks that is streamed as it is produced
+    """
+    for name, content_type, content in parts:
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: inline; name="{name}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+
+        if isinstance(content, bytes):
+            yield content
+        else:
+            yield from content
+
+        yield b"\r\n"
+
+    yield f"--{boundary}--\r\n".encode()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+import functools
+import typing as T
 import warnings
 
 import numpy as np
@@ -5,6 +7,7 @@ import pydub
 import torch
 import torchaudio
 
+from riffusion.griffin_lim import GriffinLim, GriffinLimResult
 from riffusion.spectrogram_params import SpectrogramParams
 from riffusion.util import audio_util, torch_util
 
@@ -58,18 +61,15 @@ class SpectrogramConverter:
             onesided=True,
         ).to(self.device)
 
-        # https://pytorch.org/audio/stable/generated/torchaudio.transforms.GriffinLim.html
-        self.inverse_spectrogram_func = torchaudio.transforms.GriffinLim(
+        # Same as torchaudio.transforms.GriffinLim, with support for warm starts and early stopping
+        self.inverse_spectrogram_func = GriffinLim(
             n_fft=params.n_fft,
             n_iter=params.num_griffin_lim_iters,
             win_length=params.win_length,
             hop_length=params.hop_length,
-            window_fn=torch.hann_window,
-            power=1.0,
-            wkwargs=None,
             momentum=0.99,
+            tolerance=params.griffin_lim_tolerance,
             length=None,
-            rand_init=True,
         ).to(self.device)
 
         # https://pytorch.org/audio/stable/generated/torchaudio.transforms.MelScale.html
@@ -83,47 +83,45 @@ class SpectrogramConverter:
             mel_scale=params.mel_scale_type,
         ).to(self.device)
 
-        # https://pytorch.org/audio/stable/generated/torchaudio.transforms.InverseMelScale.html
-        self.inverse_mel_scaler = torchaudio.transforms.InverseMelScale(
-            n_stft=params.n_fft // 2 + 1,
-            n_mels=params.num_frequencies,
-            sample_rate=params.sample_rate,
-            f_min=params.min_frequency,
-            f_max=params.max_frequency,
-            norm=params.mel_scale_norm,
-            mel_scale=params.mel_scale_type,
-        ).to(self.device)
+        if params.inverse_mel_method == "torchaudio":
+            # https://pytorch.org/audio/stable/generated/torchaudio.transforms.InverseMelScale.html
+            self.inverse_mel_scaler = torchaudio.transforms.InverseMelScale(
+                n_stft=params.n_fft // 2 + 1,
+                n_mels=params.num_frequencies,
+                sample_rate=params.sample_rate,
+                f_min=params.min_frequency,
+                f_max=params.max_frequency,
+                norm=params.mel_scale_norm,
+                mel_scale=params.mel_scale_type,
+            ).to(self.device)
+        elif params.inverse_mel_method == "pinv":
+            self.inverse_mel_scaler = PseudoInverseMelScale(params).to(self.device)
+        else:
+            raise ValueError(f"Unknown inverse mel method: {params.inverse_mel_method}")
 
     def spectrogram_from_audio(
         self,
-        audio: pydub.AudioSegment,
+        audio: T.Union[pydub.AudioSegment, audio_util.Waveform],
     ) -> np.ndarray:
         """
         Compute a spectrogram from an audio segment.
 
         Args:
-            audio: Audio segment which must match the sample rate of the params
+            audio: Audio segment or waveform which must match the sample rate of the params
 
         Returns:
             spectrogram: (channel, frequency, time)
         """
         assert int(audio.frame_rate) == self.p.sample_rate, "Audio sample rate must match params"
 
-        # Get the samples as a numpy array in (batch, samples) shape
-        waveform = np.array([c.get_array_of_samples() for c in audio.split_to_mono()])
-
-        # Convert to floats if necessary
-        if waveform.dtype != np.float32:
-            waveform = waveform.astype(np.float32)
-
-        waveform_tensor = torch.from_numpy(waveform).to(self.device)
-        amplitudes_mel = self.mel_amplitudes_from_waveform(waveform_tensor)
+        amplitudes_mel = self.mel_amplitudes_from_waveform(self._waveform_tensor(audio))
         return amplitudes_mel.cpu().numpy()
 
     def audio_from_spectrogram(
         self,
         spectrogram: np.ndarray,
         apply_filters: bool = True,
+        init_phase: T.Optional[np.ndarray] = None,
     ) -> pydub.AudioSegment:
         """
         Reconstruct an audio segment from a spectrogram.
@@ -131,32 +129,141 @@ class SpectrogramConverter:
         Args:
             spectrogram: (batch, frequency, time)
             apply_filters: Post-process with normalization and compression
+            init_phase: Optional phase to warm start Griffin-Lim from, see `phase_from_audio`
 
         Returns:
             audio: Audio segment with channels equal to the batch dimension
         """
+        return self.waveform_from_spectrogram(
+            spectrogram, apply_filters=apply_filters, init_phase=init_phase
+        ).to_segment()
+
+    def waveform_from_spectrogram(
+        self,
+        spectrogram: np.ndarray,
+        apply_filters: bool = True,
+        init_phase: T.Optional[np.ndarray] = None,
+    ) -> audio_util.Waveform:
+        """
+        Like `audio_from_spectrogram`, but returns a waveform for further processing instead of
+        an audio segment.
+        """
         # Move to device
         amplitudes_mel = torch.from_numpy(spectrogram).to(self.device)
 
         # Reconstruct the waveform
-        waveform = self.waveform_from_mel_amplitudes(amplitudes_mel)
-
-        # Convert to audio segment
-        segment = audio_util.audio_from_waveform(
-            samples=waveform.cpu().numpy(),
-            sample_rate=self.p.sample_rate,
-            # Normalize the waveform to the range [-1, 1]
-            normalize=True,
+        waveform = self.waveform_from_mel_amplitudes(
+            amplitudes_mel,
+            init_phase=None if init_phase is None else torch.from_numpy(init_phase),
         )
 
+        return self._normalized_waveform(waveform.cpu().numpy(), apply_filters=apply_filters)
+
+    def audio_from_spectrograms(
+        self,
+        spectrograms: T.Union[np.ndarray, T.Sequence[np.ndarray]],
+        apply_filters: bool = True,
+    ) -> T.List[pydub.AudioSegment]:
+        """
+        Reconstruct a batch of audio segments from spectrograms of equal shape.
+
+        The spectrograms are stacked along the batch dimension so that the inverse mel scaling
+        and Griffin-Lim run once for the whole stack instead of once per clip.
+
+        Args:
+            spectrograms: Sequence of (batch, frequency, time) arrays, all of the same shape, or
+                          an already stacked array of (clip, batch, frequency, time)
+            apply_filters: Post-process each clip with normalization and compression
+
+        Returns:
+            audio: One audio segment per spectrogram, with channels equal to its batch dimension
+        """
+        if len(spectrograms) == 0:
+            return []
+
+        shape = spectrograms[0].shape
+        for spectrogram in spectrograms:
+            if spectrogram.shape != shape:
+                raise ValueError(
+                    "All spectrograms must have the same shape, "
+                    f"got {spectrogram.shape} and {shape}"
+                )
+
+        # Stack along the batch dimension and move to device
+        num_channels = shape[0]
+        if isinstance(spectrograms, np.ndarray):
+            stacked = spectrograms.reshape((-1,) + shape[1:])
+        else:
+            stacked = np.concatenate(spectrograms, axis=0)
+        amplitudes_mel = torch.from_numpy(stacked).to(self.device)
+
+        # Reconstruct all waveforms at once
+        waveforms = self.waveform_from_mel_amplitudes(amplitudes_mel).cpu().numpy()
+
+        return [
+            self._normalized_waveform(
+                waveforms[i * num_channels : (i + 1) * num_channels],
+                apply_filters=apply_filters,
+            ).to_segment()
+            for i in range(len(spectrograms))
+        ]
+
+    def _normalized_waveform(
+        self,
+        samples: np.ndarray,
+        apply_filters: bool = True,
+    ) -> audio_util.Waveform:
+        """
+        Normalize a reconstructed (channels, samples) array to full scale and wrap it.
+        """
+        # Normalize the waveform to the range [-1, 1]
+        samples /= np.max(np.abs(samples))
+        waveform = audio_util.Waveform(samples=samples, sample_rate=self.p.sample_rate)
+
         # Optionally apply post-processing filters
         if apply_filters:
-            segment = audio_util.apply_filters(
-                segment,
+            waveform = audio_util.apply_filters(
+                waveform,
                 compression=False,
             )
 
-        return segment
+        return waveform
+
+    def _waveform_tensor(
+        self,
+        audio: T.Union[pydub.AudioSegment, audio_util.Waveform],
+    ) -> torch.Tensor:
+        """
+        Move the samples of the audio to the device as a (channel, samples) float tensor in the
+        int16 amplitude range, which is the scale the spectrogram images are calibrated for.
+        """
+        if isinstance(audio, pydub.AudioSegment):
+            audio = audio_util.Waveform.from_segment(audio)
+
+        return torch.from_numpy(audio.samples).to(self.device) * 2**15
+
+    def phase_from_audio(
+        self,
+        audio: T.Union[pydub.AudioSegment, audio_util.Waveform],
+    ) -> np.ndarray:
+        """
+        Compute the STFT phase of an audio segment, for warm starting the phase reconstruction.
+
+        For example in audio to audio, the phase of the source clip is a much better starting
+        point than a random phase.
+
+        Args:
+            audio: Audio segment or waveform which must match the sample rate of the params
+
+        Returns:
+            phase: Unit magnitude complex array of (channel, n_fft // 2 + 1, time)
+        """
+        assert int(audio.frame_rate) == self.p.sample_rate, "Audio sample rate must match params"
+
+        spectrogram_complex = self.spectrogram_func(self._waveform_tensor(audio))
+        phase = spectrogram_complex / (torch.abs(spectrogram_complex) + 1e-16)
+
+        return phase.cpu().numpy()
 
     def mel_amplitudes_from_waveform(
         self,
@@ -183,18 +290,82 @@ class SpectrogramConverter:
     def waveform_from_mel_amplitudes(
         self,
         amplitudes_mel: torch.Tensor,
+        init_phase: T.Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         Torch-only function to approximately reconstruct a waveform from Mel-scale amplitudes.
 
         Args:
             amplitudes_mel: (batch, frequency, time)
+            init_phase: Optional complex phase to warm start from, (batch, n_fft // 2 + 1, time)
 
         Returns:
             waveform: (batch, samples)
         """
+        return self.reconstruct_from_mel_amplitudes(amplitudes_mel, init_phase=init_phase).waveform
+
+    def reconstruct_from_mel_amplitudes(
+        self,
+        amplitudes_mel: torch.Tensor,
+        init_phase: T.Optional[torch.Tensor] = None,
+    ) -> GriffinLimResult:
+        """
+        Like `waveform_from_mel_amplitudes`, but also returns the estimated phase, the number of
+        Griffin-Lim iterations used and the residual spectral convergence error.
+
+        Args:
+            amplitudes_mel: (batch, frequency, time)
+            init_phase: Optional complex phase to warm start from, (batch, n_fft // 2 + 1, time)
+        """
         # Convert from mel scale to linear
         amplitudes_linear = self.inverse_mel_scaler(amplitudes_mel)
 
         # Run the approximate algorithm to compute the phase and recover the waveform
-        return self.inverse_spectrogram_func(amplitudes_linear)
+        return self.inverse_spectrogram_func.reconstruct(amplitudes_linear, init_phase=init_phase)
+
+
+class PseudoInverseMelScale(torch.nn.Module):
+    """
+    Estimate linear frequency amplitudes from mel amplitudes with a single matrix multiply.
+
+    The Moore-Penrose pseudo-inverse of the mel filterbank is computed once per set of params,
+    instead of solving for the amplitudes on every call like torchaudio's InverseMelScale.
+    Negative values are clamped to zero.
+    """
+
+    def __init__(self, params: SpectrogramParams):
+        super().__init__()
+        self.register_buffer("fb_pinv", mel_filterbank_pseudo_inverse(params))
+
+    def forward(self, amplitudes_mel: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            amplitudes_mel: (batch, frequency, time)
+
+        Returns:
+            amplitudes_linear: (batch, n_fft // 2 + 1, time)
+        """
+        return torch.clamp(torch.matmul(self.fb_pinv, amplitudes_mel), min=0.0)
+
+
+@functools.lru_cache(maxsize=8)
+def mel_filterbank_pseudo_inverse(params: SpectrogramParams) -> torch.Tensor:
+    """
+    Compute the pseudo-inverse of the mel filterbank defined by the params, on the CPU.
+
+    Returns:
+        fb_pinv: (n_fft // 2 + 1, num_frequencies)
+    """
+    # (n_fft // 2 + 1, num_frequencies)
+    fb = torchaudio.functional.melscale_fbanks(
+        n_freqs=params.n_fft // 2 + 1,
+        f_min=params.min_frequency,
+        f_max=params.max_frequency,
+        n_mels=params.num_frequencies,
+        sample_rate=params.sample_rate,
+        norm=params.mel_scale_norm,
+        mel_scale=params.mel_scale_type,
+    )
+
+    # Compute in double precision for accuracy, then store as float
+    return torch.linalg.pinv(fb.transpose(0, 1).double()).float()
@@ -1,10 +1,14 @@
+import functools
+import threading
+import typing as T
+
 import numpy as np
 import pydub
 from PIL import Image
 
 from riffusion.spectrogram_converter import SpectrogramConverter
 from riffusion.spectrogram_params import SpectrogramParams
-from riffusion.util import image_util
+from riffusion.util import audio_util, image_util
 
 
 class SpectrogramImageConverter:
@@ -22,30 +26,20 @@ class SpectrogramImageConverter:
 
     def spectrogram_image_from_audio(
         self,
-        segment: pydub.AudioSegment,
+        segment: T.Union[pydub.AudioSegment, audio_util.Waveform],
     ) -> Image.Image:
         """
         Compute a spectrogram image from an audio segment.
 
         Args:
-            segment: Audio segment to convert
+            segment: Audio segment or waveform to convert
 
         Returns:
             Spectrogram image (in pillow format)
         """
         assert int(segment.frame_rate) == self.p.sample_rate, "Sample rate mismatch"
 
-        if self.p.stereo:
-            if segment.channels == 1:
-                print("WARNING: Mono audio but stereo=True, cloning channel")
-                segment = segment.set_channels(2)
-            elif segment.channels > 2:
-                print("WARNING: Multi channel audio, reducing to stereo")
-                segment = segment.set_channels(2)
-        else:
-            if segment.channels > 1:
-                print("WARNING: Stereo audio but stereo=False, setting to mono")
-                segment = segment.set_channels(1)
+        segment = self._match_channels(segment)
 
         spectrogram = self.converter.spectrogram_from_audio(segment)
 
@@ -67,6 +61,7 @@ class SpectrogramImageConverter:
         image: Image.Image,
         apply_filters: bool = True,
         max_value: float = 30e6,
+        init_phase: T.Optional[np.ndarray] = None,
     ) -> pydub.AudioSegment:
         """
         Reconstruct an audio segment from a spectrogram image.
@@ -75,6 +70,7 @@ class SpectrogramImageConverter:
             image: Spectrogram image (in pillow format)
             apply_filters: Apply post-processing to improve the reconstructed audio
             max_value: Scaled max amplitude of the spectrogram. Shouldn't matter.
+            init_phase: Optional phase to warm start the reconstruction, see `phase_from_audio`
         """
         spectrogram = image_util.spectrogram_from_image(
             image,
@@ -86,6 +82,98 @@ class SpectrogramImageConverter:
         segment = self.converter.audio_from_spectrogram(
             spectrogram,
             apply_filters=apply_filters,
+            init_phase=init_phase,
         )
 
         return segment
+
+    def phase_from_audio(
+        self, segment: T.Union[pydub.AudioSegment, audio_util.Waveform]
+    ) -> np.ndarray:
+        """
+        Compute the STFT phase of an audio segment, to warm start reconstructing audio from a
+        spectrogram image of the same duration. Useful for audio to audio.
+
+        Args:
+            segment: Audio segment to analyze
+
+        Returns:
+            phase: Unit magnitude complex array of (channel, n_fft // 2 + 1, time)
+        """
+        assert int(segment.frame_rate) == self.p.sample_rate, "Sample rate mismatch"
+
+        return self.converter.phase_from_audio(self._match_channels(segment))
+
+    def _match_channels(self, segment: audio_util.AudioT) -> audio_util.AudioT:
+        """
+        Convert the segment to mono or stereo according to the params.
+        """
+        if self.p.stereo:
+            if segment.channels == 1:
+                print("WARNING: Mono audio but stereo=True, cloning channel")
+                segment = segment.set_channels(2)
+            elif segment.channels > 2:
+                print("WARNING: Multi channel audio, reducing to stereo")
+                segment = segment.set_channels(2)
+        else:
+            if segment.channels > 1:
+                print("WARNING: Stereo audio but stereo=False, setting to mono")
+                segment = segment.set_channels(1)
+
+        return segment
+
+    def audio_from_spectrogram_images(
+        self,
+        images: T.Sequence[Image.Image],
+        apply_filters: bool = True,
+        max_value: float = 30e6,
+    ) -> T.List[pydub.AudioSegment]:
+        """
+        Reconstruct audio segments from a batch of spectrogram images of the same size.
+
+        This runs the audio reconstruction once for the whole batch, which is much faster than
+        calling `audio_from_spectrogram_image` for each image.
+
+        Args:
+            images: Spectrogram images (in pillow format), all of the same size
+            apply_filters: Apply post-processing to improve the reconstructed audio
+            max_value: Scaled max amplitude of the spectrogram. Shouldn't matter.
+        """
+        spectrograms = image_util.spectrograms_from_images(
+            images,
+            max_value=max_value,
+            power=self.p.power_for_image,
+            stereo=self.p.stereo,
+        )
+
+        return self.converter.audio_from_spectrograms(
+            spectrograms,
+            apply_filters=apply_filters,
+        )
+
+
+# Guards construction of cached converters, so concurrent callers never build duplicates
+_CONVERTER_CACHE_LOCK = threading.Lock()
+
+
+def get_spectrogram_image_converter(
+    params: SpectrogramParams,
+    device: str = "cuda",
+) -> SpectrogramImageConverter:
+    """
+    Get a process-wide shared converter for the given params and device.
+
+    Building a converter creates several torchaudio transforms including mel filterbanks and
+    window tensors, so callers that convert many images should share one instance. The cache
+    is keyed on the frozen params and the device string, is bounded, and is thread-safe.
+    """
+    with _CONVERTER_CACHE_LOCK:
+        return _cached_spectrogram_image_converter(params, device)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_spectrogram_image_converter(
+    params: SpectrogramParams,
+    device: str,
+) -> SpectrogramImageConverter:
+    return SpectrogramImageConverter(params=params, device=device)
@@ -34,9 +34,15 @@ class SpectrogramParams:
     mel_scale_norm: T.Optional[str] = None
     mel_scale_type: str = "htk"
     max_mel_iters: int = 200
+    # How to invert the mel scale: "torchaudio" solves for the linear amplitudes on every call,
+    # "pinv" applies a pseudo-inverse of the mel filterbank that is computed once
+    inverse_mel_method: str = "torchaudio"
 
     # Griffin Lim parameters
     num_griffin_lim_iters: int = 32
+    # Stop Griffin Lim early once the relative improvement in spectral convergence between two
+    # iterations falls below this value. Zero always runs all iterations.
+    griffin_lim_tolerance: float = 0.0
 
     # Image parameterization
     power_for_image: float = 0.25
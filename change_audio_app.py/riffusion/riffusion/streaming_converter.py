@@ -0,0 +1,127 @@
+"""
+Incremental reconstruction of long audio from spectrogram columns.
+"""
+import typing as T
+
+import numpy as np
+import torch
+
+from riffusion.spectrogram_converter import SpectrogramConverter
+
+
+class StreamingSpectrogramConverter:
+    """
+    Reconstruct audio from a spectrogram that arrives in pieces, for example generated tiles of a
+    long output, with bounded memory.
+
+    Mel spectrogram columns are buffered and reconstructed in windows of `window_frames` columns
+    that overlap the previous window by `overlap_frames` columns. Each window warm starts
+    Griffin-Lim from the phase estimated for the overlapping columns of the previous window, and
+    the overlapping audio is crossfaded, so there are no phase discontinuities between windows.
+    A window is only reconstructed once a full window of columns follows it, so the final window
+    is never too short for the STFT.
+
+    Chunks are float32 waveforms of shape (channel, samples) in the arbitrary amplitude scale of
+    the reconstruction. Concatenated, they have the same length as reconstructing the whole
+    spectrogram at once.
+    """
+
+    def __init__(
+        self,
+        converter: SpectrogramConverter,
+        window_frames: int = 512,
+        overlap_frames: int = 32,
+    ):
+        if not 1 < overlap_frames < window_frames:
+            raise ValueError(
+                f"Need 1 < overlap_frames < window_frames, got {overlap_frames}, {window_frames}"
+            )
+
+        self.converter = converter
+        self.window_frames = window_frames
+        self.overlap_frames = overlap_frames
+
+        # Mel columns not yet finalized, including the overlap with the previous window
+        self._frames: T.Optional[np.ndarray] = None
+
+        # Audio and phase of the overlap with the previous window, if any
+        self._tail: T.Optional[np.ndarray] = None
+        self._tail_phase: T.Optional[torch.Tensor] = None
+
+    @property
+    def hop_length(self) -> int:
+        return self.converter.p.hop_length
+
+    def push(self, spectrogram: np.ndarray) -> T.Iterator[np.ndarray]:
+        """
+        Append spectrogram columns and yield any audio chunks that are final.
+
+        Args:
+            spectrogram: (channel, frequency, time) mel amplitudes
+
+        Yields:
+            waveform: (channel, samples) chunks in order
+        """
+        if self._frames is None:
+            self._frames = spectrogram
+        else:
+            self._frames = np.concatenate([self._frames, spectrogram], axis=-1)
+
+        stride = self.window_frames - self.overlap_frames
+        while self._frames.shape[-1] >= self.window_frames + stride:
+            yield self._reconstruct_window(self._frames[:, :, : self.window_frames], last=False)
+            self._frames = self._frames[:, :, stride:]
+
+    def flush(self) -> T.Iterator[np.ndarray]:
+        """
+        Reconstruct the remaining buffered columns and yield the final audio chunks. The
+        converter can be reused for a new stream afterwards.
+        """
+        if self._frames is None:
+            return
+
+        yield self._reconstruct_window(self._frames, last=True)
+
+        self._frames = None
+        self._tail = None
+        self._tail_phase = None
+
+    def _reconstruct_window(self, frames: np.ndarray, last: bool) -> np.ndarray:
+        """
+        Reconstruct one window of columns, crossfade it with the previous window and return the
+        audio that is final. Unless this is the last window, keep the overlap for the next one.
+        """
+        amplitudes_mel = torch.from_numpy(np.ascontiguousarray(frames)).to(self.converter.device)
+
+        # Warm start the overlapping columns from the phase of the previous window
+        init_phase: T.Optional[torch.Tensor] = None
+        if self._tail_phase is not None:
+            num_channels, _, num_frames = frames.shape
+            init_phase = torch.rand(
+                (num_channels, self.converter.p.n_fft // 2 + 1, num_frames),
+                dtype=self._tail_phase.dtype,
+                device=self._tail_phase.device,
+            )
+            init_phase[:, :, : self.overlap_frames] = self._tail_phase
+
+        result = self.converter.reconstruct_from_mel_amplitudes(
+            amplitudes_mel, init_phase=init_phase
+        )
+        waveform = result.waveform.cpu().numpy()
+
+        # Crossfade with the end of the previous window
+        if self._tail is not None:
+            crossfade_len = self._tail.shape[-1]
+            fade_in = np.linspace(0.0, 1.0, crossfade_len, dtype=np.float32)
+            waveform[:, :crossfade_len] *= fade_in
+            waveform[:, :crossfade_len] += self._tail * (1.0 - fade_in)
+
+        if last:
+            return waveform
+
+        # Columns from here on are shared with the next window
+        split = (frames.shape[-1] - self.overlap_frames) * self.hop_length
+        self._tail = waveform[:, split:]
+        self._tail_phase = result.phase[:, :, -self.overlap_frames :]
+
+        return waveform[:, :split]
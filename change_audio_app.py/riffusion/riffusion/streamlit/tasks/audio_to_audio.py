@@ -292,10 +292,12 @@ def render() -> None:
             empty_bin.empty()
             right.image(image, use_column_width=False)
 
+        # Warm start the phase reconstruction from the source clip
         riffed_segment = streamlit_util.audio_segment_from_spectrogram_image(
             image=image,
             params=params,
             device=device,
+            init_phase=streamlit_util.phase_from_audio(clip_segment, params=params, device=device),
         )
         result_segments.append(riffed_segment)
 
@@ -11,6 +11,7 @@ from PIL import Image
 from riffusion.datatypes import InferenceInput, PromptInput
 from riffusion.spectrogram_params import SpectrogramParams
 from riffusion.streamlit import util as streamlit_util
+from riffusion.util import audio_util
 
 
 def render() -> None:
@@ -66,6 +67,14 @@ def render() -> None:
         help="How much the model listens to the text prompt",
     )
 
+    scheduler = st.sidebar.selectbox(
+        "Scheduler",
+        options=streamlit_util.SCHEDULER_OPTIONS,
+        index=0,
+        help="Which diffusion scheduler to use, DPMSolverMultistepScheduler needs fewer steps",
+    )
+    assert scheduler is not None
+
     init_image_name = st.sidebar.selectbox(
         "Seed image",
         # TODO(hayk): Read from directory
@@ -141,44 +150,41 @@ def render() -> None:
         init_image = Image.open(str(init_image_path)).convert("RGB")
 
     # TODO(hayk): Move this code into a shared place and add to riffusion.cli
-    image_list: T.List[Image.Image] = []
-    audio_bytes_list: T.List[io.BytesIO] = []
-    for i, alpha in enumerate(alphas):
-        inputs = InferenceInput(
+    inputs_list = [
+        InferenceInput(
             alpha=float(alpha),
             num_inference_steps=num_inference_steps,
             seed_image_id="og_beat",
             start=prompt_input_a,
             end=prompt_input_b,
+            scheduler=scheduler,
         )
+        for alpha in alphas
+    ]
 
-        if i == 0:
-            with st.expander("Example input JSON", expanded=False):
-                st.json(dataclasses.asdict(inputs))
+    with st.expander("Example input JSON", expanded=False):
+        st.json(dataclasses.asdict(inputs_list[0]))
 
-        image, audio_bytes = run_interpolation(
-            inputs=inputs,
-            init_image=init_image,
-            device=device,
-            extension=extension,
-        )
+    # Denoise all alphas together
+    image_list, audio_bytes_list = run_interpolation_batch(
+        inputs_list=inputs_list,
+        init_image=init_image,
+        device=device,
+        extension=extension,
+    )
 
-        if show_individual_outputs:
+    if show_individual_outputs:
+        for i, (alpha, image, audio_bytes) in enumerate(zip(alphas, image_list, audio_bytes_list)):
             st.write(f"#### ({i + 1} / {len(alphas)}) Alpha={alpha:.2f}")
             if show_images:
                 st.image(image)
             st.audio(audio_bytes)
 
-        image_list.append(image)
-        audio_bytes_list.append(audio_bytes)
-
     st.write("#### Final Output")
 
     # TODO(hayk): Concatenate with overlap and better blending like in audio to audio
     audio_segments = [pydub.AudioSegment.from_file(audio_bytes) for audio_bytes in audio_bytes_list]
-    concat_segment = audio_segments[0]
-    for segment in audio_segments[1:]:
-        concat_segment = concat_segment.append(segment, crossfade=0)
+    concat_segment = audio_util.stitch_segments(audio_segments, crossfade_s=0)
 
     audio_bytes = io.BytesIO()
     concat_segment.export(audio_bytes, format=extension)
@@ -240,15 +246,15 @@ def get_prompt_inputs(
 
 
 @st.cache_data
-def run_interpolation(
-    inputs: InferenceInput,
+def run_interpolation_batch(
+    inputs_list: T.List[InferenceInput],
     init_image: Image.Image,
     checkpoint: str = streamlit_util.DEFAULT_CHECKPOINT,
     device: str = "cuda",
     extension: str = "mp3",
-) -> T.Tuple[Image.Image, io.BytesIO]:
+) -> T.Tuple[T.List[Image.Image], T.List[io.BytesIO]]:
     """
-    Cached function for riffusion interpolation.
+    Cached function for riffusion interpolation of several alphas in one batch.
     """
     pipeline = streamlit_util.load_riffusion_checkpoint(
         device=device,
@@ -257,8 +263,8 @@ def run_interpolation(
         no_traced_unet=True,
     )
 
-    image = pipeline.riffuse(
-        inputs,
+    images = pipeline.riffuse_batch(
+        inputs_list,
         init_image=init_image,
         mask_image=None,
     )
@@ -270,11 +276,35 @@ def run_interpolation(
     )
 
     # Reconstruct from image to audio
-    audio_bytes = streamlit_util.audio_bytes_from_spectrogram_image(
-        image=image,
-        params=params,
+    audio_bytes_list = [
+        streamlit_util.audio_bytes_from_spectrogram_image(
+            image=image,
+            params=params,
+            device=device,
+            output_format=extension,
+        )
+        for image in images
+    ]
+
+    return images, audio_bytes_list
+
+
+def run_interpolation(
+    inputs: InferenceInput,
+    init_image: Image.Image,
+    checkpoint: str = streamlit_util.DEFAULT_CHECKPOINT,
+    device: str = "cuda",
+    extension: str = "mp3",
+) -> T.Tuple[Image.Image, io.BytesIO]:
+    """
+    Cached function for riffusion interpolation of a single alpha.
+    """
+    images, audio_bytes_list = run_interpolation_batch(
+        inputs_list=[inputs],
+        init_image=init_image,
+        checkpoint=checkpoint,
         device=device,
-        output_format=extension,
+        extension=extension,
     )
 
-    return image, audio_bytes
+    return images[0], audio_bytes_list[0]
@@ -5,33 +5,27 @@ import io
 import threading
 import typing as T
 
+import numpy as np
 import pydub
 import streamlit as st
 import torch
 from diffusers import DiffusionPipeline, StableDiffusionImg2ImgPipeline, StableDiffusionPipeline
 from PIL import Image
 
+from riffusion import model_registry
 from riffusion.audio_splitter import AudioSplitter
 from riffusion.riffusion_pipeline import RiffusionPipeline
 from riffusion.spectrogram_image_converter import SpectrogramImageConverter
 from riffusion.spectrogram_params import SpectrogramParams
+from riffusion.util.scheduler_util import SCHEDULER_OPTIONS, get_scheduler
 
 # TODO(hayk): Add URL params
 
-DEFAULT_CHECKPOINT = "riffusion/riffusion-model-v1"
+DEFAULT_CHECKPOINT = model_registry.DEFAULT_CHECKPOINT
 
 AUDIO_EXTENSIONS = ["mp3", "wav", "flac", "webm", "m4a", "ogg"]
 IMAGE_EXTENSIONS = ["png", "jpg", "jpeg"]
 
-SCHEDULER_OPTIONS = [
-    "DPMSolverMultistepScheduler",
-    "PNDMScheduler",
-    "DDIMScheduler",
-    "LMSDiscreteScheduler",
-    "EulerDiscreteScheduler",
-    "EulerAncestralDiscreteScheduler",
-]
-
 
 @st.cache_resource
 def load_riffusion_checkpoint(
@@ -40,9 +34,9 @@ def load_riffusion_checkpoint(
     device: str = "cuda",
 ) -> RiffusionPipeline:
     """
-    Load the riffusion pipeline.
+    Load the riffusion pipeline, sharing weights with the other pipelines.
     """
-    return RiffusionPipeline.load_checkpoint(
+    return model_registry.get_model_registry().riffusion(
         checkpoint=checkpoint,
         use_traced_unet=not no_traced_unet,
         device=device,
@@ -57,56 +51,11 @@ def load_stable_diffusion_pipeline(
     scheduler: str = SCHEDULER_OPTIONS[0],
 ) -> StableDiffusionPipeline:
     """
-    Load the riffusion pipeline.
-
-    TODO(hayk): Merge this into RiffusionPipeline to just load one model.
+    Load the text to image pipeline, sharing weights with the other pipelines.
     """
-    if device == "cpu" or device.lower().startswith("mps"):
-        print(f"WARNING: Falling back to float32 on {device}, float16 is unsupported")
-        dtype = torch.float32
-
-    pipeline = StableDiffusionPipeline.from_pretrained(
-        checkpoint,
-        revision="main",
-        torch_dtype=dtype,
-        safety_checker=lambda images, **kwargs: (images, False),
-    ).to(device)
-
-    pipeline.scheduler = get_scheduler(scheduler, config=pipeline.scheduler.config)
-
-    return pipeline
-
-
-def get_scheduler(scheduler: str, config: T.Any) -> T.Any:
-    """
-    Construct a denoising scheduler from a string.
-    """
-    if scheduler == "PNDMScheduler":
-        from diffusers import PNDMScheduler
-
-        return PNDMScheduler.from_config(config)
-    elif scheduler == "DPMSolverMultistepScheduler":
-        from diffusers import DPMSolverMultistepScheduler
-
-        return DPMSolverMultistepScheduler.from_config(config)
-    elif scheduler == "DDIMScheduler":
-        from diffusers import DDIMScheduler
-
-        return DDIMScheduler.from_config(config)
-    elif scheduler == "LMSDiscreteScheduler":
-        from diffusers import LMSDiscreteScheduler
-
-        return LMSDiscreteScheduler.from_config(config)
-    elif scheduler == "EulerDiscreteScheduler":
-        from diffusers import EulerDiscreteScheduler
-
-        return EulerDiscreteScheduler.from_config(config)
-    elif scheduler == "EulerAncestralDiscreteScheduler":
-        from diffusers import EulerAncestralDiscreteScheduler
-
-        return EulerAncestralDiscreteScheduler.from_config(config)
-    else:
-        raise ValueError(f"Unknown scheduler {scheduler}")
+    return model_registry.get_model_registry().txt2img(
+        checkpoint, device=device, dtype=dtype, scheduler=scheduler
+    )
 
 
 @st.cache_resource
@@ -125,24 +74,11 @@ def load_stable_diffusion_img2img_pipeline(
     scheduler: str = SCHEDULER_OPTIONS[0],
 ) -> StableDiffusionImg2ImgPipeline:
     """
-    Load the image to image pipeline.
-
-    TODO(hayk): Merge this into RiffusionPipeline to just load one model.
+    Load the image to image pipeline, sharing weights with the other pipelines.
     """
-    if device == "cpu" or device.lower().startswith("mps"):
-        print(f"WARNING: Falling back to float32 on {device}, float16 is unsupported")
-        dtype = torch.float32
-
-    pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
-        checkpoint,
-        revision="main",
-        torch_dtype=dtype,
-        safety_checker=lambda images, **kwargs: (images, False),
-    ).to(device)
-
-    pipeline.scheduler = get_scheduler(scheduler, config=pipeline.scheduler.config)
-
-    return pipeline
+    return model_registry.get_model_registry().img2img(
+        checkpoint, device=device, dtype=dtype, scheduler=scheduler
+    )
 
 
 @st.cache_data(persist=True)
@@ -207,9 +143,20 @@ def audio_segment_from_spectrogram_image(
     image: Image.Image,
     params: SpectrogramParams,
     device: str = "cuda",
+    init_phase: T.Optional[np.ndarray] = None,
 ) -> pydub.AudioSegment:
     converter = spectrogram_image_converter(params=params, device=device)
-    return converter.audio_from_spectrogram_image(image)
+    return converter.audio_from_spectrogram_image(image, init_phase=init_phase)
+
+
+@st.cache_data
+def phase_from_audio(
+    segment: pydub.AudioSegment,
+    params: SpectrogramParams,
+    device: str = "cuda",
+) -> np.ndarray:
+    converter = spectrogram_image_converter(params=params, device=device)
+    return converter.phase_from_audio(segment)
 
 
 @st.cache_data
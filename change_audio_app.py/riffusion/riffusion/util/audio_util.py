@@ -2,12 +2,96 @@
 Audio utility functions.
 """
 
-import io
+import subprocess
+import threading
 import typing as T
+from dataclasses import dataclass
 
 import numpy as np
 import pydub
-from scipy.io import wavfile
+import pydub.utils
+
+
+@dataclass(frozen=True, eq=False)
+class Waveform:
+    """
+    Audio samples as a float numpy array, an alternative to pydub segments for processing.
+
+    Converting to and from pydub is a single copy of the raw samples with no encoding, so audio
+    can stay in this form through processing and only become a segment for export.
+    """
+
+    # (channels, samples) float32 array, where 1.0 is full scale
+    samples: np.ndarray
+
+    # Samples per second
+    sample_rate: int
+
+    @property
+    def channels(self) -> int:
+        return self.samples.shape[0]
+
+    @property
+    def frame_rate(self) -> int:
+        """
+        Alias of sample_rate matching pydub.AudioSegment.
+        """
+        return self.sample_rate
+
+    @property
+    def num_samples(self) -> int:
+        return self.samples.shape[1]
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.num_samples / self.sample_rate
+
+    @classmethod
+    def from_segment(cls, segment: pydub.AudioSegment) -> "Waveform":
+        """
+        Convert a pydub audio segment, scaling integer samples to [-1, 1].
+        """
+        if segment.sample_width == 3:
+            segment = segment.set_sample_width(4)
+
+        dtype = {1: np.int8, 2: np.int16, 4: np.int32}[segment.sample_width]
+
+        # View the interleaved raw data as (samples, channels) without copying
+        pcm = np.frombuffer(segment.raw_data, dtype=dtype).reshape(-1, segment.channels)
+
+        samples = np.empty((segment.channels, pcm.shape[0]), dtype=np.float32)
+        np.multiply(pcm.T, 1.0 / -np.iinfo(dtype).min, out=samples, casting="unsafe")
+
+        return cls(samples=samples, sample_rate=int(segment.frame_rate))
+
+    def to_segment(self) -> pydub.AudioSegment:
+        """
+        Convert to a 16-bit pydub audio segment, clipping to full scale.
+        """
+        # Exact inverse of from_segment for 16-bit audio
+        pcm = self.samples * -np.iinfo(np.int16).min
+        np.clip(pcm, np.iinfo(np.int16).min, np.iinfo(np.int16).max, out=pcm)
+        return audio_from_waveform(pcm, sample_rate=self.sample_rate)
+
+    def set_channels(self, channels: int) -> "Waveform":
+        """
+        Convert between mono and stereo, like pydub.AudioSegment.set_channels.
+        """
+        if channels == self.channels:
+            return self
+
+        if channels == 1:
+            samples = self.samples.mean(axis=0, keepdims=True)
+        elif self.channels == 1:
+            samples = np.repeat(self.samples, channels, axis=0)
+        else:
+            raise ValueError(f"Cannot convert {self.channels} channels to {channels}")
+
+        return Waveform(samples=samples, sample_rate=self.sample_rate)
+
+
+# Either representation of audio
+AudioT = T.TypeVar("AudioT", pydub.AudioSegment, Waveform)
 
 
 def audio_from_waveform(
@@ -23,38 +107,40 @@ def audio_from_waveform(
     if normalize:
         samples *= np.iinfo(np.int16).max / np.max(np.abs(samples))
 
-    # Transpose and convert to int16
-    samples = samples.transpose(1, 0)
-    samples = samples.astype(np.int16)
+    # Interleave channels and convert to int16
+    pcm = samples.transpose(1, 0).astype(np.int16)
 
-    # Write to the bytes of a WAV file
-    wav_bytes = io.BytesIO()
-    wavfile.write(wav_bytes, sample_rate, samples)
-    wav_bytes.seek(0)
-
-    # Read into pydub
-    return pydub.AudioSegment.from_wav(wav_bytes)
+    return pydub.AudioSegment(
+        data=pcm.tobytes(),
+        sample_width=2,
+        frame_rate=sample_rate,
+        channels=pcm.shape[1],
+    )
 
 
-def apply_filters(segment: pydub.AudioSegment, compression: bool = False) -> pydub.AudioSegment:
+def apply_filters(segment: AudioT, compression: bool = False) -> AudioT:
     """
     Apply post-processing filters to the audio segment to compress it and
     keep at a -10 dBFS level.
+
+    Waveforms are filtered in place, audio segments are copied.
     """
     # TODO(hayk): Come up with a principled strategy for these filters and experiment end-to-end.
     # TODO(hayk): Is this going to make audio unbalanced between sequential clips?
 
+    if isinstance(segment, pydub.AudioSegment):
+        return apply_filters(Waveform.from_segment(segment), compression=compression).to_segment()
+
+    samples = segment.samples
+
     if compression:
-        segment = pydub.effects.normalize(
-            segment,
-            headroom=0.1,
-        )
+        normalize(samples, headroom=0.1)
 
-        segment = segment.apply_gain(-10 - segment.dBFS)
+        apply_gain(samples, -10 - dbfs(samples))
 
-        # TODO(hayk): This is quite slow, ~1.7 seconds on a beefy CPU
-        segment = pydub.effects.compress_dynamic_range(
-            segment,
+        compress_dynamic_range(
+            samples,
+            sample_rate=segment.sample_rate,
             threshold=-20.0,
             ratio=4.0,
             attack=5.0,
@@ -62,38 +148,299 @@ def apply_filters(segment: pydub.AudioSegment, compression: bool = False) -> pyd
         )
 
     desired_db = -12
-    segment = segment.apply_gain(desired_db - segment.dBFS)
+    apply_gain(samples, desired_db - dbfs(samples))
 
-    segment = pydub.effects.normalize(
-        segment,
-        headroom=0.1,
-    )
+    normalize(samples, headroom=0.1)
 
     return segment
 
 
-def stitch_segments(
-    segments: T.Sequence[pydub.AudioSegment], crossfade_s: float
-) -> pydub.AudioSegment:
+def dbfs(samples: np.ndarray) -> float:
+    """
+    Loudness of the samples in dB relative to full scale, by RMS over all channels like
+    pydub.AudioSegment.dBFS.
+    """
+    rms = np.sqrt(np.mean(np.square(samples), dtype=np.float64))
+    if rms == 0:
+        return -float("inf")
+    return 20 * np.log10(rms)
+
+
+def apply_gain(samples: np.ndarray, db: float) -> None:
+    """
+    Amplify (channels, samples) in place by the given dB, clipping at full scale like
+    pydub.AudioSegment.apply_gain.
+    """
+    if not np.isfinite(db):
+        return
+
+    samples *= 10 ** (db / 20)
+    np.clip(samples, -1.0, 1.0, out=samples)
+
+
+def normalize(samples: np.ndarray, headroom: float = 0.1) -> None:
+    """
+    Scale (channels, samples) in place so the peak is `headroom` dB below full scale, like
+    pydub.effects.normalize.
+    """
+    peak = np.max(np.abs(samples))
+    if peak == 0:
+        return
+
+    samples *= 10 ** (-headroom / 20) / peak
+
+
+def compress_dynamic_range(
+    samples: np.ndarray,
+    sample_rate: int,
+    threshold: float = -20.0,
+    ratio: float = 4.0,
+    attack: float = 5.0,
+    release: float = 50.0,
+    block_ms: float = 0.5,
+) -> None:
+    """
+    Compress (channels, samples) in place, like pydub.effects.compress_dynamic_range.
+
+    The level is the RMS over all channels of the `attack` ms before each sample. While it is
+    above the threshold the attenuation rises towards (1 - 1 / ratio) of the excess over `attack`
+    ms, otherwise it falls back to zero over `release` ms.
+
+    pydub follows the envelope one sample at a time in Python, which takes seconds per clip. Here
+    the level of every sample is computed at once from a cumulative sum, the attack / release
+    state is stepped once per block of `block_ms` using the block averages, and the gain is
+    linearly interpolated between blocks. At the defaults this is within about 0.1 dB of pydub.
+
+    Args:
+        samples: (channels, samples) float array, modified in place
+        sample_rate: Samples per second
+        threshold: Level in dBFS above which to compress
+        ratio: Compression ratio
+        attack: Attack time in milliseconds, also the RMS window
+        release: Release time in milliseconds
+        block_ms: Step of the envelope follower in milliseconds
+    """
+    num_channels, num_samples = samples.shape
+    if num_samples == 0:
+        return
+
+    thresh_rms = 10 ** (threshold / 20)
+    look_frames = int(attack * sample_rate / 1000)
+    attack_frames = attack * sample_rate / 1000
+    release_frames = release * sample_rate / 1000
+    block = max(1, int(block_ms * sample_rate / 1000))
+
+    # RMS of the window before each sample, excluding the sample itself
+    energy = np.zeros(num_samples + 1, dtype=np.float64)
+    np.cumsum(np.square(samples, dtype=np.float64).sum(axis=0), out=energy[1:])
+
+    ends = np.arange(num_samples)
+    starts = np.maximum(ends - look_frames, 0)
+    window_sizes = (ends - starts) * num_channels
+    rms = np.divide(
+        energy[ends] - energy[starts],
+        window_sizes,
+        out=np.zeros(num_samples),
+        where=window_sizes > 0,
+    )
+    np.sqrt(rms.clip(min=0, out=rms), out=rms)
+
+    # Attenuation in dB to approach while over the threshold
+    with np.errstate(divide="ignore"):
+        max_attenuation = (1 - 1.0 / ratio) * np.maximum(20 * np.log10(rms / thresh_rms), 0)
+
+    # Average over blocks
+    block_starts = np.arange(0, num_samples, block)
+    block_sizes = np.diff(block_starts, append=num_samples)
+    targets = np.add.reduceat(max_attenuation, block_starts) / block_sizes
+    compressing = np.add.reduceat(rms > thresh_rms, block_starts) * 2 > block_sizes
+
+    # Step the attack / release state once per block
+    attack_steps = (targets * (block_sizes / attack_frames)).tolist()
+    release_steps = (targets * (block_sizes / release_frames)).tolist()
+
+    attenuation = 0.0
+    attenuations = np.empty(len(block_starts), dtype=np.float64)
+    for i, (target, is_compressing) in enumerate(zip(targets.tolist(), compressing.tolist())):
+        if is_compressing and attenuation <= target:
+            attenuation = min(attenuation + attack_steps[i], target)
+        else:
+            attenuation = max(attenuation - release_steps[i], 0.0)
+        attenuations[i] = attenuation
+
+    if not attenuations.any():
+        return
+
+    # Each step holds at the end of its block, interpolate the gain in between
+    gain = np.interp(ends, block_starts + block_sizes - 1, attenuations)
+    np.power(10.0, gain / -20, out=gain)
+    samples *= gain.astype(samples.dtype)
+
+
+def stitch_segments(segments: T.Sequence[AudioT], crossfade_s: float) -> AudioT:
     """
     Stitch together a sequence of audio segments with a crossfade between each segment.
+
+    Uses the same fade curves as pydub.AudioSegment.append, but allocates the output once and
+    writes each segment into it, so the cost is linear in the total length rather than in the
+    number of segments times the length.
     """
-    crossfade_ms = int(crossfade_s * 1000)
-    combined_segment = segments[0]
-    for segment in segments[1:]:
-        combined_segment = combined_segment.append(segment, crossfade=crossfade_ms)
-    return combined_segment
+    assert len(segments) > 0
+    waveforms = _sync_waveforms(segments)
+
+    crossfade = int(crossfade_s * waveforms[0].sample_rate)
+    for waveform in waveforms:
+        if waveform.num_samples < crossfade:
+            raise ValueError(
+                f"Crossfade of {crossfade} samples is longer than a segment of "
+                f"{waveform.num_samples} samples"
+            )
+
+    num_samples = sum(w.num_samples for w in waveforms) - crossfade * (len(waveforms) - 1)
+    samples = np.empty((waveforms[0].channels, num_samples), dtype=np.float32)
+
+    # Linear gain ramps, like pydub fades
+    fade_in = np.linspace(0.0, 1.0, crossfade, endpoint=False, dtype=np.float32)
+    fade_out = 1.0 - fade_in
+
+    position = 0
+    for i, waveform in enumerate(waveforms):
+        if i == 0 or crossfade == 0:
+            samples[:, position : position + waveform.num_samples] = waveform.samples
+        else:
+            overlap = samples[:, position : position + crossfade]
+            overlap *= fade_out
+            overlap += waveform.samples[:, :crossfade] * fade_in
+            samples[:, position + crossfade : position + waveform.num_samples] = waveform.samples[
+                :, crossfade:
+            ]
+
+        position += waveform.num_samples - crossfade
+
+    return _like(segments[0], Waveform(samples=samples, sample_rate=waveforms[0].sample_rate))
 
 
-def overlay_segments(segments: T.Sequence[pydub.AudioSegment]) -> pydub.AudioSegment:
+def overlay_segments(segments: T.Sequence[AudioT]) -> AudioT:
     """
     Overlay a sequence of audio segments on top of each other.
+
+    The output has the length of the first segment, like pydub.AudioSegment.overlay. Samples are
+    summed in one buffer and clipped at full scale once at the end.
     """
     assert len(segments) > 0
-    output: pydub.AudioSegment = None
+    waveforms = _sync_waveforms(segments)
+
+    samples = np.zeros((waveforms[0].channels, waveforms[0].num_samples), dtype=np.float32)
+    for waveform in waveforms:
+        num_samples = min(waveform.num_samples, samples.shape[1])
+        samples[:, :num_samples] += waveform.samples[:, :num_samples]
+
+    np.clip(samples, -1.0, 1.0, out=samples)
+
+    return _like(segments[0], Waveform(samples=samples, sample_rate=waveforms[0].sample_rate))
+
+
+def iter_mp3_chunks(
+    segment: AudioT, bitrate: str = "128k", chunk_size: int = 16 * 1024
+) -> T.Iterator[bytes]:
+    """
+    Encode audio to MP3 with an ffmpeg subprocess, yielding the bytes as they are encoded.
+
+    Unlike pydub.AudioSegment.export, nothing goes through temporary files and the encoded
+    audio is never held in memory as a whole, so it can be streamed to a client directly.
+    Closing the generator early stops the encoder.
+
+    Args:
+        segment: Audio to encode
+        bitrate: Target bitrate of the MP3
+        chunk_size: Maximum size of each yielded chunk in bytes
+    """
+    if isinstance(segment, Waveform):
+        segment = segment.to_segment()
+    segment = segment.set_sample_width(2)
+
+    command = [
+        pydub.utils.get_encoder_name(),
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-f",
+        "s16le",
+        "-ar",
+        str(segment.frame_rate),
+        "-ac",
+        str(segment.channels),
+        "-i",
+        "pipe:0",
+        "-f",
+        "mp3",
+        "-b:a",
+        bitrate,
+        "pipe:1",
+    ]
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.stdin is not None and process.stdout is not None
+
+    # Feed the PCM from a thread so the encoder never blocks on a full output pipe
+    def write_pcm() -> None:
+        try:
+            process.stdin.write(segment.raw_data)
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # The encoder exited or the generator was closed
+            pass
+
+    writer = threading.Thread(target=write_pcm, daemon=True)
+    writer.start()
+
+    finished = False
+    try:
+        while True:
+            chunk = process.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        finished = True
+    finally:
+        if not finished:
+            process.kill()
+        writer.join()
+        process.stdout.close()
+        stderr = process.stderr.read() if process.stderr else b""
+        process.wait()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"MP3 encoding failed: {stderr.decode(errors='replace').strip()}")
+
+
+def _sync_waveforms(segments: T.Sequence[AudioT]) -> T.List[Waveform]:
+    """
+    Convert segments to waveforms with a common sample rate and channel count, upsampling and
+    upmixing to the highest like pydub does when combining segments.
+    """
+    sample_rate = max(s.frame_rate for s in segments)
+    channels = max(s.channels for s in segments)
+
+    waveforms = []
     for segment in segments:
-        if output is None:
-            output = segment
-        else:
-            output = output.overlay(segment)
-    return output
+        if isinstance(segment, pydub.AudioSegment):
+            segment = Waveform.from_segment(segment.set_frame_rate(sample_rate))
+        elif segment.sample_rate != sample_rate:
+            raise ValueError(
+                f"Waveforms must have the same sample rate, got {segment.sample_rate} "
+                f"and {sample_rate}"
+            )
+        waveforms.append(segment.set_channels(channels))
+
+    return waveforms
+
+
+def _like(example: AudioT, waveform: Waveform) -> AudioT:
+    """
+    Return the waveform in the same representation as the example.
+    """
+    if isinstance(example, pydub.AudioSegment):
+        return waveform.to_segment()
+    return waveform
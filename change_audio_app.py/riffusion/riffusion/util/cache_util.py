@@ -0,0 +1,231 @@
+"""
+Small in-memory caches for reusing expensive intermediate results.
+"""
+import collections
+import hashlib
+import os
+import threading
+import typing as T
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+K = T.TypeVar("K", bound=T.Hashable)
+V = T.TypeVar("V")
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """
+    Usage counters of a cache.
+    """
+
+    hits: int
+    misses: int
+    size: int
+    max_size: int
+
+    # Total size of the entries, if the cache measures them
+    num_bytes: int = 0
+
+
+class LRUCache(T.Generic[K, V]):
+    """
+    Bounded, thread-safe cache that evicts the least recently used entry when full.
+
+    Unlike functools.lru_cache it works on explicit keys, so callers can key on something other
+    than the arguments, for example a content hash instead of a PIL image.
+
+    Args:
+        max_size: Maximum number of entries
+        max_bytes: Optional maximum total size of the entries, as measured by `size_of`
+        size_of: Size in bytes of a value, required for `max_bytes`
+    """
+
+    def __init__(
+        self,
+        max_size: int = 32,
+        max_bytes: T.Optional[int] = None,
+        size_of: T.Optional[T.Callable[[V], int]] = None,
+    ):
+        if max_size < 1:
+            raise ValueError(f"max_size must be positive, got {max_size}")
+        if max_bytes is not None and size_of is None:
+            raise ValueError("size_of is required to limit the cache by max_bytes")
+
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries: "collections.OrderedDict[K, V]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def get(self, key: K) -> T.Optional[V]:
+        """
+        Return the cached value, or None if missing.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: K, value: V) -> None:
+        """
+        Store a value, evicting the least recently used entries while the cache is over its
+        size limits.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= self._size_of(self._entries[key])
+
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._num_bytes += self._size_of(value)
+
+            while self._entries and (
+                len(self._entries) > self.max_size
+                or (self.max_bytes is not None and self._num_bytes > self.max_bytes)
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= self._size_of(evicted)
+
+    def _size_of(self, value: V) -> int:
+        return self.size_of(value) if self.size_of is not None else 0
+
+    def get_or_create(self, key: K, create: T.Callable[[], V]) -> V:
+        """
+        Return the cached value, or create and store it if missing.
+
+        The lock is not held while creating, so concurrent misses on the same key may both
+        create the value. The last one is kept.
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+            self._num_bytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                size=len(self._entries),
+                max_size=self.max_size,
+                num_bytes=self._num_bytes,
+            )
+
+
+class PromptEmbeddingCache:
+    """
+    Cache of text encoder outputs by prompt, bounded by entry count and total bytes.
+
+    Entries are keyed by the kind of embedding, the prompt, the device and the dtype, so moving
+    or casting the model never returns stale tensors. With a `cache_dir`, embeddings are also
+    saved to disk and reloaded after a restart. The `namespace` should identify the text
+    encoder weights, for example the checkpoint name, since it is part of the file names.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        max_bytes: T.Optional[int] = 512 * 2**20,
+        cache_dir: T.Optional[T.Union[str, Path]] = None,
+        namespace: str = "",
+    ):
+        self.cache: LRUCache[T.Hashable, torch.Tensor] = LRUCache(
+            max_size=max_size,
+            max_bytes=max_bytes,
+            size_of=lambda tensor: tensor.element_size() * tensor.nelement(),
+        )
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.namespace = namespace
+
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_or_create(
+        self,
+        kind: str,
+        prompt: str,
+        device: T.Union[str, torch.device],
+        dtype: torch.dtype,
+        create: T.Callable[[], torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Return the cached embedding, loading it from disk or creating it if missing.
+
+        Args:
+            kind: Which embedding function produced the value, such as "text" or "weighted"
+            prompt: Prompt that was embedded
+            device: Device of the embedding
+            dtype: Dtype of the embedding
+            create: Computes the embedding on a miss
+        """
+        key = (kind, prompt, str(device), dtype)
+        embedding = self.cache.get(key)
+        if embedding is not None:
+            return embedding
+
+        path = self._path(kind, prompt, dtype)
+        if path is not None and path.is_file():
+            embedding = torch.load(path, map_location="cpu").to(device=device, dtype=dtype)
+        else:
+            embedding = create()
+            if path is not None:
+                # Write to a temporary file first so concurrent readers never see partial data
+                tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+                torch.save(embedding.cpu(), tmp_path)
+                tmp_path.replace(path)
+
+        self.cache.put(key, embedding)
+        return embedding
+
+    def stats(self) -> CacheStats:
+        return self.cache.stats()
+
+    def clear(self) -> None:
+        """
+        Clear the in-memory entries. Files on disk are kept.
+        """
+        self.cache.clear()
+
+    def _path(self, kind: str, prompt: str, dtype: torch.dtype) -> T.Optional[Path]:
+        if self.cache_dir is None:
+            return None
+
+        digest = hashlib.blake2b(
+            f"{self.namespace}\0{kind}\0{dtype}\0{prompt}".encode(), digest_size=16
+        ).hexdigest()
+        return self.cache_dir / f"{kind}_{digest}.pt"
+
+
+def image_hash(image: Image.Image) -> str:
+    """
+    Hash of the mode, size and pixel content of an image.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
@@ -2,6 +2,7 @@
 Module for converting between spectrograms tensors and spectrogram images, as well as
 general helpers for operating on pillow images.
 """
+import functools
 import typing as T
 
 import numpy as np
@@ -24,36 +25,40 @@ def image_from_spectrogram(spectrogram: np.ndarray, power: float = 0.25) -> Imag
     Returns:
         image: (frequency, time, channels)
     """
-    # Rescale to 0-1
+    num_channels, height, width = spectrogram.shape
+    if num_channels not in (1, 2):
+        raise NotImplementedError(f"Unsupported number of channels: {num_channels}")
+
+    # Rescale to 0-1, in a single float buffer that the steps below modify in place
     max_value = np.max(spectrogram)
-    data = spectrogram / max_value
+    data = np.divide(spectrogram, max_value, dtype=np.float32)
 
     # Apply the power curve
-    data = np.power(data, power)
+    np.power(data, power, out=data)
 
     # Rescale to 0-255
-    data = data * 255
+    np.multiply(data, 255, out=data)
 
     # Invert
-    data = 255 - data
+    np.subtract(255, data, out=data)
 
     # Convert to uint8
     data = data.astype(np.uint8)
 
     # Munge channels into a PIL image
-    if data.shape[0] == 1:
+    if num_channels == 1:
         # TODO(hayk): Do we want to write single channel to disk instead?
-        image = Image.fromarray(data[0], mode="L").convert("RGB")
-    elif data.shape[0] == 2:
-        data = np.array([np.zeros_like(data[0]), data[0], data[1]]).transpose(1, 2, 0)
-        image = Image.fromarray(data, mode="RGB")
+        image = Image.fromarray(data[0], mode="L")
     else:
-        raise NotImplementedError(f"Unsupported number of channels: {data.shape[0]}")
+        blank = Image.new("L", (width, height))
+        green = Image.fromarray(data[0], mode="L")
+        blue = Image.fromarray(data[1], mode="L")
+        image = Image.merge("RGB", (blank, green, blue))
 
     # Flip Y
     image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
 
-    return image
+    return image.convert("RGB")
 
 
 def spectrogram_from_image(
@@ -61,18 +66,20 @@ def spectrogram_from_image(
     power: float = 0.25,
     stereo: bool = False,
     max_value: float = 30e6,
+    out: T.Optional[np.ndarray] = None,
 ) -> np.ndarray:
     """
     Compute a spectrogram magnitude array from a spectrogram image.
 
     This is the inverse of image_from_spectrogram, except for discretization error from
-    quantizing to uint8.
+    quantizing to uint8. Since pixels are uint8, the conversion is a 256 entry lookup table.
 
     Args:
         image: (frequency, time, channels)
         power: The power curve applied to the spectrogram
         stereo: Whether the spectrogram encodes stereo data
         max_value: The max value of the original spectrogram. In practice doesn't matter.
+        out: Optional float32 array of (channels, frequency, time) to write the result into
 
     Returns:
         spectrogram: (channels, frequency, time)
@@ -81,33 +88,65 @@ def spectrogram_from_image(
     if image.mode in ("P", "L"):
         image = image.convert("RGB")
 
-    # Flip Y
-    image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-
-    # Munge channels into a numpy array of (channels, frequency, time)
-    data = np.array(image).transpose(2, 0, 1)
+    # View as (channels, frequency, time), flipping Y
+    data = np.asarray(image)[::-1].transpose(2, 0, 1)
     if stereo:
         # Take the G and B channels as done in image_from_spectrogram
-        data = data[[1, 2], :, :]
+        data = data[1:3]
     else:
-        data = data[0:1, :, :]
+        data = data[0:1]
 
-    # Convert to floats
-    data = data.astype(np.float32)
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
 
-    # Invert
-    data = 255 - data
+    # Invert, rescale, reverse the power curve and rescale to max value in one lookup
+    return np.take(_spectrogram_lookup_table(power, max_value), data, out=out, mode="clip")
 
-    # Rescale to 0-1
-    data = data / 255
 
-    # Reverse the power curve
-    data = np.power(data, 1 / power)
+def spectrograms_from_images(
+    images: T.Sequence[Image.Image],
+    power: float = 0.25,
+    stereo: bool = False,
+    max_value: float = 30e6,
+    out: T.Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Compute a batch of spectrogram magnitude arrays from spectrogram images of the same size.
 
-    # Rescale to max value
-    data = data * max_value
+    See spectrogram_from_image.
 
-    return data
+    Args:
+        images: Images of (frequency, time, channels)
+        power: The power curve applied to the spectrograms
+        stereo: Whether the spectrograms encode stereo data
+        max_value: The max value of the original spectrograms. In practice doesn't matter.
+        out: Optional float32 array of (batch, channels, frequency, time) to write the result into
+
+    Returns:
+        spectrograms: (batch, channels, frequency, time), with zero size for no images
+    """
+    if out is None:
+        width, height = images[0].size if len(images) > 0 else (0, 0)
+        out = np.empty((len(images), 2 if stereo else 1, height, width), dtype=np.float32)
+
+    for i, image in enumerate(images):
+        spectrogram_from_image(image, power=power, stereo=stereo, max_value=max_value, out=out[i])
+
+    return out
+
+
+@functools.lru_cache(maxsize=32)
+def _spectrogram_lookup_table(power: float, max_value: float) -> np.ndarray:
+    """
+    Spectrogram magnitude for each uint8 pixel value, matching the float math it replaces.
+    """
+    table = np.arange(256, dtype=np.float32)
+    table = 255 - table
+    table = table / 255
+    table = np.power(table, 1 / power)
+    table = table * max_value
+    table.setflags(write=False)
+    return table
 
 
 def exif_from_image(pil_image: Image.Image) -> T.Dict[str, T.Any]:
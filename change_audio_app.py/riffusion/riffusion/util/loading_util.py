@@ -0,0 +1,83 @@
+"""
+Loading expensive resources like models in the background.
+"""
+import logging
+import threading
+import typing as T
+from concurrent.futures import Future
+
+V = T.TypeVar("V")
+
+
+class BackgroundLoader(T.Generic[V]):
+    """
+    Runs a loading function once on a background thread, so a process can start serving, for
+    example health checks, while its models load.
+
+    This module only depends on the standard library, so it can be imported before the heavy
+    dependencies of the loading function.
+
+    Args:
+        load: Function that loads and returns the resource
+        name: Name of the loading thread
+    """
+
+    def __init__(self, load: T.Callable[[], V], name: str = "background-loader"):
+        self.load = load
+        self.name = name
+
+        self._future: "Future[V]" = Future()
+        self._thread: T.Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> "BackgroundLoader[V]":
+        """
+        Start loading, if not started yet.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether loading finished successfully.
+        """
+        return self._future.done() and self._future.exception() is None
+
+    @property
+    def error(self) -> T.Optional[BaseException]:
+        """
+        The exception raised by the loading function, if it failed.
+        """
+        return self._future.exception() if self._future.done() else None
+
+    @property
+    def status(self) -> str:
+        """
+        One of "not_started", "loading", "ready" or "failed".
+        """
+        if self._thread is None:
+            return "not_started"
+        if not self._future.done():
+            return "loading"
+        return "failed" if self.error is not None else "ready"
+
+    def get(self, timeout: T.Optional[float] = None) -> V:
+        """
+        Return the loaded resource, starting and waiting for the load as needed.
+
+        Raises:
+            The exception of the loading function, or TimeoutError
+        """
+        self.start()
+        return self._future.result(timeout=timeout)
+
+    def _run(self) -> None:
+        try:
+            self._future.set_result(self.load())
+        except BaseException as exception:  # pylint: disable=broad-except
+            logging.exception(f"Loading in {self.name} failed")
+            self._future.set_exception(exception)
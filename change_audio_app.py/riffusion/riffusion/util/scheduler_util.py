@@ -0,0 +1,73 @@
+"""
+Denoising schedulers by name, and presets of a scheduler with a number of inference steps.
+"""
+import dataclasses
+import typing as T
+
+# Schedulers offered in the apps, any other scheduler of diffusers works by name as well
+SCHEDULER_OPTIONS = [
+    "DPMSolverMultistepScheduler",
+    "PNDMScheduler",
+    "DDIMScheduler",
+    "LMSDiscreteScheduler",
+    "EulerDiscreteScheduler",
+    "EulerAncestralDiscreteScheduler",
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class SchedulerPreset:
+    """
+    A scheduler with the number of inference steps it is meant to run.
+    """
+
+    # Name of the scheduler, None for the scheduler of the checkpoint
+    scheduler: T.Optional[str]
+
+    # Number of inner loops of the diffusion model
+    num_inference_steps: int
+
+
+# DPMSolverMultistepScheduler runs DPM-Solver++ by default, a solver made for 15 to 20 steps
+SCHEDULER_PRESETS = {
+    "fast": SchedulerPreset(scheduler="DPMSolverMultistepScheduler", num_inference_steps=15),
+    "balanced": SchedulerPreset(scheduler="DPMSolverMultistepScheduler", num_inference_steps=20),
+    "quality": SchedulerPreset(scheduler=None, num_inference_steps=50),
+}
+
+
+def get_scheduler_class(scheduler: str) -> T.Type[T.Any]:
+    """
+    Look up a diffusers scheduler class by its name.
+
+    Raises:
+        ValueError: If diffusers has no scheduler of that name
+    """
+    import diffusers
+    from diffusers.schedulers.scheduling_utils import SchedulerMixin
+
+    cls = getattr(diffusers, scheduler, None)
+    if not isinstance(cls, type) or not issubclass(cls, SchedulerMixin):
+        raise ValueError(f"Unknown scheduler {scheduler}")
+
+    return cls
+
+
+def get_scheduler(scheduler: str, config: T.Any) -> T.Any:
+    """
+    Construct a denoising scheduler from a string, with the config of another scheduler.
+    """
+    return get_scheduler_class(scheduler).from_config(config)
+
+
+def get_preset(name: str) -> SchedulerPreset:
+    """
+    Look up a scheduler preset by name.
+
+    Raises:
+        ValueError: If there is no preset of that name
+    """
+    if name not in SCHEDULER_PRESETS:
+        raise ValueError(f"Unknown preset {name}, must be one of {list(SCHEDULER_PRESETS)}")
+
+    return SCHEDULER_PRESETS[name]
@@ -1,3 +1,4 @@
+import typing as T
 import warnings
 
 import numpy as np
@@ -19,30 +20,59 @@ def check_device(device: str, backup: str = "cpu") -> str:
 
 
 def slerp(
-    t: float, v0: torch.Tensor, v1: torch.Tensor, dot_threshold: float = 0.9995
+    t: T.Union[float, torch.Tensor],
+    v0: torch.Tensor,
+    v1: torch.Tensor,
+    dot_threshold: float = 0.9995,
 ) -> torch.Tensor:
     """
     Helper function to spherically interpolate two arrays v1 v2.
+
+    Runs in torch on the device of the inputs. Numpy arrays are also accepted and give a numpy
+    result. Falls back to linear interpolation when the inputs are nearly parallel.
+
+    Args:
+        t: Interpolation factor, or a (batch,) tensor of factors
+        v0: Start array
+        v1: End array of the same shape
+        dot_threshold: Cosine similarity above which to interpolate linearly
+
+    Returns:
+        Interpolated array of the shape of v0 for a scalar t. For a batched t the first
+        dimension of v0 and v1 is a batch dimension of size one or the size of t, each batch
+        element is interpolated separately, and the result has a first dimension of the size
+        of t.
     """
-    if not isinstance(v0, np.ndarray):
-        inputs_are_torch = True
-        input_device = v0.device
-        v0 = v0.cpu().numpy()
-        v1 = v1.cpu().numpy()
-
-    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
-    if np.abs(dot) > dot_threshold:
-        v2 = (1 - t) * v0 + t * v1
-    else:
-        theta_0 = np.arccos(dot)
-        sin_theta_0 = np.sin(theta_0)
-        theta_t = theta_0 * t
-        sin_theta_t = np.sin(theta_t)
-        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
-        s1 = sin_theta_t / sin_theta_0
-        v2 = s0 * v0 + s1 * v1
-
-    if inputs_are_torch:
-        v2 = torch.from_numpy(v2).to(input_device)
-
-    return v2
+    if isinstance(v0, np.ndarray):
+        return slerp(
+            torch.as_tensor(t), torch.from_numpy(v0), torch.from_numpy(v1), dot_threshold
+        ).numpy()
+
+    t = torch.as_tensor(t, device=v0.device, dtype=torch.float32)
+    batched = t.ndim > 0
+
+    # Flatten to (batch, features), computing in at least single precision
+    num_rows = v0.shape[0] if batched else 1
+    compute_dtype = torch.promote_types(v0.dtype, torch.float32)
+    v0_flat = v0.reshape(num_rows, -1).to(compute_dtype)
+    v1_flat = v1.reshape(num_rows, -1).to(compute_dtype)
+    t = t.reshape(-1).to(compute_dtype)
+
+    dot = (v0_flat * v1_flat).sum(dim=1) / (
+        torch.linalg.norm(v0_flat, dim=1) * torch.linalg.norm(v1_flat, dim=1)
+    )
+
+    theta_0 = torch.arccos(dot.clamp(-1.0, 1.0))
+    sin_theta_0 = torch.sin(theta_0)
+    theta_t = theta_0 * t
+    s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+    s1 = torch.sin(theta_t) / sin_theta_0
+
+    linear = dot.abs() > dot_threshold
+    s0 = torch.where(linear, 1 - t, s0)
+    s1 = torch.where(linear, t, s1)
+
+    v2 = s0[:, None] * v0_flat + s1[:, None] * v1_flat
+
+    shape = (v2.shape[0],) + v0.shape[1:] if batched else v0.shape
+    return v2.reshape(shape).to(v0.dtype)
@@ -0,0 +1,279 @@
+"""
+On-disk caches that make loading a checkpoint fast: its modules converted to the serving dtype
+as safetensors, and traced UNets for fixed input shapes.
+"""
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import typing as T
+from pathlib import Path
+
+import torch
+
+# (sample shape, encoder hidden states shape) of a UNet call
+UNetShapes = T.Tuple[T.Tuple[int, ...], T.Tuple[int, ...]]
+
+
+def _module_classes() -> T.Dict[str, T.Any]:
+    """
+    Classes of the modules that are cached, by module name. Imported here so that the traced
+    UNet cache can be used without diffusers.
+    """
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+    from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
+
+    return dict(
+        vae=AutoencoderKL,
+        text_encoder=CLIPTextModel,
+        tokenizer=CLIPTokenizer,
+        unet=UNet2DConditionModel,
+        feature_extractor=CLIPFeatureExtractor,
+    )
+
+
+def checkpoint_id(checkpoint: str) -> str:
+    """
+    Identifier of a checkpoint for cache keys. For local checkpoints it includes the modification
+    time of the model index, so that entries of retrained weights are not reused.
+    """
+    model_index = Path(checkpoint, "model_index.json")
+    if model_index.is_file():
+        return f"{Path(checkpoint).resolve()}@{model_index.stat().st_mtime_ns}"
+    return checkpoint
+
+
+def _digest(*parts: T.Any) -> str:
+    key = "\0".join(str(part) for part in parts)
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+class WeightsCache:
+    """
+    Modules of checkpoints converted to a dtype and saved as safetensors on local disk.
+
+    The first load of a checkpoint goes through `from_pretrained` as usual and the modules are
+    then saved here. Later loads memory-map the safetensors files, which skips the download
+    cache, pickle deserialization and dtype conversion, so they are limited by disk reads.
+    Entries are keyed by checkpoint and dtype. Remove the directory to drop them.
+    """
+
+    # Bump when the layout of entries changes
+    VERSION = 1
+
+    def __init__(self, cache_dir: T.Union[str, Path]):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, checkpoint: str, dtype: torch.dtype) -> Path:
+        name = checkpoint.strip("/").replace("/", "--")
+        dtype_name = str(dtype).replace("torch.", "")
+        digest = _digest(checkpoint_id(checkpoint), dtype, self.VERSION)
+        return self.cache_dir / f"{name}-{dtype_name}-{digest}"
+
+    def load(
+        self, checkpoint: str, dtype: torch.dtype, device: str
+    ) -> T.Optional[T.Dict[str, T.Any]]:
+        """
+        Load the cached modules of a checkpoint, or return None if there is no entry.
+        """
+        path = self.path(checkpoint, dtype)
+        if not path.is_dir():
+            return None
+
+        components: T.Dict[str, T.Any] = {}
+        for name, cls in _module_classes().items():
+            if issubclass(cls, torch.nn.Module):
+                module = cls.from_pretrained(
+                    path / name, torch_dtype=dtype, use_safetensors=True, low_cpu_mem_usage=True
+                )
+                components[name] = module.to(device)
+            else:
+                components[name] = cls.from_pretrained(path / name)
+
+        # Restore the scheduler class that was saved
+        import diffusers
+
+        scheduler_config = json.loads((path / "scheduler" / "scheduler_config.json").read_text())
+        scheduler_cls = getattr(diffusers, scheduler_config["_class_name"])
+        components["scheduler"] = scheduler_cls.from_pretrained(path / "scheduler")
+
+        return components
+
+    def save(self, checkpoint: str, dtype: torch.dtype, components: T.Dict[str, T.Any]) -> None:
+        """
+        Save the modules of a checkpoint, which must already have the given dtype.
+        """
+        path = self.path(checkpoint, dtype)
+
+        # Write to a temporary directory first so concurrent loaders never see partial entries
+        tmp_path = Path(tempfile.mkdtemp(prefix=f"{path.name}.", dir=self.cache_dir))
+        try:
+            for name in list(_module_classes()) + ["scheduler"]:
+                module = components[name]
+                if isinstance(module, torch.nn.Module):
+                    module.save_pretrained(tmp_path / name, safe_serialization=True)
+                else:
+                    module.save_pretrained(tmp_path / name)
+
+            try:
+                tmp_path.rename(path)
+            except OSError:
+                # Another process saved the same entry first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+
+class _UNetSample(torch.nn.Module):
+    """
+    Calls a UNet and returns the sample tensor, which is what can be traced.
+    """
+
+    def __init__(self, unet: torch.nn.Module):
+        super().__init__()
+        self.unet = unet
+
+    def forward(
+        self, sample: torch.Tensor, timestep: torch.Tensor, encoder_hidden_states: torch.Tensor
+    ) -> torch.Tensor:
+        return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)[0]
+
+
+def trace_unet(unet: torch.nn.Module, shapes: UNetShapes) -> torch.jit.ScriptModule:
+    """
+    Trace a UNet for one sample shape and encoder hidden states shape.
+    """
+    parameter = next(unet.parameters())
+    sample_shape, hidden_shape = shapes
+
+    sample = torch.randn(sample_shape, dtype=parameter.dtype, device=parameter.device)
+    # Traced with a float timestep, which works for the integer and fractional timesteps of all
+    # schedulers since the UNet embeds it as float anyway
+    timestep = torch.tensor(999.0, device=parameter.device)
+    encoder_hidden_states = torch.randn(
+        hidden_shape, dtype=parameter.dtype, device=parameter.device
+    )
+
+    with torch.no_grad():
+        return torch.jit.trace(
+            _UNetSample(unet).eval(), (sample, timestep, encoder_hidden_states), check_trace=False
+        )
+
+
+class TracedUNetCache:
+    """
+    Traced UNets saved with torch.jit.
+
+    A trace is only valid for the input shapes and the torch version it was made with, so
+    entries are keyed by checkpoint, dtype, device type, torch version and shapes.
+    """
+
+    def __init__(self, cache_dir: T.Union[str, Path]):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, checkpoint: str, dtype: torch.dtype, device: str, shapes: UNetShapes) -> Path:
+        digest = _digest(
+            checkpoint_id(checkpoint),
+            dtype,
+            torch.device(device).type,
+            torch.__version__,
+            shapes,
+        )
+        return self.cache_dir / f"unet_traced_{digest}.pt"
+
+    def get_or_trace(
+        self,
+        unet: torch.nn.Module,
+        checkpoint: str,
+        shapes: UNetShapes,
+    ) -> torch.jit.ScriptModule:
+        """
+        Load the traced UNet for the shapes, or trace and save it if missing.
+        """
+        parameter = next(unet.parameters())
+        device = str(parameter.device)
+
+        path = self.path(checkpoint, parameter.dtype, device, shapes)
+        if path.is_file():
+            return torch.jit.load(str(path), map_location=device)
+
+        traced = trace_unet(unet, shapes)
+
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        torch.jit.save(traced, str(tmp_path))
+        tmp_path.replace(path)
+
+        return traced
+
+
+class ShapeTracedUNet(torch.nn.Module):
+    """
+    UNet that runs a traced module for the input shapes it has one for, and the eager UNet for
+    all others. Has the call signature the pipelines use.
+
+    With a `trace` function, shapes without a traced module are traced on first use instead,
+    for example with `TracedUNetCache.get_or_trace`, so every shape is traced once.
+    """
+
+    @dataclasses.dataclass
+    class UNet2DConditionOutput:
+        sample: torch.Tensor
+
+    def __init__(
+        self,
+        unet: torch.nn.Module,
+        traced: T.Optional[T.Dict[UNetShapes, torch.jit.ScriptModule]] = None,
+        trace: T.Optional[T.Callable[[UNetShapes], torch.jit.ScriptModule]] = None,
+    ):
+        super().__init__()
+        self.unet = unet
+        self.trace = trace
+
+        # Plain dict, the traced modules are not parameters of this module
+        self.traced: T.Dict[UNetShapes, torch.jit.ScriptModule] = dict(traced or {})
+        self._lock = threading.Lock()
+
+    @property
+    def in_channels(self) -> int:
+        return self.unet.in_channels
+
+    @property
+    def config(self) -> T.Any:
+        return self.unet.config
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.unet.parameters()).device
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return next(self.unet.parameters()).dtype
+
+    def forward(
+        self,
+        sample: torch.Tensor,
+        timestep: T.Union[torch.Tensor, float, int],
+        encoder_hidden_states: torch.Tensor,
+    ) -> T.Any:
+        shapes = (tuple(sample.shape), tuple(encoder_hidden_states.shape))
+
+        traced = self.traced.get(shapes)
+        if traced is None and self.trace is not None:
+            with self._lock:
+                if shapes not in self.traced:
+                    self.traced[shapes] = self.trace(shapes)
+                traced = self.traced[shapes]
+
+        if traced is None:
+            return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states)
+
+        timestep = torch.as_tensor(timestep, dtype=torch.float32, device=sample.device)
+        return self.UNet2DConditionOutput(sample=traced(sample, timestep, encoder_hidden_states))
@@ -0,0 +1,76 @@
+import numpy as np
+import pydub
+import torch
+
+from riffusion.audio_splitter import AudioSplitter
+from riffusion.util import audio_util
+
+from .test_case import TestCase
+
+
+class ScaleModel(torch.nn.Module):
+    """
+    Stand-in for HDemucs whose sources are scaled copies of the input.
+    """
+
+    sources = ["half", "double"]
+
+    def forward(self, waveform: torch.Tensor) -> torch.Tensor:
+        return torch.stack([0.5 * waveform, 2.0 * waveform], dim=1)
+
+
+class ScaleSplitter(AudioSplitter):
+    @staticmethod
+    def load_model(model_path: str = "") -> torch.nn.Module:
+        return ScaleModel()
+
+
+class AudioSplitterTest(TestCase):
+    """
+    Test riffusion.audio_splitter.AudioSplitter chunking with a fake model.
+    """
+
+    def test_separate_sources(self) -> None:
+        sample_rate = 8000
+
+        for batch_size in (1, 3):
+            splitter = ScaleSplitter(segment_length_s=1.0, batch_size=batch_size, device="cpu")
+
+            # Shorter than the overlap, one chunk, and many chunks with a ragged end
+            for length in (100, 8000, 3 * sample_rate + 17):
+                with self.subTest(batch_size=batch_size, length=length):
+                    waveform = torch.randn(2, 2, length)
+
+                    sources = splitter.separate_sources(waveform, sample_rate=sample_rate)
+                    self.assertEqual(sources.shape, (2, 2, 2, length))
+
+                    # The crossfades add back up to the model output
+                    torch.testing.assert_close(sources[:, 0], 0.5 * waveform)
+                    torch.testing.assert_close(sources[:, 1], 2.0 * waveform)
+
+                    # Streaming gives the same pieces
+                    pieces = list(splitter.iter_separate_sources(waveform, sample_rate))
+                    torch.testing.assert_close(torch.cat(pieces, dim=-1), sources)
+
+    def test_split(self) -> None:
+        audio_path = (
+            self.TEST_DATA_PATH
+            / "tired_traveler"
+            / "clips"
+            / "clip_2_start_103694_ms_duration_5678_ms.wav"
+        )
+        segment = pydub.AudioSegment.from_file(audio_path)
+
+        splitter = ScaleSplitter(segment_length_s=1.0, device="cpu")
+        stems = splitter.split(segment)
+
+        self.assertEqual(set(stems.keys()), {"half", "double"})
+        for stem in stems.values():
+            self.assertEqual(len(stem), len(segment))
+            self.assertEqual(stem.channels, segment.channels)
+
+        # The model sees normalized audio, so the offset is not scaled
+        source = audio_util.Waveform.from_segment(segment).samples
+        offset = source.mean()
+        half = audio_util.Waveform.from_segment(stems["half"]).samples
+        np.testing.assert_allclose(half, 0.5 * (source - offset) + offset, atol=1e-3)
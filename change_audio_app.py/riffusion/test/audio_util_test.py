@@ -0,0 +1,210 @@
+import io
+import shutil
+import unittest
+
+import numpy as np
+import pydub
+import pydub.utils
+
+from riffusion.util import audio_util
+
+from .test_case import TestCase
+
+
+class AudioUtilTest(TestCase):
+    """
+    Test riffusion.util.audio_util
+    """
+
+    def load_clip(self) -> pydub.AudioSegment:
+        audio_path = (
+            self.TEST_DATA_PATH
+            / "tired_traveler"
+            / "clips"
+            / "clip_2_start_103694_ms_duration_5678_ms.wav"
+        )
+        return pydub.AudioSegment.from_file(audio_path)
+
+    def test_waveform_round_trip(self) -> None:
+        segment = self.load_clip()
+
+        for channels in (1, 2):
+            for sample_width in (1, 2, 3, 4):
+                with self.subTest(channels=channels, sample_width=sample_width):
+                    source = segment.set_channels(channels).set_sample_width(sample_width)
+
+                    waveform = audio_util.Waveform.from_segment(source)
+                    self.assertEqual(waveform.channels, channels)
+                    self.assertEqual(waveform.num_samples, int(source.frame_count()))
+                    self.assertEqual(waveform.samples.dtype, np.float32)
+                    self.assertLessEqual(np.abs(waveform.samples).max(), 1.0)
+
+                    # The samples match pydub's own per channel arrays
+                    expected = np.array(
+                        [c.get_array_of_samples() for c in source.split_to_mono()],
+                        dtype=np.float64,
+                    )
+                    scale = 2 ** (8 * source.sample_width - 1)
+                    np.testing.assert_allclose(waveform.samples * scale, expected, rtol=1e-6)
+
+                    # Converting back to 16 bit is within a sample of pydub's conversion
+                    round_trip = waveform.to_segment()
+                    self.assertEqual(round_trip.channels, channels)
+                    self.assertEqual(round_trip.frame_rate, source.frame_rate)
+                    self.assertEqual(len(round_trip), len(source))
+
+                    if sample_width >= 2:
+                        reference = np.array(
+                            source.set_sample_width(2).get_array_of_samples(), dtype=np.int32
+                        )
+                        actual = np.array(round_trip.get_array_of_samples(), dtype=np.int32)
+                        self.assertLessEqual(np.abs(actual - reference).max(), 2)
+
+    def test_waveform_set_channels(self) -> None:
+        waveform = audio_util.Waveform.from_segment(self.load_clip().set_channels(2))
+
+        mono = waveform.set_channels(1)
+        self.assertEqual(mono.channels, 1)
+        np.testing.assert_allclose(mono.samples[0], waveform.samples.mean(axis=0))
+
+        stereo = mono.set_channels(2)
+        self.assertEqual(stereo.channels, 2)
+        np.testing.assert_array_equal(stereo.samples[0], stereo.samples[1])
+
+        self.assertIs(stereo.set_channels(2), stereo)
+
+    def test_audio_from_waveform(self) -> None:
+        sample_rate = 44100
+        samples = np.stack(
+            [
+                np.sin(np.linspace(0, 100, sample_rate)),
+                np.cos(np.linspace(0, 100, sample_rate)),
+            ]
+        ).astype(np.float32)
+
+        segment = audio_util.audio_from_waveform(samples.copy(), sample_rate, normalize=True)
+        self.assertEqual(segment.channels, 2)
+        self.assertEqual(segment.sample_width, 2)
+        self.assertEqual(segment.frame_rate, sample_rate)
+        self.assertEqual(int(segment.frame_count()), sample_rate)
+
+        # Channels are interleaved correctly
+        left, right = [np.array(c.get_array_of_samples()) for c in segment.split_to_mono()]
+        np.testing.assert_allclose(left / 32767, samples[0], atol=1e-3)
+        np.testing.assert_allclose(right / 32767, samples[1], atol=1e-3)
+
+    def test_filters_match_pydub(self) -> None:
+        segment = self.load_clip()[:1500].apply_gain(10)
+        scale = 1 / 2**15
+
+        # Loudness
+        waveform = audio_util.Waveform.from_segment(segment)
+        self.assertAlmostEqual(audio_util.dbfs(waveform.samples), segment.dBFS, places=2)
+
+        # Gain with clipping
+        audio_util.apply_gain(waveform.samples, 6.0)
+        expected = audio_util.Waveform.from_segment(segment.apply_gain(6.0)).samples
+        np.testing.assert_allclose(waveform.samples, expected, atol=2 * scale)
+
+        # Peak normalization
+        waveform = audio_util.Waveform.from_segment(segment)
+        audio_util.normalize(waveform.samples, headroom=0.1)
+        expected = audio_util.Waveform.from_segment(
+            pydub.effects.normalize(segment, headroom=0.1)
+        ).samples
+        np.testing.assert_allclose(waveform.samples, expected, atol=2 * scale)
+
+        # Compression, which is approximated at block rate
+        waveform = audio_util.Waveform.from_segment(segment)
+        audio_util.compress_dynamic_range(waveform.samples, sample_rate=waveform.sample_rate)
+        expected = audio_util.Waveform.from_segment(
+            pydub.effects.compress_dynamic_range(segment)
+        ).samples
+        error = np.sqrt(np.mean((waveform.samples - expected) ** 2) / np.mean(expected**2))
+        self.assertLess(error, 0.02)
+
+    def test_apply_filters(self) -> None:
+        segment = self.load_clip()
+
+        for compression in (False, True):
+            with self.subTest(compression=compression):
+                filtered = audio_util.apply_filters(segment, compression=compression)
+                self.assertEqual(len(filtered), len(segment))
+                self.assertEqual(filtered.channels, segment.channels)
+
+                # Peak normalized with 0.1 dB of headroom
+                peak = np.abs(np.array(filtered.get_array_of_samples())).max()
+                self.assertAlmostEqual(20 * np.log10(peak / 2**15), -0.1, places=2)
+
+                # Waveforms are filtered in place
+                waveform = audio_util.Waveform.from_segment(segment)
+                self.assertIs(
+                    audio_util.apply_filters(waveform, compression=compression), waveform
+                )
+                np.testing.assert_allclose(
+                    waveform.samples,
+                    audio_util.Waveform.from_segment(filtered).samples,
+                    atol=1 / 2**15,
+                )
+
+    def test_stitch_segments(self) -> None:
+        clip = self.load_clip()
+        segments = [clip[i * 500 : (i + 1) * 500 + 200] for i in range(8)]
+
+        for crossfade_s in (0.0, 0.1):
+            with self.subTest(crossfade_s=crossfade_s):
+                stitched = audio_util.stitch_segments(segments, crossfade_s=crossfade_s)
+
+                # Same length and fade curves as appending with pydub
+                expected = segments[0]
+                for segment in segments[1:]:
+                    expected = expected.append(segment, crossfade=int(crossfade_s * 1000))
+
+                self.assertEqual(stitched.channels, expected.channels)
+                self.assertAlmostEqual(len(stitched), len(expected), delta=1)
+
+                actual = audio_util.Waveform.from_segment(stitched).samples
+                reference = audio_util.Waveform.from_segment(expected).samples
+                num_samples = min(actual.shape[1], reference.shape[1])
+                error = np.abs(actual[:, :num_samples] - reference[:, :num_samples])
+                self.assertLess(error.max(), 1e-3)
+
+                # Waveforms stitch to the same result
+                waveforms = [audio_util.Waveform.from_segment(s) for s in segments]
+                stitched_waveform = audio_util.stitch_segments(waveforms, crossfade_s=crossfade_s)
+                np.testing.assert_allclose(stitched_waveform.samples, actual, atol=1 / 2**15)
+
+    def test_overlay_segments(self) -> None:
+        clip = self.load_clip()
+        segments = [clip[:1000], clip[1000:1500].set_channels(1), clip[2000:4000]]
+
+        # Keep the sum below full scale, pydub clips after every step
+        segments = [s.apply_gain(-10) for s in segments]
+
+        overlaid = audio_util.overlay_segments(segments)
+        expected = segments[0].overlay(segments[1]).overlay(segments[2])
+
+        self.assertEqual(len(overlaid), len(segments[0]))
+        self.assertEqual(overlaid.channels, 2)
+        np.testing.assert_allclose(
+            audio_util.Waveform.from_segment(overlaid).samples,
+            audio_util.Waveform.from_segment(expected).samples,
+            atol=2 / 2**15,
+        )
+
+    @unittest.skipUnless(shutil.which(pydub.utils.get_encoder_name()), "requires ffmpeg")
+    def test_iter_mp3_chunks(self) -> None:
+        segment = self.load_clip()
+
+        chunks = list(audio_util.iter_mp3_chunks(segment, chunk_size=4096))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 4096 for chunk in chunks))
+
+        decoded = pydub.AudioSegment.from_file(io.BytesIO(b"".join(chunks)), format="mp3")
+        self.assertEqual(decoded.channels, segment.channels)
+        self.assertAlmostEqual(decoded.duration_seconds, segment.duration_seconds, delta=0.1)
+
+        # Closing early stops the encoder
+        stream = audio_util.iter_mp3_chunks(audio_util.Waveform.from_segment(segment))
+        self.assertGreater(len(next(stream)), 0)
+        stream.close()
@@ -0,0 +1,105 @@
+import tempfile
+
+import torch
+from PIL import Image
+
+from riffusion.util import cache_util
+
+from .test_case import TestCase
+
+
+class CacheUtilTest(TestCase):
+    """
+    Test riffusion.util.cache_util
+    """
+
+    def test_lru_cache(self) -> None:
+        cache: cache_util.LRUCache[str, int] = cache_util.LRUCache(max_size=2)
+
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        # "b" is now the least recently used
+        cache.put("c", 3)
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertEqual(len(cache), 2)
+
+        calls = []
+        self.assertEqual(cache.get_or_create("c", lambda: calls.append(1) or 4), 3)
+        self.assertEqual(cache.get_or_create("d", lambda: calls.append(1) or 4), 4)
+        self.assertEqual(len(calls), 1)
+
+        self.assertEqual(
+            cache.stats(), cache_util.CacheStats(hits=2, misses=2, size=2, max_size=2)
+        )
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats().hits, 0)
+
+    def test_lru_cache_max_bytes(self) -> None:
+        cache: cache_util.LRUCache[str, bytes] = cache_util.LRUCache(
+            max_size=10, max_bytes=10, size_of=len
+        )
+
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        self.assertEqual(cache.stats().num_bytes, 8)
+
+        # Replacing an entry updates the total
+        cache.put("b", b"12")
+        self.assertEqual(cache.stats().num_bytes, 6)
+
+        # Evicts the oldest until under the limit
+        cache.put("c", b"123456")
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.stats().num_bytes, 8)
+
+        # Entries larger than the limit are not kept
+        cache.put("d", b"12345678901")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats().num_bytes, 0)
+
+    def test_prompt_embedding_cache(self) -> None:
+        calls = []
+
+        def create() -> torch.Tensor:
+            calls.append(1)
+            return torch.full((1, 77, 8), float(len(calls)))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = cache_util.PromptEmbeddingCache(cache_dir=cache_dir, namespace="model")
+
+            first = cache.get_or_create("text", "lofi", "cpu", torch.float32, create)
+            self.assertIs(cache.get_or_create("text", "lofi", "cpu", torch.float32, create), first)
+            self.assertEqual(len(calls), 1)
+
+            # Different kind or dtype are different entries
+            cache.get_or_create("weighted", "lofi", "cpu", torch.float32, create)
+            cache.get_or_create("text", "lofi", "cpu", torch.float16, create)
+            self.assertEqual(len(calls), 3)
+
+            # A new cache with the same directory and namespace loads from disk
+            reloaded = cache_util.PromptEmbeddingCache(cache_dir=cache_dir, namespace="model")
+            loaded = reloaded.get_or_create("text", "lofi", "cpu", torch.float32, create)
+            self.assertEqual(len(calls), 3)
+            torch.testing.assert_close(loaded, first)
+
+            # But not with another namespace
+            other = cache_util.PromptEmbeddingCache(cache_dir=cache_dir, namespace="other")
+            other.get_or_create("text", "lofi", "cpu", torch.float32, create)
+            self.assertEqual(len(calls), 4)
+
+    def test_image_hash(self) -> None:
+        image = Image.open(self.TEST_DATA_PATH.parent.parent / "seed_images" / "og_beat.png")
+        image_rgb = image.convert("RGB")
+
+        self.assertEqual(cache_util.image_hash(image_rgb), cache_util.image_hash(image_rgb.copy()))
+        self.assertNotEqual(cache_util.image_hash(image), cache_util.image_hash(image_rgb))
+
+        changed = image_rgb.copy()
+        changed.putpixel((0, 0), (255, 0, 0))
+        self.assertNotEqual(cache_util.image_hash(changed), cache_util.image_hash(image_rgb))
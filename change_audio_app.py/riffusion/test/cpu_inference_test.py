@@ -0,0 +1,62 @@
+import torch
+
+from riffusion.cpu_inference import CpuOptions, CpuUNet, optimize_for_cpu, quantize_text_encoder
+from riffusion.weights_cache import ShapeTracedUNet
+
+from .test_case import TestCase
+from .weights_cache_test import FakeUNet
+
+
+class CpuInferenceTest(TestCase):
+    """
+    Test riffusion.cpu_inference with a small stand-in UNet.
+    """
+
+    def test_cpu_unet(self) -> None:
+        unet = FakeUNet().eval()
+        sample = torch.randn(2, 4, 8, 16)
+        encoder_hidden_states = torch.randn(2, 77, 32)
+
+        with torch.no_grad():
+            expected = unet(sample, 500, encoder_hidden_states).sample
+
+            # Under bfloat16 autocast samples come back in the input dtype
+            output = CpuUNet(unet, autocast=True)(
+                sample, 500, encoder_hidden_states=encoder_hidden_states
+            )
+        self.assertEqual(output.sample.dtype, torch.float32)
+        torch.testing.assert_close(output.sample, expected, atol=0.1, rtol=0.05)
+
+        with torch.no_grad():
+            output = CpuUNet(unet, autocast=False)(
+                sample, 500, encoder_hidden_states=encoder_hidden_states
+            )
+        torch.testing.assert_close(output.sample, expected)
+
+    def test_optimize_for_cpu(self) -> None:
+        unet = FakeUNet().eval()
+        text_encoder = torch.nn.Sequential(torch.nn.Linear(32, 32)).eval()
+
+        options = CpuOptions(unet_mode="trace", num_threads=torch.get_num_threads())
+        optimized_unet, optimized_encoder = optimize_for_cpu(unet, text_encoder, options)
+
+        # Traced per shape on first use, and the text encoder is a quantized copy
+        self.assertIsInstance(optimized_unet, ShapeTracedUNet)
+        self.assertEqual(optimized_unet.traced, {})
+        self.assertIsNot(optimized_encoder, text_encoder)
+        self.assertIsInstance(text_encoder[0], torch.nn.Linear)
+
+        inputs = torch.randn(3, 32)
+        with torch.no_grad():
+            torch.testing.assert_close(
+                optimized_encoder(inputs), text_encoder(inputs), atol=0.05, rtol=0.05
+            )
+
+        with self.assertRaises(ValueError):
+            CpuOptions(unet_mode="jit")
+
+    def test_quantize_text_encoder(self) -> None:
+        text_encoder = torch.nn.Sequential(torch.nn.Linear(16, 16))
+        quantized = quantize_text_encoder(text_encoder)
+        self.assertNotIsInstance(quantized[0], torch.nn.Linear)
+        self.assertEqual(quantized(torch.randn(2, 16)).shape, (2, 16))
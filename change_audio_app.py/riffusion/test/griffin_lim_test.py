@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+
+from riffusion.griffin_lim import GriffinLim
+
+from .test_case import TestCase
+
+
+class GriffinLimTest(TestCase):
+    """
+    Test riffusion.griffin_lim
+    """
+
+    N_FFT = 512
+    HOP_LENGTH = 128
+
+    def make_specgram(self) -> torch.Tensor:
+        """
+        Compute the STFT of a short stereo chord.
+        """
+        sample_rate = 16000
+        t = np.arange(sample_rate) / sample_rate
+        waveform = np.stack(
+            [
+                np.sin(2 * np.pi * 440 * t) + 0.5 * np.sin(2 * np.pi * 660 * t),
+                np.sin(2 * np.pi * 330 * t) + 0.3 * np.sin(2 * np.pi * 990 * t),
+            ]
+        ).astype(np.float32)
+
+        return torch.stft(
+            torch.from_numpy(waveform),
+            n_fft=self.N_FFT,
+            hop_length=self.HOP_LENGTH,
+            window=torch.hann_window(self.N_FFT),
+            return_complex=True,
+        )
+
+    def test_random_init(self) -> None:
+        specgram = self.make_specgram()
+
+        griffin_lim = GriffinLim(n_fft=self.N_FFT, n_iter=32, hop_length=self.HOP_LENGTH)
+        result = griffin_lim.reconstruct(specgram.abs())
+
+        self.assertEqual(result.num_iters, 32)
+        self.assertEqual(result.phase.shape, specgram.shape)
+        self.assertEqual(result.waveform.shape[0], 2)
+        self.assertLess(result.spectral_convergence, 0.5)
+
+        # The module call returns just the waveform
+        self.assertEqual(griffin_lim(specgram.abs()).shape, result.waveform.shape)
+
+    def test_warm_start(self) -> None:
+        specgram = self.make_specgram()
+
+        griffin_lim = GriffinLim(
+            n_fft=self.N_FFT,
+            n_iter=32,
+            hop_length=self.HOP_LENGTH,
+            tolerance=1e-2,
+        )
+
+        cold = griffin_lim.reconstruct(specgram.abs())
+        warm = griffin_lim.reconstruct(specgram.abs(), init_phase=specgram)
+
+        # Starting from the true phase converges right away to a much lower error
+        self.assertLess(warm.num_iters, cold.num_iters)
+        self.assertLess(warm.spectral_convergence, cold.spectral_convergence)
+        self.assertLess(warm.spectral_convergence, 1e-2)
+
+        with self.assertRaises(ValueError):
+            griffin_lim.reconstruct(specgram.abs(), init_phase=specgram[:1])
@@ -1,5 +1,6 @@
 import numpy as np
 import pydub
+from PIL import Image
 
 from riffusion.spectrogram_converter import SpectrogramConverter
 from riffusion.spectrogram_params import SpectrogramParams
@@ -63,3 +64,39 @@ class ImageUtilTest(TestCase):
         # Make sure all values are somewhat similar, but allow for discretization error
         # TODO(hayk): Investigate error more closely
         self.assertTrue(np.allclose(spectrogram, spectrogram_reversed, rtol=0.15))
+
+    def test_spectrogram_from_image_lookup(self) -> None:
+        image_path = (
+            self.TEST_DATA_PATH
+            / "tired_traveler"
+            / "images"
+            / "clip_2_start_103694_ms_duration_5678_ms_stereo.png"
+        )
+        image = Image.open(image_path)
+
+        for stereo in (False, True):
+            spectrogram = image_util.spectrogram_from_image(
+                image, power=0.25, stereo=stereo, max_value=1e6
+            )
+
+            # Compare against the direct float computation
+            pixels = np.array(image.convert("RGB").transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+            pixels = pixels.transpose(2, 0, 1)[[1, 2] if stereo else [0]].astype(np.float32)
+            expected = np.power((255 - pixels) / 255, 1 / 0.25) * 1e6
+
+            self.assertEqual(spectrogram.dtype, np.float32)
+            self.assertEqual(spectrogram.shape, expected.shape)
+            self.assertTrue(np.allclose(spectrogram, expected, rtol=1e-6))
+
+        # Batched conversion writes into a caller supplied buffer
+        out = np.zeros((3, 2, image.height, image.width), dtype=np.float32)
+        spectrograms = image_util.spectrograms_from_images(
+            [image] * 3, power=0.25, stereo=True, max_value=1e6, out=out
+        )
+        self.assertIs(spectrograms, out)
+        for batch_spectrogram in spectrograms:
+            self.assertTrue(np.array_equal(batch_spectrogram, spectrogram))
+
+        # An empty batch gives an empty array
+        empty = image_util.spectrograms_from_images([], stereo=True)
+        self.assertEqual(empty.shape, (0, 2, 0, 0))
@@ -0,0 +1,180 @@
+import threading
+import time
+import typing as T
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from riffusion.datatypes import InferenceInput, PromptInput
+from riffusion.inference_scheduler import BoundedExecutor, InferenceScheduler
+
+from .test_case import TestCase
+
+
+class FakePipeline:
+    """
+    Records the batches it is called with and returns images tagged with the alpha.
+    """
+
+    def __init__(self, delay_s: float = 0.0):
+        self.delay_s = delay_s
+        self.batches: T.List[T.List[InferenceInput]] = []
+        self.lock = threading.Lock()
+
+    def riffuse_batch(self, inputs_list, init_image, mask_image=None):
+        with self.lock:
+            self.batches.append(list(inputs_list))
+        time.sleep(self.delay_s)
+        if any(inputs.alpha < 0 for inputs in inputs_list):
+            raise ValueError("negative alpha")
+        return [Image.new("L", (1, 1), int(inputs.alpha * 100)) for inputs in inputs_list]
+
+
+def make_inputs(
+    alpha: float, num_inference_steps: int = 50, scheduler: T.Optional[str] = None
+) -> InferenceInput:
+    prompt = PromptInput(prompt="lofi", seed=1)
+    return InferenceInput(
+        start=prompt,
+        end=prompt,
+        alpha=alpha,
+        num_inference_steps=num_inference_steps,
+        scheduler=scheduler,
+    )
+
+
+class InferenceSchedulerTest(TestCase):
+    """
+    Test riffusion.inference_scheduler.InferenceScheduler with a fake pipeline.
+    """
+
+    def test_batches_compatible_requests(self) -> None:
+        pipeline = FakePipeline()
+        scheduler = InferenceScheduler(
+            pipeline, max_batch_size=3, max_wait_s=0.5  # type: ignore[arg-type]
+        )
+        init_image = Image.new("RGB", (8, 8))
+
+        try:
+            # Five compatible requests, one with a different step count and one with a different
+            # scheduler, all at once
+            inputs_list = [make_inputs(i / 10) for i in range(5)] + [
+                make_inputs(0.8, scheduler="DPMSolverMultistepScheduler"),
+                make_inputs(0.9, 20),
+            ]
+            with ThreadPoolExecutor(max_workers=len(inputs_list)) as pool:
+                images = list(
+                    pool.map(lambda inputs: scheduler.riffuse(inputs, init_image), inputs_list)
+                )
+        finally:
+            scheduler.stop()
+
+        # Every caller gets its own result
+        for inputs, image in zip(inputs_list, images):
+            self.assertEqual(image.getpixel((0, 0)), int(inputs.alpha * 100))
+
+        # Batches are bounded and never mix step counts or schedulers
+        self.assertEqual(sum(len(batch) for batch in pipeline.batches), len(inputs_list))
+        self.assertLess(len(pipeline.batches), len(inputs_list))
+        for batch in pipeline.batches:
+            self.assertLessEqual(len(batch), 3)
+            self.assertEqual(len({inputs.num_inference_steps for inputs in batch}), 1)
+            self.assertEqual(len({inputs.scheduler for inputs in batch}), 1)
+
+    def test_errors_propagate(self) -> None:
+        scheduler = InferenceScheduler(FakePipeline(), max_wait_s=0.0)  # type: ignore[arg-type]
+        try:
+            with self.assertRaises(ValueError):
+                scheduler.riffuse(make_inputs(-1.0), Image.new("RGB", (8, 8)))
+
+            # The worker keeps serving afterwards
+            image = scheduler.riffuse(make_inputs(0.5), Image.new("RGB", (8, 8)))
+            self.assertEqual(image.getpixel((0, 0)), 50)
+        finally:
+            scheduler.stop()
+
+        with self.assertRaises(RuntimeError):
+            scheduler.submit(make_inputs(0.5), Image.new("RGB", (8, 8)))
+
+    def test_stop_resolves_requests(self) -> None:
+        scheduler = InferenceScheduler(
+            FakePipeline(delay_s=0.01), max_batch_size=2, max_wait_s=0.0  # type: ignore[arg-type]
+        )
+        init_image = Image.new("RGB", (8, 8))
+
+        def submit_until_stopped() -> T.List[T.Any]:
+            futures = []
+            while True:
+                try:
+                    futures.append(scheduler.submit(make_inputs(0.5), init_image))
+                except RuntimeError:
+                    return futures
+
+        # Stop while other threads keep submitting
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            submitters = [pool.submit(submit_until_stopped) for _ in range(4)]
+            time.sleep(0.05)
+            scheduler.stop()
+            futures = [future for submitter in submitters for future in submitter.result()]
+
+        # Every accepted request was either run or cancelled, none is left waiting
+        self.assertGreater(len(futures), 0)
+        for future in futures:
+            self.assertTrue(future.done())
+
+    def test_bounded_executor(self) -> None:
+        executor = BoundedExecutor(max_workers=1, max_pending=2)
+        release = threading.Event()
+
+        try:
+            first = executor.submit(release.wait)
+            second = executor.submit(lambda: 2)
+
+            # A third submit blocks until a slot frees up
+            submitted = threading.Event()
+
+            def submit_third() -> None:
+                executor.submit(lambda: 3)
+                submitted.set()
+
+            thread = threading.Thread(target=submit_third)
+            thread.start()
+            self.assertFalse(submitted.wait(timeout=0.2))
+
+            release.set()
+            self.assertTrue(submitted.wait(timeout=5))
+            thread.join()
+
+            self.assertTrue(first.result())
+            self.assertEqual(second.result(), 2)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    def test_bounded_executor_streams(self) -> None:
+        executor = BoundedExecutor(max_workers=1, max_pending=1)
+
+        try:
+            # A stream holds the only slot from its first chunk until it is closed
+            stream = executor.iter_bounded(iter([b"a", b"b"]))
+            self.assertEqual(next(stream), b"a")
+
+            submitted = threading.Event()
+
+            def submit() -> None:
+                executor.submit(lambda: None).result()
+                submitted.set()
+
+            thread = threading.Thread(target=submit)
+            thread.start()
+            self.assertFalse(submitted.wait(timeout=0.2))
+
+            stream.close()
+            self.assertTrue(submitted.wait(timeout=5))
+            thread.join()
+
+            # Exhausting a stream releases its slot as well
+            self.assertEqual(list(executor.iter_bounded([1, 2])), [1, 2])
+            self.assertEqual(executor.submit(lambda: 3).result(), 3)
+        finally:
+            executor.shutdown()
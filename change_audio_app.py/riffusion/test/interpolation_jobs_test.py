@@ -0,0 +1,132 @@
+import typing as T
+
+import pydub
+from PIL import Image
+
+from riffusion.datatypes import InferenceInput, InferenceOutput, InterpolationInput, PromptInput
+from riffusion.inference_scheduler import BoundedExecutor, InferenceScheduler
+from riffusion.interpolation_jobs import InterpolationJobManager
+
+from .test_case import TestCase
+
+
+class FakePipeline:
+    """
+    Returns images whose width is one plus the index of the alpha in tenths.
+    """
+
+    def __init__(self) -> None:
+        self.batches: T.List[T.List[InferenceInput]] = []
+
+    def riffuse_batch(self, inputs_list, init_image, mask_image=None):
+        self.batches.append(list(inputs_list))
+        if any(inputs.start.prompt == "fail" for inputs in inputs_list):
+            raise ValueError("bad prompt")
+        return [Image.new("L", (1 + round(inputs.alpha * 10), 4)) for inputs in inputs_list]
+
+
+def reconstruct_audio(image: Image.Image) -> pydub.AudioSegment:
+    # One second of silence per pixel of width
+    return pydub.AudioSegment.silent(duration=1000 * image.width, frame_rate=8000)
+
+
+def encode_output(image: Image.Image, segment: pydub.AudioSegment) -> InferenceOutput:
+    return InferenceOutput(image=f"{image.width}", audio="", duration_s=segment.duration_seconds)
+
+
+class InterpolationJobsTest(TestCase):
+    """
+    Test riffusion.interpolation_jobs with a fake pipeline.
+    """
+
+    def setUp(self) -> None:
+        self.pipeline = FakePipeline()
+        self.scheduler = InferenceScheduler(
+            self.pipeline, max_batch_size=4, max_wait_s=0.1  # type: ignore[arg-type]
+        )
+        self.pool = BoundedExecutor(max_workers=2)
+        self.jobs = InterpolationJobManager(
+            self.scheduler,
+            reconstruct_audio=reconstruct_audio,
+            encode_output=encode_output,
+            postprocess_pool=self.pool,
+            max_jobs=2,
+        )
+
+    def tearDown(self) -> None:
+        self.scheduler.stop()
+        self.pool.shutdown()
+
+    def make_inputs(self, prompt: str = "lofi", **kwargs: T.Any) -> InterpolationInput:
+        return InterpolationInput(
+            start=PromptInput(prompt=prompt, seed=1),
+            end=PromptInput(prompt="jazz", seed=2),
+            **kwargs,
+        )
+
+    def test_alphas(self) -> None:
+        inputs = self.make_inputs(num_interpolation_steps=5)
+        self.assertEqual(inputs.alphas(), [0.0, 0.25, 0.5, 0.75, 1.0])
+
+        # Values above one bunch the alphas around the middle
+        alphas = self.make_inputs(num_interpolation_steps=5, alpha_power=2.0).alphas()
+        self.assertEqual(alphas, [0.0, 0.375, 0.5, 0.625, 1.0])
+
+        self.assertEqual(self.make_inputs(num_interpolation_steps=1).alphas(), [0.0])
+
+        inference_inputs = inputs.inference_inputs()
+        self.assertEqual([i.alpha for i in inference_inputs], inputs.alphas())
+        self.assertTrue(all(i.num_inference_steps == 50 for i in inference_inputs))
+
+    def test_job(self) -> None:
+        inputs = self.make_inputs(num_interpolation_steps=6, crossfade_s=0.5)
+        job = self.jobs.submit(inputs, init_image=Image.new("RGB", (8, 8)))
+
+        events = list(job.iter_events(timeout=5))
+        self.assertEqual(job.status, "done")
+
+        # One clip event per alpha in any order, then the result
+        self.assertEqual([e.event_id for e in events], list(range(7)))
+        self.assertEqual({e.data["index"] for e in events[:-1]}, set(range(6)))
+        self.assertTrue(all(e.name == "clip" for e in events[:-1]))
+        self.assertEqual(events[-1].name, "result")
+
+        # All alphas went through the scheduler in batches
+        self.assertEqual(sum(len(batch) for batch in self.pipeline.batches), 6)
+        self.assertLess(len(self.pipeline.batches), 6)
+
+        # Widths 1, 3, 5, 7, 9, 11 stitched with five half second crossfades
+        self.assertEqual(job.result, InferenceOutput(image="36", audio="", duration_s=33.5))
+
+        snapshot = job.to_dict()
+        self.assertEqual(snapshot["num_clips_done"], 6)
+        self.assertEqual(snapshot["clips"][1]["image"], "3")
+
+        # Resuming after an event id only gives the later ones
+        self.assertEqual(list(job.iter_events(start=5)), events[5:])
+
+    def test_failed_job(self) -> None:
+        job = self.jobs.submit(self.make_inputs("fail"), init_image=Image.new("RGB", (8, 8)))
+
+        events = list(job.iter_events(timeout=5))
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(events[-1].name, "error")
+        self.assertIn("bad prompt", events[-1].data["message"])
+
+        with self.assertRaises(ValueError):
+            self.jobs.submit(
+                self.make_inputs(num_interpolation_steps=0), init_image=Image.new("RGB", (8, 8))
+            )
+
+    def test_evicts_finished_jobs(self) -> None:
+        jobs = [
+            self.jobs.submit(self.make_inputs(), init_image=Image.new("RGB", (8, 8)))
+            for _ in range(2)
+        ]
+        for job in jobs:
+            list(job.iter_events(timeout=5))
+
+        newest = self.jobs.submit(self.make_inputs(), init_image=Image.new("RGB", (8, 8)))
+        self.assertIsNone(self.jobs.get(jobs[0].job_id))
+        self.assertIs(self.jobs.get(jobs[1].job_id), jobs[1])
+        self.assertIs(self.jobs.get(newest.job_id), newest)
@@ -0,0 +1,48 @@
+import threading
+
+from riffusion.util.loading_util import BackgroundLoader
+
+from .test_case import TestCase
+
+
+class LoadingUtilTest(TestCase):
+    """
+    Test riffusion.util.loading_util
+    """
+
+    def test_background_loader(self) -> None:
+        release = threading.Event()
+        calls = []
+
+        def load() -> str:
+            calls.append(1)
+            release.wait()
+            return "model"
+
+        loader = BackgroundLoader(load)
+        self.assertEqual(loader.status, "not_started")
+
+        loader.start().start()
+        self.assertEqual(loader.status, "loading")
+        self.assertFalse(loader.ready)
+        with self.assertRaises(TimeoutError):
+            loader.get(timeout=0.05)
+
+        release.set()
+        self.assertEqual(loader.get(timeout=5), "model")
+        self.assertTrue(loader.ready)
+        self.assertEqual(loader.status, "ready")
+        self.assertEqual(len(calls), 1)
+
+    def test_background_loader_error(self) -> None:
+        def load() -> None:
+            raise RuntimeError("no weights")
+
+        # Getting starts the load
+        loader = BackgroundLoader(load)
+        with self.assertRaises(RuntimeError):
+            loader.get(timeout=5)
+
+        self.assertEqual(loader.status, "failed")
+        self.assertFalse(loader.ready)
+        self.assertIsInstance(loader.error, RuntimeError)
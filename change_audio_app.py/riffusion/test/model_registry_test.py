@@ -0,0 +1,159 @@
+import contextlib
+import importlib.util
+import io
+import typing as T
+import unittest
+from unittest import mock
+
+import torch
+
+from .test_case import TestCase
+
+
+def make_components() -> T.Dict[str, T.Any]:
+    """
+    Tiny randomly initialized modules with the layout of a stable diffusion checkpoint.
+    """
+    from diffusers import AutoencoderKL, DDIMScheduler, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(0)
+    return dict(
+        unet=UNet2DConditionModel(
+            block_out_channels=(32, 64),
+            layers_per_block=1,
+            sample_size=8,
+            in_channels=4,
+            out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+        ),
+        vae=AutoencoderKL(
+            block_out_channels=(32, 64),
+            in_channels=3,
+            out_channels=3,
+            down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+            up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+            latent_channels=4,
+        ),
+        text_encoder=CLIPTextModel(
+            CLIPTextConfig(
+                hidden_size=32,
+                intermediate_size=37,
+                num_attention_heads=4,
+                num_hidden_layers=2,
+                vocab_size=1000,
+            )
+        ),
+        tokenizer=None,
+        scheduler=DDIMScheduler(steps_offset=1),
+        safety_checker=None,
+        feature_extractor=None,
+    )
+
+
+class FakeLoadedPipeline:
+    """
+    What StableDiffusionPipeline.from_pretrained returns, as far as the registry uses it.
+    """
+
+    def __init__(self, components: T.Dict[str, T.Any]):
+        self.components = components
+
+    def to(self, device: str) -> "FakeLoadedPipeline":
+        return self
+
+
+@unittest.skipUnless(importlib.util.find_spec("diffusers"), "requires diffusers")
+class ModelRegistryTest(TestCase):
+    """
+    Test riffusion.model_registry.ModelRegistry with tiny stand-in modules.
+    """
+
+    def setUp(self) -> None:
+        from riffusion import model_registry
+
+        self.model_registry = model_registry
+
+        patcher = mock.patch.object(
+            model_registry.StableDiffusionPipeline,
+            "from_pretrained",
+            side_effect=lambda *args, **kwargs: FakeLoadedPipeline(make_components()),
+        )
+        self.from_pretrained = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_load_per_key(self) -> None:
+        registry = self.model_registry.ModelRegistry()
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            first = registry.components("model", device="cpu", dtype=torch.float32)
+            second = registry.components("model", device="cpu", dtype=torch.float32)
+
+            # float16 falls back to float32 on the CPU, which is the same key
+            self.assertEqual(
+                registry.key("model", device="cpu", dtype=torch.float16),
+                ("model", "cpu", torch.float32),
+            )
+            fallback = registry.components("model", device="cpu", dtype=torch.float16)
+
+        self.assertEqual(self.from_pretrained.call_count, 1)
+        self.assertEqual(self.from_pretrained.call_args.kwargs["torch_dtype"], torch.float32)
+        for components in (second, fallback):
+            self.assertIs(components["unet"], first["unet"])
+
+        # Loaded already, so there was nothing to fall back for
+        self.assertNotIn("Falling back", stdout.getvalue())
+
+        # Other checkpoints load their own modules
+        other = registry.components("other", device="cpu", dtype=torch.float32)
+        self.assertEqual(self.from_pretrained.call_count, 2)
+        self.assertIsNot(other["unet"], first["unet"])
+
+        # Clearing drops the loaded modules
+        registry.clear()
+        registry.components("model", device="cpu", dtype=torch.float32)
+        self.assertEqual(self.from_pretrained.call_count, 3)
+
+    def test_fallback_warning(self) -> None:
+        registry = self.model_registry.ModelRegistry()
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            for _ in range(3):
+                registry.riffusion("model", device="cpu", dtype=torch.float16)
+
+        self.assertEqual(stdout.getvalue().count("Falling back"), 1)
+        self.assertEqual(self.from_pretrained.call_count, 1)
+
+    def test_views_share_modules(self) -> None:
+        registry = self.model_registry.ModelRegistry()
+        components = registry.components("model", device="cpu", dtype=torch.float32)
+
+        views = [
+            registry.txt2img("model", device="cpu", dtype=torch.float32),
+            registry.img2img("model", device="cpu", dtype=torch.float32),
+            registry.riffusion("model", device="cpu", dtype=torch.float32, use_traced_unet=False),
+            registry.riffusion("model", device="cpu", dtype=torch.float32, use_traced_unet=False),
+        ]
+        self.assertEqual(self.from_pretrained.call_count, 1)
+
+        for view in views:
+            for name in ("unet", "vae", "text_encoder"):
+                self.assertIs(getattr(view, name), components[name])
+
+        # Each view has its own scheduler, with the config of the checkpoint
+        schedulers = [view.scheduler for view in views] + [components["scheduler"]]
+        self.assertEqual(len({id(scheduler) for scheduler in schedulers}), len(schedulers))
+        for view in views:
+            self.assertIsInstance(view.scheduler, type(components["scheduler"]))
+            self.assertEqual(view.scheduler.config.steps_offset, 1)
+
+        # Or a scheduler of another class by name
+        view = registry.txt2img(
+            "model", device="cpu", dtype=torch.float32, scheduler="DPMSolverMultistepScheduler"
+        )
+        self.assertEqual(type(view.scheduler).__name__, "DPMSolverMultistepScheduler")
+        self.assertIs(view.unet, components["unet"])
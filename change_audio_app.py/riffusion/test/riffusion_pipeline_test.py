@@ -0,0 +1,192 @@
+import importlib.util
+import types
+import typing as T
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from PIL import Image
+
+from riffusion.datatypes import InferenceInput, PromptInput
+
+from .test_case import TestCase
+from .weights_cache_test import FakeUNet
+
+
+class FakeLatentDistribution:
+    """
+    Stand-in for the diagonal gaussian latent distribution of the VAE.
+    """
+
+    def __init__(self, parameters: torch.Tensor):
+        self.mean, logvar = parameters.chunk(2, dim=1)
+        self.std = torch.exp(0.5 * logvar.clamp(-30.0, 20.0))
+
+    def sample(self, generator: T.Optional[torch.Generator] = None) -> torch.Tensor:
+        noise = torch.randn(
+            self.mean.shape, generator=generator, device=self.mean.device, dtype=self.mean.dtype
+        )
+        return self.mean + self.std * noise
+
+
+class FakeVAE(torch.nn.Module):
+    """
+    Stand-in for AutoencoderKL with single convolutions that downsample by 8.
+    """
+
+    config = types.SimpleNamespace(block_out_channels=[8, 8, 8, 8])
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.encoder = torch.nn.Conv2d(3, 8, kernel_size=8, stride=8)
+        self.decoder = torch.nn.ConvTranspose2d(4, 3, kernel_size=8, stride=8)
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.parameters()).device
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return next(self.parameters()).dtype
+
+    def encode(self, image: torch.Tensor) -> T.Any:
+        return types.SimpleNamespace(latent_dist=FakeLatentDistribution(self.encoder(image)))
+
+    def decode(self, latents: torch.Tensor) -> T.Any:
+        return types.SimpleNamespace(sample=torch.tanh(self.decoder(latents)))
+
+
+def make_pipeline(scheduler: T.Optional[T.Any] = None) -> T.Any:
+    """
+    Riffusion pipeline over stand-in modules, with prompt embeddings derived from the prompt
+    text instead of a text encoder.
+    """
+    from diffusers import DDIMScheduler
+
+    from riffusion.riffusion_pipeline import RiffusionPipeline
+
+    class FakeTextPipeline(RiffusionPipeline):
+        def embed_text(self, text: str) -> torch.Tensor:
+            generator = torch.Generator().manual_seed(sum(text.encode()))
+            return torch.randn(1, 77, 32, generator=generator)
+
+    if scheduler is None:
+        scheduler = DDIMScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            clip_sample=False,
+            set_alpha_to_one=False,
+            steps_offset=1,
+        )
+
+    torch.manual_seed(0)
+    pipeline = FakeTextPipeline(
+        vae=FakeVAE().eval(),
+        text_encoder=None,
+        tokenizer=None,
+        unet=FakeUNet().eval(),
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def make_init_image() -> Image.Image:
+    pixels = np.random.default_rng(0).integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+@unittest.skipUnless(importlib.util.find_spec("diffusers"), "requires diffusers")
+class RiffusionPipelineTest(TestCase):
+    """
+    Test riffusion.riffusion_pipeline.RiffusionPipeline with stand-in models.
+    """
+
+    def test_riffuse_batch(self) -> None:
+        pipeline = make_pipeline()
+        init_image = make_init_image()
+
+        start = PromptInput(prompt="lofi", seed=1, denoising=0.4, guidance=7.0)
+        end = PromptInput(prompt="jazz", seed=2, denoising=0.8, guidance=3.0)
+
+        # Alphas at different strengths, so the batch runs several denoising groups, and a
+        # different start seed with guidance off
+        inputs_list = [
+            InferenceInput(start=start, end=end, alpha=alpha, num_inference_steps=10)
+            for alpha in (0.0, 0.5, 1.0, 0.5)
+        ]
+        inputs_list[3] = InferenceInput(
+            start=PromptInput(prompt="lofi", seed=3, denoising=0.6, guidance=1.0),
+            end=PromptInput(prompt="jazz", seed=2, denoising=0.6, guidance=1.0),
+            alpha=0.25,
+            num_inference_steps=10,
+        )
+        strengths = {
+            (1 - inputs.alpha) * inputs.start.denoising + inputs.alpha * inputs.end.denoising
+            for inputs in inputs_list
+        }
+        self.assertGreater(len(strengths), 2)
+
+        images = pipeline.riffuse_batch(inputs_list, init_image=init_image, use_reweighting=False)
+        self.assertEqual(len(images), len(inputs_list))
+
+        # The same images as one call per input
+        for inputs, image in zip(inputs_list, images):
+            expected = pipeline.riffuse(inputs, init_image=init_image, use_reweighting=False)
+            self.assertEqual(image.size, expected.size)
+            np.testing.assert_allclose(
+                np.asarray(image, dtype=np.int16), np.asarray(expected, dtype=np.int16), atol=1
+            )
+
+        # Inputs of a batch must share the number of steps
+        with self.assertRaises(ValueError):
+            pipeline.riffuse_batch(
+                [inputs_list[0], InferenceInput(start=start, end=end, alpha=0.0)],
+                init_image=init_image,
+            )
+
+    def test_riffuse_schedulers(self) -> None:
+        import diffusers
+
+        init_image = make_init_image()
+        prompt = PromptInput(prompt="lofi", seed=1, denoising=0.5, guidance=1.0)
+
+        # Heun takes two timesteps per inference step
+        for name, order in (("DPMSolverMultistepScheduler", 1), ("HeunDiscreteScheduler", 2)):
+            with self.subTest(scheduler=name):
+                pipeline = make_pipeline()
+                inputs = InferenceInput(
+                    start=prompt, end=prompt, alpha=0.0, num_inference_steps=10, scheduler=name
+                )
+
+                # t_start of 5 for a strength of 0.5 with a steps_offset of 1
+                expected = pipeline.get_scheduler(name)
+                expected.set_timesteps(10)
+                self.assertEqual(expected.order, order)
+                expected_timesteps = expected.timesteps[5 * order :].tolist()
+
+                unet_timesteps: T.List[float] = []
+                pipeline.unet.register_forward_pre_hook(
+                    lambda module, args: unet_timesteps.append(float(args[1]))
+                )
+
+                scheduler_class = getattr(diffusers, name)
+                with mock.patch.object(
+                    scheduler_class,
+                    "add_noise",
+                    autospec=True,
+                    side_effect=scheduler_class.add_noise,
+                ) as add_noise:
+                    image = pipeline.riffuse(inputs, init_image=init_image, use_reweighting=False)
+
+                self.assertEqual(image.size, init_image.size)
+                self.assertEqual(len(unet_timesteps), 5 * order - order + 1)
+                np.testing.assert_allclose(unet_timesteps, expected_timesteps)
+
+                # The init latents are noised to the first timestep that is denoised
+                noise_timesteps = add_noise.call_args_list[0].args[3]
+                np.testing.assert_allclose(noise_timesteps.tolist(), expected_timesteps[:1])
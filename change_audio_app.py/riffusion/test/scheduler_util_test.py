@@ -0,0 +1,38 @@
+import importlib.util
+import unittest
+
+from riffusion.util import scheduler_util
+
+from .test_case import TestCase
+
+
+class SchedulerUtilTest(TestCase):
+    """
+    Test riffusion.util.scheduler_util
+    """
+
+    def test_get_preset(self) -> None:
+        preset = scheduler_util.get_preset("fast")
+        self.assertEqual(preset.scheduler, "DPMSolverMultistepScheduler")
+        self.assertLess(preset.num_inference_steps, 50)
+
+        # The quality preset keeps the scheduler of the checkpoint
+        self.assertIsNone(scheduler_util.get_preset("quality").scheduler)
+
+        with self.assertRaises(ValueError):
+            scheduler_util.get_preset("fastest")
+
+    @unittest.skipUnless(importlib.util.find_spec("diffusers"), "requires diffusers")
+    def test_get_scheduler(self) -> None:
+        from diffusers import DDIMScheduler
+
+        config = DDIMScheduler(steps_offset=1).config
+        for name in scheduler_util.SCHEDULER_OPTIONS:
+            scheduler = scheduler_util.get_scheduler(name, config=config)
+            self.assertEqual(type(scheduler).__name__, name)
+            self.assertEqual(scheduler.config.num_train_timesteps, config.num_train_timesteps)
+
+        # Only schedulers can be looked up by name
+        for name in ("NotAScheduler", "UNet2DConditionModel"):
+            with self.assertRaises(ValueError):
+                scheduler_util.get_scheduler_class(name)
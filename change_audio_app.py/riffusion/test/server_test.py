@@ -0,0 +1,80 @@
+import importlib.util
+import typing as T
+import unittest
+from unittest import mock
+
+from .test_case import TestCase
+
+
+@unittest.skipUnless(importlib.util.find_spec("flask"), "requires flask")
+class ServerTest(TestCase):
+    """
+    Test the response helpers of riffusion.server that do not need the model.
+    """
+
+    def test_iter_multipart(self) -> None:
+        from riffusion.server import iter_multipart
+
+        closed = []
+
+        def stub_chunks() -> T.Iterator[bytes]:
+            try:
+                yield b"ID3"
+                yield b"frames"
+            finally:
+                closed.append(True)
+
+        body = b"".join(
+            iter_multipart(
+                "xyz",
+                [
+                    ("metadata", "application/json", b'{"duration_s": 5.0}'),
+                    ("audio", "audio/mpeg", stub_chunks()),
+                ],
+            )
+        )
+
+        self.assertEqual(
+            body,
+            b"--xyz\r\n"
+            b'Content-Disposition: inline; name="metadata"\r\n'
+            b"Content-Type: application/json\r\n\r\n"
+            b'{"duration_s": 5.0}\r\n'
+            b"--xyz\r\n"
+            b'Content-Disposition: inline; name="audio"\r\n'
+            b"Content-Type: audio/mpeg\r\n\r\n"
+            b"ID3frames\r\n"
+            b"--xyz--\r\n",
+        )
+        self.assertEqual(closed, [True])
+
+        # Closing the body early closes the streamed part, which stops its encoder
+        closed.clear()
+        parts = iter_multipart("xyz", [("audio", "audio/mpeg", stub_chunks())])
+        next(parts)
+        next(parts)
+        parts.close()
+        self.assertEqual(closed, [True])
+
+    def test_interpolation_job_events_last_event_id(self) -> None:
+        from riffusion import server
+
+        loader = mock.Mock(ready=True)
+        jobs = mock.Mock()
+        jobs.get.return_value.finished = True
+        jobs.get.return_value.iter_events.return_value = []
+
+        with mock.patch.object(server, "MODEL_LOADER", loader), mock.patch.object(
+            server, "JOBS", jobs
+        ):
+            client = server.app.test_client()
+
+            response = client.get("/interpolation_jobs/xyz/events", headers={"Last-Event-ID": "x"})
+            self.assertEqual(response.status_code, 400)
+
+            response = client.get("/interpolation_jobs/xyz/events", headers={"Last-Event-ID": "3"})
+            self.assertEqual(response.status_code, 200)
+            response.get_data()
+            jobs.get.return_value.iter_events.assert_called_with(
+                start=4, timeout=server.SSE_KEEPALIVE_S
+            )
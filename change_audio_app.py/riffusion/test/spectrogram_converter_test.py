@@ -2,6 +2,7 @@ import dataclasses
 import typing as T
 
 import pydub
+import torch
 
 from riffusion.spectrogram_converter import SpectrogramConverter
 from riffusion.spectrogram_params import SpectrogramParams
@@ -84,3 +85,52 @@ class SpectrogramConverterTest(TestCase):
         # If debugging, load up a browser tab plotting the FFTs
         if self.DEBUG:
             fft_util.plot_ffts(segments)
+
+    def test_batch(self) -> None:
+        audio_path = (
+            self.TEST_DATA_PATH
+            / "tired_traveler"
+            / "clips"
+            / "clip_2_start_103694_ms_duration_5678_ms.wav"
+        )
+        segment = pydub.AudioSegment.from_file(audio_path)
+
+        params = SpectrogramParams(sample_rate=segment.frame_rate, stereo=True)
+        converter = SpectrogramConverter(params=params, device=self.DEVICE)
+
+        # Build a batch of differently sliced clips of the same duration
+        clips = [segment[:2000], segment[1000:3000], segment[2000:4000]]
+        spectrograms = [converter.spectrogram_from_audio(clip) for clip in clips]
+
+        segments = converter.audio_from_spectrograms(spectrograms, apply_filters=True)
+        single_segment = converter.audio_from_spectrogram(spectrograms[0], apply_filters=True)
+
+        self.assertEqual(len(segments), len(clips))
+        for batch_segment in segments:
+            self.assertEqual(batch_segment.channels, 2)
+            self.assertEqual(batch_segment.frame_rate, segment.frame_rate)
+            self.assertEqual(batch_segment.frame_count(), single_segment.frame_count())
+
+        # Mismatched shapes are rejected
+        with self.assertRaises(ValueError):
+            converter.audio_from_spectrograms([spectrograms[0], spectrograms[0][:, :, :-1]])
+
+    def test_pinv_inverse_mel(self) -> None:
+        params = SpectrogramParams()
+        converter = SpectrogramConverter(params=params, device=self.DEVICE)
+        converter_pinv = SpectrogramConverter(
+            params=dataclasses.replace(params, inverse_mel_method="pinv"),
+            device=self.DEVICE,
+        )
+
+        amplitudes_mel = torch.rand(2, params.num_frequencies, 50, device=converter.device)
+
+        expected = converter.inverse_mel_scaler(amplitudes_mel)
+        actual = converter_pinv.inverse_mel_scaler(amplitudes_mel)
+
+        self.assertEqual(expected.shape, actual.shape)
+        self.assertTrue(bool(torch.all(actual >= 0)))
+
+        # Both compute the minimum norm solution, so they should agree closely
+        relative_error = torch.linalg.norm(expected - actual) / torch.linalg.norm(expected)
+        self.assertLess(float(relative_error), 1e-3)
@@ -4,7 +4,10 @@ import typing as T
 import pydub
 from PIL import Image
 
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
+from riffusion.spectrogram_image_converter import (
+    SpectrogramImageConverter,
+    get_spectrogram_image_converter,
+)
 from riffusion.spectrogram_params import SpectrogramParams
 from riffusion.util import fft_util
 
@@ -95,3 +98,24 @@ class SpectrogramImageConverterTest(TestCase):
         # If debugging, load up a browser tab plotting the FFTs
         if self.DEBUG:
             fft_util.plot_ffts(segments)
+
+    def test_converter_cache(self) -> None:
+        params = SpectrogramParams()
+
+        converter = get_spectrogram_image_converter(params=params, device=self.DEVICE)
+
+        # Equal params share the same converter
+        self.assertIs(
+            converter,
+            get_spectrogram_image_converter(params=SpectrogramParams(), device=self.DEVICE),
+        )
+
+        # Different params get their own converter
+        other_params = dataclasses.replace(params, stereo=True)
+        other_converter = get_spectrogram_image_converter(params=other_params, device=self.DEVICE)
+        self.assertIsNot(converter, other_converter)
+        self.assertEqual(other_converter.p, other_params)
+
+    def test_empty_batch(self) -> None:
+        converter = get_spectrogram_image_converter(params=SpectrogramParams(), device=self.DEVICE)
+        self.assertEqual(converter.audio_from_spectrogram_images([]), [])
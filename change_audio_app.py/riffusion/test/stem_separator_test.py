@@ -0,0 +1,95 @@
+import importlib.util
+import threading
+import typing as T
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+import torch
+
+from riffusion import audio_splitter
+from riffusion.util import audio_util
+
+from .test_case import TestCase
+
+
+class ScaleDemucs(torch.nn.Module):
+    """
+    Stand-in for a demucs model whose sources are scaled copies of the input. Records which
+    replica ran each call.
+    """
+
+    sources = ["half", "double"]
+    samplerate = 8000
+    audio_channels = 2
+    segment = 1.0
+
+    calls: T.List[int] = []
+    calls_lock = threading.Lock()
+
+    def forward(self, waveform: torch.Tensor) -> torch.Tensor:
+        with self.calls_lock:
+            self.calls.append(id(self))
+        return torch.stack([0.5 * waveform, 2.0 * waveform], dim=1)
+
+
+@unittest.skipUnless(importlib.util.find_spec("demucs"), "requires demucs")
+class StemSeparatorTest(TestCase):
+    """
+    Test riffusion.audio_splitter.StemSeparator with a stand-in model.
+    """
+
+    def setUp(self) -> None:
+        ScaleDemucs.calls = []
+        audio_splitter._cached_stem_separator.cache_clear()
+        self.addCleanup(audio_splitter._cached_stem_separator.cache_clear)
+
+        patcher = mock.patch("demucs.pretrained.get_model", side_effect=lambda name: ScaleDemucs())
+        self.get_model = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_separate(self) -> None:
+        separator = audio_splitter.StemSeparator(device="cpu", shifts=0)
+
+        samples = np.random.default_rng(0).normal(size=(2, 2 * 8000 + 17)).astype(np.float32)
+        waveform = audio_util.Waveform(samples=samples, sample_rate=8000)
+        stems = separator.separate(waveform)
+
+        # One stem per source, in the layout of the input
+        self.assertEqual(list(stems), ["half", "double"])
+        offset = samples.mean()
+        for name, scale in (("half", 0.5), ("double", 2.0)):
+            self.assertEqual(stems[name].samples.shape, samples.shape)
+            self.assertEqual(stems[name].sample_rate, 8000)
+            np.testing.assert_allclose(
+                stems[name].samples, scale * (samples - offset) + offset, atol=1e-4
+            )
+
+    def test_replicas(self) -> None:
+        separator = audio_splitter.StemSeparator(device="cpu", num_workers=2, shifts=0)
+        self.assertEqual(self.get_model.call_count, 2)
+        replicas = {id(model) for model in separator._models.queue}
+
+        samples = np.zeros((2, 8000), dtype=np.float32)
+        samples[:, ::2] = 1.0
+        waveform = audio_util.Waveform(samples=samples, sample_rate=8000)
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(lambda _: separator.separate(waveform), range(6)))
+
+        # Every call ran on one of the replicas, which are all returned afterwards
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.get_model.call_count, 2)
+        self.assertTrue(set(ScaleDemucs.calls) <= replicas)
+        self.assertEqual(separator._models.qsize(), 2)
+
+    def test_get_stem_separator(self) -> None:
+        separator = audio_splitter.get_stem_separator(device="cpu")
+
+        # The same key shares one separator, another key loads its own
+        self.assertIs(separator, audio_splitter.get_stem_separator(device="cpu"))
+        self.assertEqual(self.get_model.call_count, 1)
+
+        other = audio_splitter.get_stem_separator(device="cpu", num_workers=2)
+        self.assertIsNot(other, separator)
+        self.assertEqual(self.get_model.call_count, 3)
@@ -0,0 +1,49 @@
+import numpy as np
+import pydub
+
+from riffusion.spectrogram_converter import SpectrogramConverter
+from riffusion.spectrogram_params import SpectrogramParams
+from riffusion.streaming_converter import StreamingSpectrogramConverter
+
+from .test_case import TestCase
+
+
+class StreamingSpectrogramConverterTest(TestCase):
+    """
+    Test riffusion.streaming_converter
+    """
+
+    def test_streaming(self) -> None:
+        audio_path = (
+            self.TEST_DATA_PATH
+            / "tired_traveler"
+            / "clips"
+            / "clip_2_start_103694_ms_duration_5678_ms.wav"
+        )
+        segment = pydub.AudioSegment.from_file(audio_path)[:3000]
+
+        params = SpectrogramParams(sample_rate=segment.frame_rate, stereo=True)
+        converter = SpectrogramConverter(params=params, device=self.DEVICE)
+        spectrogram = converter.spectrogram_from_audio(segment)
+        num_frames = spectrogram.shape[-1]
+
+        streaming = StreamingSpectrogramConverter(converter, window_frames=80, overlap_frames=8)
+
+        # Push columns in uneven pieces, audio should come out before the end of the stream
+        chunks = []
+        for start, end in [(0, 50), (50, 130), (130, 200), (200, num_frames)]:
+            chunks.extend(streaming.push(spectrogram[:, :, start:end]))
+        self.assertGreater(len(chunks), 0)
+        chunks.extend(streaming.flush())
+
+        waveform = np.concatenate(chunks, axis=-1)
+
+        # Same length as reconstructing everything at once
+        expected = converter.audio_from_spectrogram(spectrogram, apply_filters=False)
+        self.assertEqual(waveform.shape[0], 2)
+        self.assertEqual(waveform.shape[-1], (num_frames - 1) * params.hop_length)
+        self.assertEqual(waveform.shape[-1], expected.frame_count())
+        self.assertTrue(np.all(np.isfinite(waveform)))
+
+        # Nothing left after a flush
+        self.assertEqual(list(streaming.flush()), [])
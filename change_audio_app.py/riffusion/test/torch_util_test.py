@@ -0,0 +1,75 @@
+import numpy as np
+import torch
+
+from riffusion.util import torch_util
+
+from .test_case import TestCase
+
+
+def slerp_numpy(t: float, v0: np.ndarray, v1: np.ndarray, dot_threshold: float = 0.9995):
+    """
+    Reference implementation of slerp in numpy.
+    """
+    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
+    if np.abs(dot) > dot_threshold:
+        return (1 - t) * v0 + t * v1
+
+    theta_0 = np.arccos(dot)
+    theta_t = theta_0 * t
+    s0 = np.sin(theta_0 - theta_t) / np.sin(theta_0)
+    s1 = np.sin(theta_t) / np.sin(theta_0)
+    return s0 * v0 + s1 * v1
+
+
+class TorchUtilTest(TestCase):
+    """
+    Test riffusion.util.torch_util
+    """
+
+    def test_slerp(self) -> None:
+        generator = torch.Generator().manual_seed(0)
+        v0 = torch.randn(1, 4, 8, 8, generator=generator)
+        v1 = torch.randn(1, 4, 8, 8, generator=generator)
+
+        for t in (0.0, 0.3, 1.0):
+            expected = slerp_numpy(t, v0.numpy(), v1.numpy())
+
+            result = torch_util.slerp(t, v0, v1)
+            self.assertEqual(result.shape, v0.shape)
+            np.testing.assert_allclose(result.numpy(), expected, atol=1e-5)
+
+            # Numpy in, numpy out
+            result_np = torch_util.slerp(t, v0.numpy(), v1.numpy())
+            self.assertIsInstance(result_np, np.ndarray)
+            np.testing.assert_allclose(result_np, expected, atol=1e-5)
+
+        # Nearly parallel inputs are interpolated linearly
+        result = torch_util.slerp(0.5, v0, v0 * 2)
+        torch.testing.assert_close(result, v0 * 1.5)
+
+        # Half precision is computed in single precision and cast back
+        result = torch_util.slerp(0.3, v0.half(), v1.half())
+        self.assertEqual(result.dtype, torch.float16)
+        np.testing.assert_allclose(
+            result.float().numpy(), slerp_numpy(0.3, v0.numpy(), v1.numpy()), atol=1e-2
+        )
+
+    def test_slerp_batched(self) -> None:
+        generator = torch.Generator().manual_seed(0)
+        v0 = torch.randn(3, 4, 8, 8, generator=generator)
+        v1 = torch.randn(3, 4, 8, 8, generator=generator)
+        t = torch.tensor([0.0, 0.25, 0.9])
+
+        # One pair per batch element
+        result = torch_util.slerp(t, v0, v1)
+        self.assertEqual(result.shape, v0.shape)
+        for i in range(3):
+            torch.testing.assert_close(result[i], torch_util.slerp(float(t[i]), v0[i], v1[i]))
+
+        # One pair broadcast across all factors
+        result = torch_util.slerp(t, v0[:1], v1[:1])
+        self.assertEqual(result.shape, v0.shape)
+        for i in range(3):
+            torch.testing.assert_close(
+                result[i : i + 1], torch_util.slerp(float(t[i]), v0[:1], v1[:1])
+            )
@@ -0,0 +1,202 @@
+import importlib.util
+import os
+import tempfile
+import typing as T
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import torch
+
+from riffusion import weights_cache
+from riffusion.weights_cache import ShapeTracedUNet, TracedUNetCache, WeightsCache
+
+from .test_case import TestCase
+
+
+class FakeUNet(torch.nn.Module):
+    """
+    Stand-in for UNet2DConditionModel with a convolution conditioned on the inputs.
+    """
+
+    in_channels = 4
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 4, kernel_size=3, padding=1)
+        self.calls = 0
+
+    def forward(
+        self,
+        sample: torch.Tensor,
+        timestep: T.Any,
+        encoder_hidden_states: torch.Tensor,
+        return_dict: bool = True,
+    ) -> T.Any:
+        self.calls += 1
+        if not torch.is_tensor(timestep):
+            timestep = torch.tensor(timestep)
+        timestep = timestep.to(sample.dtype)
+        conditioning = encoder_hidden_states.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+        out = self.conv(sample) * timestep / 1000 + conditioning
+        if return_dict:
+            return ShapeTracedUNet.UNet2DConditionOutput(sample=out)
+        return (out,)
+
+
+class WeightsCacheTest(TestCase):
+    """
+    Test riffusion.weights_cache. The weights cache needs diffusers and safetensors, and is
+    tested with a subset of the modules of a checkpoint.
+    """
+
+    def setUp(self) -> None:
+        if importlib.util.find_spec("diffusers") and importlib.util.find_spec("safetensors"):
+            from diffusers import AutoencoderKL, UNet2DConditionModel
+            from transformers import CLIPFeatureExtractor
+
+            patcher = mock.patch.object(
+                weights_cache,
+                "_module_classes",
+                return_value=dict(
+                    unet=UNet2DConditionModel,
+                    vae=AutoencoderKL,
+                    feature_extractor=CLIPFeatureExtractor,
+                ),
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def make_components() -> T.Dict[str, T.Any]:
+        from diffusers import DPMSolverMultistepScheduler
+        from transformers import CLIPFeatureExtractor
+
+        from .model_registry_test import make_components
+
+        components = make_components()
+        components["unet"].to(torch.float16)
+        components["vae"].to(torch.float16)
+        components["feature_extractor"] = CLIPFeatureExtractor()
+        components["scheduler"] = DPMSolverMultistepScheduler.from_config(
+            components["scheduler"].config
+        )
+        return components
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("diffusers") and importlib.util.find_spec("safetensors"),
+        "requires diffusers and safetensors",
+    )
+    def test_weights_cache_round_trip(self) -> None:
+        components = self.make_components()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = WeightsCache(cache_dir)
+            self.assertIsNone(cache.load("model", dtype=torch.float16, device="cpu"))
+
+            cache.save("model", dtype=torch.float16, components=components)
+            self.assertTrue((cache.path("model", torch.float16) / "unet").is_dir())
+
+            # Saved as safetensors, and only under its dtype
+            self.assertTrue(list(cache.path("model", torch.float16).glob("*/*.safetensors")))
+            self.assertIsNone(cache.load("model", dtype=torch.float32, device="cpu"))
+
+            loaded = cache.load("model", dtype=torch.float16, device="cpu")
+            assert loaded is not None
+
+        for name in ("unet", "vae"):
+            self.assertEqual(loaded[name].dtype, torch.float16)
+            state = components[name].state_dict()
+            for key, value in loaded[name].state_dict().items():
+                torch.testing.assert_close(value, state[key])
+
+        # The scheduler class is restored, not the default of the checkpoint
+        self.assertIsInstance(loaded["scheduler"], type(components["scheduler"]))
+        self.assertEqual(loaded["scheduler"].config.steps_offset, 1)
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("diffusers") and importlib.util.find_spec("safetensors"),
+        "requires diffusers and safetensors",
+    )
+    def test_weights_cache_failed_save(self) -> None:
+        components = self.make_components()
+
+        # The second module fails to save, after the first one was written
+        components["vae"] = mock.Mock()
+        components["vae"].save_pretrained.side_effect = OSError("disk full")
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = WeightsCache(cache_dir)
+            with self.assertRaises(OSError):
+                cache.save("model", dtype=torch.float16, components=components)
+
+            # Nothing partial is left behind to be loaded
+            self.assertEqual(list(Path(cache_dir).iterdir()), [])
+            self.assertIsNone(cache.load("model", dtype=torch.float16, device="cpu"))
+
+    def test_checkpoint_id(self) -> None:
+        # Hub checkpoints are their own id
+        self.assertEqual(weights_cache.checkpoint_id("riffusion/model"), "riffusion/model")
+
+        with tempfile.TemporaryDirectory() as checkpoint, tempfile.TemporaryDirectory() as cache:
+            model_index = Path(checkpoint, "model_index.json")
+            model_index.write_text("{}")
+            os.utime(model_index, ns=(1_000_000_000, 1_000_000_000))
+
+            first_id = weights_cache.checkpoint_id(checkpoint)
+            first_path = WeightsCache(cache).path(checkpoint, torch.float16)
+            self.assertEqual(weights_cache.checkpoint_id(checkpoint), first_id)
+
+            # Retrained weights get new cache entries
+            os.utime(model_index, ns=(2_000_000_000, 2_000_000_000))
+            self.assertNotEqual(weights_cache.checkpoint_id(checkpoint), first_id)
+            self.assertNotEqual(WeightsCache(cache).path(checkpoint, torch.float16), first_path)
+
+    def test_traced_unet_cache(self) -> None:
+        unet = FakeUNet().eval()
+        shapes = ((2, 4, 8, 16), (2, 77, 32))
+
+        sample = torch.randn(shapes[0])
+        encoder_hidden_states = torch.randn(shapes[1])
+        timestep = torch.tensor(500)
+        with torch.no_grad():
+            expected = unet(sample, timestep, encoder_hidden_states).sample
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TracedUNetCache(cache_dir)
+            traced = cache.get_or_trace(unet, checkpoint="model", shapes=shapes)
+
+            path = cache.path("model", torch.float32, "cpu", shapes)
+            self.assertTrue(path.is_file())
+
+            # A new cache loads the saved trace, and other shapes get other entries
+            loaded = TracedUNetCache(cache_dir).get_or_trace(unet, "model", shapes)
+            self.assertNotEqual(cache.path("model", torch.float32, "cpu", ((1, 4, 8, 16),)), path)
+
+            for module in (traced, loaded):
+                dispatcher = ShapeTracedUNet(unet, {shapes: module})
+                unet.calls = 0
+                with torch.no_grad():
+                    output = dispatcher(
+                        sample, timestep, encoder_hidden_states=encoder_hidden_states
+                    )
+                torch.testing.assert_close(output.sample, expected)
+                self.assertEqual(unet.calls, 0)
+
+            # Shapes without a trace run the eager UNet
+            with torch.no_grad():
+                output = dispatcher(
+                    sample[:1], 500, encoder_hidden_states=encoder_hidden_states[:1]
+                )
+            torch.testing.assert_close(output.sample, expected[:1])
+            self.assertEqual(unet.calls, 1)
+            self.assertEqual(dispatcher.in_channels, 4)
+
+            # Or are traced on first use with a trace function
+            lazy = ShapeTracedUNet(
+                unet, trace=lambda shapes: cache.get_or_trace(unet, "model", shapes)
+            )
+            with torch.no_grad():
+                output = lazy(sample[:1], 500, encoder_hidden_states=encoder_hidden_states[:1])
+            torch.testing.assert_close(output.sample, expected[:1])
+            self.assertEqual(list(lazy.traced), [((1, 4, 8, 16), (1, 77, 32))])
@@ -1,13 +1,16 @@
 import os
 import sys
+from dataclasses import dataclass
 from math import floor, ceil
+from typing import Any
+import numpy as np
 import PIL
 import pydub
-from diffusers import DiffusionPipeline, StableDiffusionImg2ImgPipeline
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'riffusion'))
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
 from riffusion.spectrogram_params import SpectrogramParams
+from riffusion.util import audio_util, image_util
+from riffusion.util.loading_util import BackgroundLoader
 
 from config import config
 
@@ -15,16 +18,58 @@ from config import config
 print(f'File location: {__file__}')
 
 
-init_image = PIL.Image.open(os.path.join(os.path.dirname(__file__), 'riffusion', 'seed_images', 'og_beat.png')).convert('RGB')
+@dataclass
+class Models:
+    init_image: PIL.Image.Image
+    pipeline: Any
+    diffusion_img_to_img: Any
+    spectrogram_params: SpectrogramParams
+    spectrogram_image_converter: Any
 
 
-pipeline = DiffusionPipeline.from_pretrained('riffusion/riffusion-model-v1').to(config.device)
-diffusion_img_to_img = StableDiffusionImg2ImgPipeline.from_pipe(pipeline)
-spectrogram_params = SpectrogramParams()
-spectrogram_image_converter = SpectrogramImageConverter(spectrogram_params)
+def load_models() -> Models:
+    # torch and diffusers are imported here, so importing this module does not wait for them
+    import torch
+    from riffusion.model_registry import get_model_registry
+    from riffusion.spectrogram_image_converter import get_spectrogram_image_converter
+
+    print(f'cuda: {torch.cuda.is_available()}')
+
+    init_image = PIL.Image.open(os.path.join(os.path.dirname(__file__), 'riffusion', 'seed_images', 'og_beat.png')).convert('RGB')
+
+    # Both pipelines are views over one copy of the weights
+    model_registry = get_model_registry()
+    pipeline = model_registry.txt2img('riffusion/riffusion-model-v1', device=config.device, dtype=torch.float32)
+    diffusion_img_to_img = model_registry.img2img('riffusion/riffusion-model-v1', device=config.device, dtype=torch.float32)
+    spectrogram_params = SpectrogramParams()
+    spectrogram_image_converter = get_spectrogram_image_converter(spectrogram_params, config.device)
+
+    print('Models loaded')
+    return Models(init_image, pipeline, diffusion_img_to_img, spectrogram_params, spectrogram_image_converter)
+
+
+# Loading starts with start_loading() or on the first inference, whichever comes first
+models_loader = BackgroundLoader(load_models, name='riffusion-models')
+
+
+def start_loading() -> None:
+    models_loader.start()
+
+
+def is_ready() -> bool:
+    return models_loader.ready
 
 
 def inference(prompt: str, guidance_scale: float, num_inference_steps: int, duration: float, save_path: str, format: str):
+    from riffusion.streaming_converter import StreamingSpectrogramConverter
+
+    models = models_loader.get()
+    init_image = models.init_image
+    pipeline = models.pipeline
+    diffusion_img_to_img = models.diffusion_img_to_img
+    spectrogram_params = models.spectrogram_params
+    spectrogram_image_converter = models.spectrogram_image_converter
+
     default_width = 512
     default_duration = 5.12
     
@@ -35,7 +80,9 @@ def inference(prompt: str, guidance_scale: float, num_inference_steps: int, dura
     width = config.max_image_width
     iters = ceil(total_width / width)
     
-    spectrograms = []
+    streaming_converter = StreamingSpectrogramConverter(spectrogram_image_converter.converter)
+    waveform_chunks = []
+    spectrogram = None
     for idx in range(iters):
         if idx == 0:
             spectrogram = pipeline(
@@ -43,10 +90,20 @@ def inference(prompt: str, guidance_scale: float, num_inference_steps: int, dura
                 num_inference_steps=num_inference_steps
             )['images'][0]
         else:
-            spectrogram = diffusion_img_to_img(prompt, image=spectrograms[-1], strength=0.9, guidance_scale=guidance_scale).images[0]
-        spectrograms.append(spectrogram)
+            spectrogram = diffusion_img_to_img(prompt, image=spectrogram, strength=0.9, guidance_scale=guidance_scale).images[0]
         
-    audio = pydub.AudioSegment.empty()
-    for spectrogram in spectrograms:
-        audio += spectrogram_image_converter.audio_from_spectrogram_image(spectrogram)
+        # Reconstruct the audio of each tile as soon as it is produced, with a crossfade
+        # between tiles so there are no seams
+        mel_amplitudes = image_util.spectrogram_from_image(
+            spectrogram, power=spectrogram_params.power_for_image, stereo=spectrogram_params.stereo)
+        waveform_chunks.extend(streaming_converter.push(mel_amplitudes))
+    waveform_chunks.extend(streaming_converter.flush())
+    
+    # A part too short for a single tile has no audio
+    if waveform_chunks:
+        audio = audio_util.audio_from_waveform(
+            np.concatenate(waveform_chunks, axis=1), spectrogram_params.sample_rate, normalize=True)
+        audio = audio_util.apply_filters(audio)
+    else:
+        audio = pydub.AudioSegment.empty()
     audio.export(save_path, format=format)